@@ -28,6 +28,7 @@ from ..tasks import (
 )
 from .. import serializers
 from .mixin import SerializeToTreeNodeMixin
+from ..pagination import NodeChildrenCursorPagination
 from assets.locks import NodeAddChildrenLock
 
 
@@ -164,7 +165,7 @@ class NodeChildrenApi(generics.ListCreateAPIView):
             return Node.objects.none()
 
         if query_all:
-            queryset = self.instance.get_all_children(with_self=with_self)
+            queryset = self.instance.get_descendants(with_self=with_self)
         else:
             queryset = self.instance.get_children(with_self=with_self)
         return queryset
@@ -186,12 +187,26 @@ class NodeChildrenAsTreeApi(SerializeToTreeNodeMixin, NodeChildrenApi):
     model = Node
 
     def list(self, request, *args, **kwargs):
+        paginator = NodeChildrenCursorPagination(request)
+        if paginator.enabled:
+            return self.list_page(paginator)
+
         nodes = self.get_queryset().order_by('value')
         nodes = self.serialize_nodes(nodes, with_asset_amount=True)
         assets = self.get_assets()
         data = [*nodes, *assets]
         return Response(data=data)
 
+    def list_page(self, paginator: NodeChildrenCursorPagination):
+        """
+        子节点很多时分页返回，资产只在第一页返回
+        """
+        nodes = paginator.paginate_queryset(self.get_queryset())
+        data = self.serialize_nodes(nodes, with_asset_amount=True)
+        if paginator.is_first_page:
+            data.extend(self.get_assets())
+        return Response(data=paginator.get_paginated_data(data))
+
     def get_assets(self):
         include_assets = self.request.query_params.get('assets', '0') == '1'
         if not self.instance or not include_assets:
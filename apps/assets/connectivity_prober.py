@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+#
+import asyncio
+import socket
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import paramiko
+from django.conf import settings
+
+from common.utils import get_logger
+
+__all__ = [
+    'ProbeTarget', 'AsyncConnectivityProber',
+    'split_hosts_for_prober', 'probe_assets_connectivity',
+]
+
+logger = get_logger(__file__)
+
+# auth: {'username', 'password', 'private_key'(文件路径)}，为 None 时只检查端口
+ProbeTarget = namedtuple('ProbeTarget', ['name', 'ip', 'port', 'protocol', 'auth'])
+
+
+class AsyncConnectivityProber:
+    """
+    用 asyncio 检测主机端口是否可达，ssh 协议读取服务端 banner，
+    需要认证时在线程池中用 paramiko 完成认证
+
+    代替只为了判断可连接性而执行的 ansible ping，不依赖 django 的模型，
+    可以直接对本地的 sshd 或 TCP 服务测试
+    """
+
+    def __init__(self, concurrency=None, timeout=None, auth_workers=None):
+        self.concurrency = concurrency or settings.CONNECTIVITY_PROBE_CONCURRENCY
+        self.timeout = timeout or settings.CONNECTIVITY_PROBE_TIMEOUT
+        self.auth_workers = auth_workers or settings.CONNECTIVITY_PROBE_AUTH_WORKERS
+
+    async def probe_tcp(self, target: ProbeTarget):
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(target.ip, target.port), self.timeout
+            )
+        except asyncio.TimeoutError:
+            return False, 'Connect timeout'
+        except OSError as e:
+            return False, str(e)
+
+        try:
+            if target.protocol != 'ssh':
+                return True, ''
+            banner = await asyncio.wait_for(reader.readline(), self.timeout)
+            if not banner.startswith(b'SSH-'):
+                return False, 'Invalid ssh banner'
+            return True, ''
+        except asyncio.TimeoutError:
+            return False, 'Read ssh banner timeout'
+        except OSError as e:
+            return False, str(e)
+        finally:
+            writer.close()
+
+    def ssh_auth(self, target: ProbeTarget):
+        auth = target.auth
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        try:
+            client.connect(
+                target.ip, port=target.port,
+                username=auth.get('username'),
+                password=auth.get('password') or None,
+                key_filename=auth.get('private_key') or None,
+                timeout=self.timeout, banner_timeout=self.timeout, auth_timeout=self.timeout,
+                allow_agent=False, look_for_keys=False,
+            )
+            return True, ''
+        except (paramiko.SSHException, socket.error, EOFError) as e:
+            return False, str(e) or e.__class__.__name__
+        finally:
+            client.close()
+
+    async def probe_one(self, target, semaphore, executor):
+        async with semaphore:
+            ok, error = await self.probe_tcp(target)
+            if ok and target.auth and target.protocol == 'ssh':
+                loop = asyncio.get_event_loop()
+                ok, error = await loop.run_in_executor(executor, self.ssh_auth, target)
+            return target.name, ok, error
+
+    async def probe_all(self, targets):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        with ThreadPoolExecutor(max_workers=self.auth_workers) as executor:
+            results = await asyncio.gather(*[
+                self.probe_one(target, semaphore, executor) for target in targets
+            ])
+        return results
+
+    def probe(self, targets) -> dict:
+        """
+        同一个 name 可以有多个 target(每个协议端口一个)，全部可连接时才算可连接
+
+        :return: {name: (ok, error)}
+        """
+        if not targets:
+            return {}
+        results = asyncio.run(self.probe_all(targets))
+        errors = {}
+        for target, (name, ok, error) in zip(targets, results):
+            errors.setdefault(name, [])
+            if not ok:
+                errors[name].append(f'{target.protocol}/{target.port}: {error}')
+        return {name: (not _errors, '; '.join(_errors)) for name, _errors in errors.items()}
+
+
+def split_hosts_for_prober(prefetcher):
+    """
+    windows 使用 ansible 的 win_ping 检测，网域网关后的资产需要经过代理，
+    这两类仍然交给 ansible，其它资产直接检测
+
+    :param prefetcher: `ops.inventory.InventoryPrefetcher`，平台和网关已经批量查询
+    """
+    probe_assets, ansible_assets = [], []
+    for asset in prefetcher.assets:
+        if asset.is_windows() or prefetcher.has_gateway(asset):
+            ansible_assets.append(asset)
+        else:
+            probe_assets.append(asset)
+    return probe_assets, ansible_assets
+
+
+def probe_assets_connectivity(assets, prefetcher, system_user=None):
+    """
+    检测资产的协议端口，测试系统用户时只检测系统用户的协议，否则检测资产的所有协议；
+    ssh 协议使用系统用户或者资产的管理用户认证，认证信息从 prefetcher 中获取
+
+    :param prefetcher: `ops.inventory.InventoryPrefetcher`，测试系统用户时需要使用同一个系统用户创建
+    :return: 与 ansible 执行结果的格式一致 {'contacted': {}, 'dark': {}, 'success': bool}，
+        另外 `unverified` 中是没有做 ssh 认证、只检测了端口的主机名，不能用来判断账号的可连接性
+    """
+    with_auth = settings.CONNECTIVITY_PROBE_SSH_AUTH
+    summary = {'contacted': {}, 'dark': {}, 'success': True, 'unverified': []}
+    targets = []
+    for asset in assets:
+        protocols = asset.protocols_as_dict
+        if system_user:
+            protocols = {k: v for k, v in protocols.items() if k == system_user.protocol}
+        if not protocols:
+            summary['dark'][asset.hostname] = {'ping': 'No protocol to probe'}
+            summary['success'] = False
+            continue
+
+        auth = None
+        if with_auth and 'ssh' in protocols:
+            if system_user:
+                auth = prefetcher.get_system_user_auth_info(asset, username=system_user.username)
+            else:
+                auth = prefetcher.get_admin_auth_info(asset) or None
+        if not auth:
+            summary['unverified'].append(asset.hostname)
+        for protocol, port in protocols.items():
+            _auth = auth if protocol == 'ssh' else None
+            targets.append(ProbeTarget(asset.hostname, asset.ip, port, protocol, _auth))
+
+    results = AsyncConnectivityProber().probe(targets)
+    for hostname, (ok, error) in results.items():
+        if ok:
+            summary['contacted'][hostname] = {'ping': 'pong'}
+        else:
+            summary['dark'][hostname] = {'ping': error}
+            summary['success'] = False
+    logger.info(f'Probe assets connectivity: targets={len(targets)} '
+                f'ok={len(summary["contacted"])} failed={len(summary["dark"])}')
+    return summary
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from assets.models import NodeAncestry
+
+
+class Command(BaseCommand):
+    help = 'Rebuild node ancestry table from node keys'
+
+    def handle(self, *args, **options):
+        amount = NodeAncestry.rebuild_all()
+        self.stdout.write(self.style.SUCCESS(f'Rebuild node ancestry done: {amount} rows'))
@@ -0,0 +1,47 @@
+# Generated by Django 3.1.12 on 2021-09-22 10:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def build_node_ancestry(apps, schema_editor):
+    node_model = apps.get_model('assets', 'Node')
+    ancestry_model = apps.get_model('assets', 'NodeAncestry')
+
+    key_id_mapper = dict(node_model.objects.all().values_list('key', 'id'))
+    to_create = []
+    for key, node_id in key_id_mapper.items():
+        key_list = key.split(':')
+        for depth in range(len(key_list)):
+            ancestor_key = ':'.join(key_list[:len(key_list) - depth])
+            if ancestor_key not in key_id_mapper:
+                continue
+            to_create.append(ancestry_model(
+                ancestor_id=key_id_mapper[ancestor_key], descendant_id=node_id, depth=depth
+            ))
+    ancestry_model.objects.bulk_create(to_create, batch_size=5000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('assets', '0076_delete_assetuser'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NodeAncestry',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('depth', models.IntegerField(default=0, verbose_name='Depth')),
+                ('ancestor', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='descendant_rels', to='assets.node', verbose_name='Ancestor')),
+                ('descendant', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='ancestor_rels', to='assets.node', verbose_name='Descendant')),
+            ],
+            options={
+                'verbose_name': 'Node ancestry',
+                'unique_together': {('ancestor', 'descendant')},
+                'index_together': {('descendant', 'depth')},
+            },
+        ),
+        migrations.RunPython(build_node_ancestry),
+    ]
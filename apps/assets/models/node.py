@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 #
 import re
+import json
 import time
 import uuid
 import threading
@@ -24,9 +25,10 @@ from common.utils import get_logger
 from orgs.mixins.models import OrgModelMixin, OrgManager
 from orgs.utils import get_current_org, tmp_to_org, tmp_to_root_org
 from orgs.models import Organization
+from assets.node_assets_index import NodeAssetsIndex
 
 
-__all__ = ['Node', 'FamilyMixin', 'compute_parent_key', 'NodeQuerySet']
+__all__ = ['Node', 'FamilyMixin', 'compute_parent_key', 'NodeQuerySet', 'NodeAncestry']
 logger = get_logger(__name__)
 
 
@@ -258,7 +260,7 @@ class FamilyMixin:
 class NodeAllAssetsMappingMixin:
     # Use a new plan
 
-    # { org_id: { node_key: [ asset1_id, asset2_id ] } }
+    # { org_id: NodeAssetsIndex }
     orgid_nodekey_assetsid_mapping = defaultdict(dict)
     locks_for_get_mapping_from_cache = defaultdict(threading.Lock)
 
@@ -315,6 +317,92 @@ class NodeAllAssetsMappingMixin:
         for id in org_ids:
             cls.expire_node_all_asset_ids_mapping_from_memory(id)
 
+    @classmethod
+    def patch_node_all_asset_ids_mapping_in_memory(cls, org_id, version, delta):
+        """
+        应用一个增量到内存中的映射，版本不连续说明丢了增量，直接清除，下次使用时全量加载
+        """
+        org_id = str(org_id)
+        with cls.get_lock(org_id):
+            mapping = cls.orgid_nodekey_assetsid_mapping.get(org_id)
+            if not mapping or not isinstance(mapping, NodeAssetsIndex):
+                return False
+            if mapping.version >= version:
+                # 生成映射时已经包含了这个增量
+                return True
+            if mapping.version + 1 != version:
+                logger.info(f'Node asset mapping missed delta: org_id={org_id} '
+                            f'version={mapping.version} delta_version={version}')
+                cls.expire_node_all_asset_ids_mapping_from_memory(org_id)
+                return False
+            mapping.patch(**delta)
+            mapping.version = version
+            return True
+
+    # version
+    @staticmethod
+    def _get_cache_key_for_node_all_asset_ids_mapping_version(org_id):
+        return 'ASSETS_ORG_NODE_ALL_ASSET_ids_INDEX_VERSION_{}'.format(org_id)
+
+    @classmethod
+    def get_node_all_asset_ids_mapping_version(cls, org_id):
+        key = cls._get_cache_key_for_node_all_asset_ids_mapping_version(org_id)
+        client = cache.client.get_client(write=True)
+        version = client.get(key)
+        return int(version or 0)
+
+    @classmethod
+    def incr_node_all_asset_ids_mapping_version(cls, org_id):
+        key = cls._get_cache_key_for_node_all_asset_ids_mapping_version(org_id)
+        client = cache.client.get_client(write=True)
+        return client.incr(key)
+
+    # delta log
+    # 最近的增量保存在 redis 中，缓存的映射落后时重放增量，而不是重新生成
+    node_all_asset_ids_mapping_delta_log_size = 1000
+
+    @staticmethod
+    def _get_cache_key_for_node_all_asset_ids_mapping_deltas(org_id):
+        return 'ASSETS_ORG_NODE_ALL_ASSET_ids_INDEX_DELTAS_{}'.format(org_id)
+
+    @classmethod
+    def push_node_all_asset_ids_mapping_delta(cls, org_id, delta):
+        """
+        递增版本号并记录这个版本的增量
+
+        :return: 增量的版本号
+        """
+        version = cls.incr_node_all_asset_ids_mapping_version(org_id)
+        key = cls._get_cache_key_for_node_all_asset_ids_mapping_deltas(org_id)
+        client = cache.client.get_client(write=True)
+        with client.pipeline() as p:
+            p.rpush(key, json.dumps({'version': version, 'delta': delta}))
+            p.ltrim(key, -cls.node_all_asset_ids_mapping_delta_log_size, -1)
+            p.execute()
+        return version
+
+    @classmethod
+    def replay_node_all_asset_ids_mapping_deltas(cls, org_id, mapping, version):
+        """
+        在落后的映射上按顺序重放增量直到 `version`，中间缺少增量时返回 False，
+        例如整个清除映射时只递增版本号、增量已经被截断，或者另一个进程还没有写入增量
+        """
+        if not isinstance(mapping, NodeAssetsIndex) or mapping.version > version:
+            return False
+        key = cls._get_cache_key_for_node_all_asset_ids_mapping_deltas(org_id)
+        client = cache.client.get_client(write=True)
+        entries = [json.loads(entry) for entry in client.lrange(key, 0, -1)]
+        entries = {
+            entry['version']: entry['delta'] for entry in entries
+            if mapping.version < entry['version'] <= version
+        }
+        if len(entries) != version - mapping.version:
+            return False
+        for _version in range(mapping.version + 1, version + 1):
+            mapping.patch(**entries[_version])
+        mapping.version = version
+        return True
+
     # get order: from memory -> (from cache -> to generate)
     @classmethod
     def get_node_all_asset_ids_mapping_from_cache_or_generate_to_cache(cls, org_id):
@@ -339,6 +427,14 @@ class NodeAllAssetsMappingMixin:
     def get_node_all_asset_ids_mapping_from_cache(cls, org_id):
         cache_key = cls._get_cache_key_for_node_all_asset_ids_mapping(org_id)
         mapping = cache.get(cache_key)
+        version = cls.get_node_all_asset_ids_mapping_version(org_id)
+        if mapping and mapping.version != version:
+            if cls.replay_node_all_asset_ids_mapping_deltas(org_id, mapping, version):
+                # 写回重放后的映射，版本号保证不会用到更旧的
+                cache.set(cache_key, mapping, timeout=None)
+            else:
+                # 缓存的是旧版本，错过的增量无法重放，不能再使用
+                mapping = None
         logger.info(f'Get node asset mapping from cache {bool(mapping)}: '
                     f'thread={threading.get_ident()} '
                     f'org_id={org_id}')
@@ -356,7 +452,7 @@ class NodeAllAssetsMappingMixin:
 
     @staticmethod
     def _get_cache_key_for_node_all_asset_ids_mapping(org_id):
-        return 'ASSETS_ORG_NODE_ALL_ASSET_ids_MAPPING_{}'.format(org_id)
+        return 'ASSETS_ORG_NODE_ALL_ASSET_ids_INDEX_{}'.format(org_id)
 
     @classmethod
     def generate_node_all_asset_ids_mapping(cls, org_id):
@@ -366,10 +462,13 @@ class NodeAllAssetsMappingMixin:
                     f'thread={threading.get_ident()} '
                     f'org_id={org_id}')
         t1 = time.time()
+        # 要在查询数据前取版本号，这之后的增量即使已经包含在数据里，重复应用也没有影响
+        version = cls.get_node_all_asset_ids_mapping_version(org_id)
         with tmp_to_org(org_id):
             node_ids_key = Node.objects.annotate(
                 char_id=output_as_string('id')
             ).values_list('char_id', 'key')
+            node_ids_key = list(node_ids_key)
 
             # * 直接取出全部. filter(node__org_id=org_id)(大规模下会更慢)
             nodes_asset_ids = Asset.nodes.through.objects.all() \
@@ -377,28 +476,97 @@ class NodeAllAssetsMappingMixin:
                 .annotate(char_asset_id=output_as_string('asset_id')) \
                 .values_list('char_node_id', 'char_asset_id')
 
-            node_id_ancestor_keys_mapping = {
-                node_id: cls.get_node_ancestor_keys(node_key, with_self=True)
-                for node_id, node_key in node_ids_key
-            }
-
             nodeid_assetsid_mapping = defaultdict(set)
             for node_id, asset_id in nodes_asset_ids:
                 nodeid_assetsid_mapping[node_id].add(asset_id)
 
         t2 = time.time()
 
-        mapping = defaultdict(set)
-        for node_id, node_key in node_ids_key:
-            asset_ids = nodeid_assetsid_mapping[node_id]
-            node_ancestor_keys = node_id_ancestor_keys_mapping[node_id]
-            for ancestor_key in node_ancestor_keys:
-                mapping[ancestor_key].update(asset_ids)
+        nodekey_assetsid_mapping = {
+            node_key: nodeid_assetsid_mapping[node_id]
+            for node_id, node_key in node_ids_key
+            if node_id in nodeid_assetsid_mapping
+        }
+        node_keys = [node_key for __, node_key in node_ids_key]
+        mapping = NodeAssetsIndex.build(node_keys, nodekey_assetsid_mapping)
+        mapping.version = version
 
         t3 = time.time()
-        logger.info('t1-t2(DB Query): {} s, t3-t2(Generate mapping): {} s'.format(t2-t1, t3-t2))
+        logger.info('t1-t2(DB Query): {} s, t3-t2(Generate mapping): {} s, memory: {}'.format(
+            t2-t1, t3-t2, mapping.memory_usage()
+        ))
         return mapping
 
+    @classmethod
+    def get_node_all_asset_ids_mapping_memory_usage(cls):
+        """
+        当前进程中各组织节点资产索引占用的内存
+        """
+        return {
+            org_id: mapping.memory_usage()
+            for org_id, mapping in cls.orgid_nodekey_assetsid_mapping.items()
+            if isinstance(mapping, NodeAssetsIndex)
+        }
+
+
+class NodeAncestryMixin:
+    """
+    通过 `NodeAncestry` 闭包表查询祖先和后代节点，走索引关联，代替 `key__startswith`
+    """
+    id = None
+    key = ''
+
+    @staticmethod
+    def get_nodes_descendant_ids(node_ids, with_self=True):
+        """
+        :return: 后代节点 id 的 queryset，可以直接用作子查询
+        """
+        depth_lookup = 'depth__gte' if with_self else 'depth__gt'
+        return NodeAncestry.objects.filter(
+            ancestor_id__in=node_ids, **{depth_lookup: 0}
+        ).values_list('descendant_id', flat=True)
+
+    @staticmethod
+    def get_nodes_ancestor_ids(node_ids, with_self=True):
+        depth_lookup = 'depth__gte' if with_self else 'depth__gt'
+        return NodeAncestry.objects.filter(
+            descendant_id__in=node_ids, **{depth_lookup: 0}
+        ).values_list('ancestor_id', flat=True)
+
+    @classmethod
+    def get_node_descendant_ids_by_key(cls, key, with_self=True):
+        depth_lookup = 'depth__gte' if with_self else 'depth__gt'
+        return NodeAncestry.objects.filter(
+            ancestor__key=key, **{depth_lookup: 0}
+        ).values_list('descendant_id', flat=True)
+
+    def get_descendants(self, with_self=False):
+        node_ids = self.get_nodes_descendant_ids([self.id], with_self=with_self)
+        return Node.objects.filter(id__in=node_ids)
+
+    def rebuild_ancestry(self):
+        """
+        重建该节点作为后代的闭包数据，节点创建或 key 变化时调用
+        """
+        ancestor_keys = self.get_node_ancestor_keys(self.key, with_self=True)
+        with tmp_to_root_org():
+            key_id_mapper = dict(Node.objects.filter(
+                key__in=ancestor_keys
+            ).values_list('key', 'id'))
+
+        missing_keys = [key for key in ancestor_keys if key not in key_id_mapper]
+        if missing_keys:
+            logger.warning(f'Rebuild node ancestry, ancestor nodes not found: '
+                           f'node={self.key} missing={missing_keys}')
+
+        to_create = [
+            NodeAncestry(ancestor_id=key_id_mapper[key], descendant_id=self.id, depth=depth)
+            for depth, key in enumerate(ancestor_keys)
+            if key in key_id_mapper
+        ]
+        NodeAncestry.objects.filter(descendant_id=self.id).delete()
+        NodeAncestry.objects.bulk_create(to_create)
+
 
 class NodeAssetsMixin(NodeAllAssetsMappingMixin):
     org_id: str
@@ -408,20 +576,18 @@ class NodeAssetsMixin(NodeAllAssetsMappingMixin):
 
     def get_all_assets(self):
         from .asset import Asset
-        q = Q(nodes__key__startswith=f'{self.key}:') | Q(nodes__key=self.key)
-        return Asset.objects.filter(q).distinct()
+        node_ids = self.get_nodes_descendant_ids([self.id], with_self=True)
+        return Asset.objects.filter(nodes__id__in=node_ids).distinct()
 
     @classmethod
     def get_node_all_assets_by_key_v2(cls, key):
         # 最初的写法是：
         #   Asset.objects.filter(Q(nodes__key__startswith=f'{node.key}:') | Q(nodes__id=node.id))
-        #   可是 startswith 会导致表关联时 Asset 索引失效
+        #   可是 startswith 会导致表关联时 Asset 索引失效，现在通过闭包表关联
         from .asset import Asset
-        node_ids = cls.objects.filter(
-            Q(key__startswith=f'{key}:') | Q(key=key)
-        ).values_list('id', flat=True).distinct()
+        node_ids = cls.get_node_descendant_ids_by_key(key, with_self=True)
         assets = Asset.objects.filter(
-            nodes__id__in=list(node_ids)
+            nodes__id__in=node_ids
         ).distinct()
         return assets
 
@@ -445,15 +611,11 @@ class NodeAssetsMixin(NodeAllAssetsMappingMixin):
     @classmethod
     def get_nodes_all_assets(cls, *nodes):
         from .asset import Asset
-        node_ids = set()
-        descendant_node_query = Q()
-        for n in nodes:
-            node_ids.add(n.id)
-            descendant_node_query |= Q(key__istartswith=f'{n.key}:')
-        if descendant_node_query:
-            _ids = Node.objects.order_by().filter(descendant_node_query).values_list('id', flat=True)
-            node_ids.update(_ids)
-        return Asset.objects.order_by().filter(nodes__id__in=node_ids).distinct()
+        node_ids = {n.id for n in nodes}
+        if not node_ids:
+            return Asset.objects.none()
+        descendant_ids = cls.get_nodes_descendant_ids(node_ids, with_self=True)
+        return Asset.objects.order_by().filter(nodes__id__in=descendant_ids).distinct()
 
     def get_all_asset_ids(self):
         asset_ids = self.get_all_asset_ids_by_node_key(org_id=self.org_id, node_key=self.key)
@@ -463,8 +625,15 @@ class NodeAssetsMixin(NodeAllAssetsMappingMixin):
     def get_all_asset_ids_by_node_key(cls, org_id, node_key):
         org_id = str(org_id)
         nodekey_assetsid_mapping = cls.get_node_all_asset_ids_mapping(org_id)
-        asset_ids = nodekey_assetsid_mapping.get(node_key, [])
-        return set(asset_ids)
+        # `NodeAssetsIndex.get` 返回的已经是新的集合
+        asset_ids = nodekey_assetsid_mapping.get(node_key)
+        return asset_ids or set()
+
+    @classmethod
+    def get_all_assets_amount_by_node_key(cls, org_id, node_key):
+        org_id = str(org_id)
+        nodekey_assetsid_mapping = cls.get_node_all_asset_ids_mapping(org_id)
+        return nodekey_assetsid_mapping.count(node_key)
 
 
 class SomeNodesMixin:
@@ -540,7 +709,7 @@ class SomeNodesMixin:
         return root_nodes
 
 
-class Node(OrgModelMixin, SomeNodesMixin, FamilyMixin, NodeAssetsMixin):
+class Node(OrgModelMixin, SomeNodesMixin, FamilyMixin, NodeAncestryMixin, NodeAssetsMixin):
     id = models.UUIDField(default=uuid.uuid4, primary_key=True)
     key = models.CharField(unique=True, max_length=64, verbose_name=_("Key"))  # '1:1:1:1'
     value = models.CharField(max_length=128, verbose_name=_("Value"))
@@ -649,8 +818,65 @@ class Node(OrgModelMixin, SomeNodesMixin, FamilyMixin, NodeAssetsMixin):
             node.full_value = parent.full_value + '/' + node.value
         self.__class__.objects.bulk_update(nodes, ['full_value'])
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_key = instance.__dict__.get('key')
+        return instance
+
     def save(self, *args, **kwargs):
         self.full_value = self.computed_full_value()
+        adding = self._state.adding
+        loaded_key = getattr(self, '_loaded_key', None)
         instance = super().save(*args, **kwargs)
+        if adding or (loaded_key is not None and loaded_key != self.key):
+            self.rebuild_ancestry()
+            self._loaded_key = self.key
         self.update_child_full_value()
         return instance
+
+
+class NodeAncestry(models.Model):
+    """
+    节点的闭包表，每个节点与它的每个祖先（包括自己）一条记录
+    """
+    id = models.BigAutoField(primary_key=True)
+    ancestor = models.ForeignKey(
+        'assets.Node', on_delete=models.CASCADE, db_constraint=False,
+        related_name='descendant_rels', verbose_name=_('Ancestor')
+    )
+    descendant = models.ForeignKey(
+        'assets.Node', on_delete=models.CASCADE, db_constraint=False,
+        related_name='ancestor_rels', verbose_name=_('Descendant')
+    )
+    depth = models.IntegerField(default=0, verbose_name=_('Depth'))
+
+    class Meta:
+        verbose_name = _('Node ancestry')
+        unique_together = [('ancestor', 'descendant')]
+        index_together = [('descendant', 'depth')]
+
+    def __str__(self):
+        return f'{self.ancestor_id} -> {self.descendant_id} ({self.depth})'
+
+    @classmethod
+    def rebuild_all(cls):
+        """
+        根据节点的 key 重建整张表
+        """
+        with tmp_to_root_org():
+            key_id_mapper = dict(Node.objects.all().values_list('key', 'id'))
+
+        to_create = []
+        for key, node_id in key_id_mapper.items():
+            ancestor_keys = Node.get_node_ancestor_keys(key, with_self=True)
+            for depth, ancestor_key in enumerate(ancestor_keys):
+                if ancestor_key not in key_id_mapper:
+                    continue
+                to_create.append(cls(
+                    ancestor_id=key_id_mapper[ancestor_key], descendant_id=node_id, depth=depth
+                ))
+        with transaction.atomic():
+            cls.objects.all().delete()
+            cls.objects.bulk_create(to_create, batch_size=5000)
+        return len(to_create)
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+#
+import sys
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+
+from common.utils import get_logger
+
+__all__ = ['CompactIdSet', 'NodeAssetsIndex']
+
+logger = get_logger(__file__)
+
+ARRAY_TYPECODE = 'I'
+
+
+def compute_parent_key(key):
+    try:
+        return key[:key.rindex(':')]
+    except ValueError:
+        return ''
+
+
+class CompactIdSet:
+    """
+    由有序的 int 数组保存的集合，每个元素 4 字节
+    集合运算时转换成 int 位图计算
+    """
+    __slots__ = ('_array',)
+
+    def __init__(self, values=()):
+        self._array = array(ARRAY_TYPECODE, sorted(set(values)))
+
+    @classmethod
+    def from_sorted_array(cls, _array):
+        instance = cls.__new__(cls)
+        instance._array = _array
+        return instance
+
+    @classmethod
+    def from_bitmap(cls, bitmap: int):
+        _array = array(ARRAY_TYPECODE)
+        data = bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little')
+        for i, byte in enumerate(data):
+            if not byte:
+                continue
+            base = i << 3
+            for bit in range(8):
+                if byte & (1 << bit):
+                    _array.append(base + bit)
+        return cls.from_sorted_array(_array)
+
+    def to_bitmap(self) -> int:
+        if not self._array:
+            return 0
+        data = bytearray((self._array[-1] >> 3) + 1)
+        for i in self._array:
+            data[i >> 3] |= 1 << (i & 7)
+        return int.from_bytes(data, 'little')
+
+    def __len__(self):
+        return len(self._array)
+
+    def __iter__(self):
+        return iter(self._array)
+
+    def __contains__(self, value):
+        i = bisect_left(self._array, value)
+        return i < len(self._array) and self._array[i] == value
+
+    def __eq__(self, other):
+        if not isinstance(other, CompactIdSet):
+            return NotImplemented
+        return self._array == other._array
+
+    def __repr__(self):
+        return f'<CompactIdSet: {len(self)}>'
+
+    @property
+    def nbytes(self):
+        return self._array.buffer_info()[1] * self._array.itemsize
+
+    def union(self, *others):
+        bitmap = self.to_bitmap()
+        for other in others:
+            bitmap |= other.to_bitmap()
+        return self.from_bitmap(bitmap)
+
+    def intersection(self, *others):
+        bitmap = self.to_bitmap()
+        for other in others:
+            if not bitmap:
+                break
+            bitmap &= other.to_bitmap()
+        return self.from_bitmap(bitmap)
+
+    def difference(self, *others):
+        bitmap = self.to_bitmap()
+        for other in others:
+            bitmap &= ~other.to_bitmap()
+        return self.from_bitmap(bitmap)
+
+    __or__ = union
+    __and__ = intersection
+    __sub__ = difference
+
+
+class NodeAssetsIndex:
+    """
+    节点 key 到该节点及其后代节点下所有资产的索引
+
+    资产 id 被编号成连续的 int，每个节点的资产保存为 `CompactIdSet`，
+    替代原来的 {node_key: set(asset_id_str)}，内存和序列化后的体积都会小很多
+
+    兼容 dict 的 `get`，返回资产 id (str) 的集合
+    """
+
+    def __init__(self, asset_ids=None, nodekey_idset_mapper=None, version=0):
+        # int -> asset_id(str)
+        self.asset_ids = asset_ids or []
+        # node_key -> CompactIdSet
+        self.nodekey_idset_mapper = nodekey_idset_mapper or {}
+        # 生成时的版本号，每次应用增量后递增，用来发现丢失的增量
+        self.version = version
+        self._asset_id_int_mapper = None
+
+    @classmethod
+    def build(cls, node_keys, nodekey_direct_asset_ids_mapper):
+        """
+        :param node_keys: 组织内所有节点的 key
+        :param nodekey_direct_asset_ids_mapper: 节点直接关联的资产 {node_key: {asset_id, }}
+        """
+        asset_ids = []
+        asset_id_int_mapper = {}
+
+        def intern(asset_id):
+            i = asset_id_int_mapper.get(asset_id)
+            if i is None:
+                i = len(asset_ids)
+                asset_id_int_mapper[asset_id] = i
+                asset_ids.append(asset_id)
+            return i
+
+        # 补全祖先节点，保证自底向上合并时父节点都存在
+        all_keys = set()
+        for key in node_keys:
+            while key and key not in all_keys:
+                all_keys.add(key)
+                key = compute_parent_key(key)
+
+        children_mapper = defaultdict(list)
+        for key in all_keys:
+            parent_key = compute_parent_key(key)
+            if parent_key:
+                children_mapper[parent_key].append(key)
+
+        # 按树的先序给资产编号，同一子树的资产编号尽量连续
+        sort_key = lambda k: [int(i) for i in k.split(':') if i.lstrip('-').isdigit()]
+        for key in sorted(all_keys, key=sort_key):
+            for asset_id in nodekey_direct_asset_ids_mapper.get(key, ()):
+                intern(asset_id)
+
+        # 自底向上合并，同时只保留一个临时的 set
+        nodekey_idset_mapper = {}
+        for key in sorted(all_keys, key=lambda k: k.count(':'), reverse=True):
+            ids = {asset_id_int_mapper[i] for i in nodekey_direct_asset_ids_mapper.get(key, ())}
+            for child_key in children_mapper.get(key, ()):
+                ids.update(nodekey_idset_mapper[child_key])
+            nodekey_idset_mapper[key] = CompactIdSet(ids)
+
+        index = cls(asset_ids=asset_ids, nodekey_idset_mapper=nodekey_idset_mapper)
+        index._asset_id_int_mapper = asset_id_int_mapper
+        return index
+
+    def __getstate__(self):
+        return {
+            'asset_ids': self.asset_ids,
+            'nodekey_arrays': {k: v._array for k, v in self.nodekey_idset_mapper.items()},
+            'version': self.version,
+        }
+
+    def __setstate__(self, state):
+        self.asset_ids = state['asset_ids']
+        self.version = state.get('version', 0)
+        self.nodekey_idset_mapper = {
+            k: CompactIdSet.from_sorted_array(v) for k, v in state['nodekey_arrays'].items()
+        }
+        self._asset_id_int_mapper = None
+
+    @property
+    def asset_id_int_mapper(self):
+        if self._asset_id_int_mapper is None:
+            self._asset_id_int_mapper = {
+                asset_id: i for i, asset_id in enumerate(self.asset_ids)
+            }
+        return self._asset_id_int_mapper
+
+    # 兼容 dict 的接口
+    def __bool__(self):
+        return bool(self.nodekey_idset_mapper)
+
+    def __len__(self):
+        return len(self.nodekey_idset_mapper)
+
+    def __contains__(self, node_key):
+        return node_key in self.nodekey_idset_mapper
+
+    def keys(self):
+        return self.nodekey_idset_mapper.keys()
+
+    def get(self, node_key, default=None):
+        idset = self.nodekey_idset_mapper.get(node_key)
+        if idset is None:
+            return default
+        return self.to_asset_ids(idset)
+
+    # 原生的集合运算
+    def get_idset(self, node_key) -> CompactIdSet:
+        return self.nodekey_idset_mapper.get(node_key) or CompactIdSet()
+
+    def count(self, node_key) -> int:
+        return len(self.get_idset(node_key))
+
+    def union(self, node_keys) -> CompactIdSet:
+        idsets = [self.get_idset(key) for key in node_keys]
+        if not idsets:
+            return CompactIdSet()
+        return idsets[0].union(*idsets[1:])
+
+    def intersection(self, node_keys) -> CompactIdSet:
+        idsets = [self.get_idset(key) for key in node_keys]
+        if not idsets:
+            return CompactIdSet()
+        return idsets[0].intersection(*idsets[1:])
+
+    def to_asset_ids(self, idset) -> set:
+        asset_ids = self.asset_ids
+        return {asset_ids[i] for i in idset}
+
+    def to_idset(self, asset_ids) -> CompactIdSet:
+        mapper = self.asset_id_int_mapper
+        return CompactIdSet(mapper[i] for i in asset_ids if i in mapper)
+
+    def _intern(self, asset_id):
+        mapper = self.asset_id_int_mapper
+        i = mapper.get(asset_id)
+        if i is None:
+            i = len(self.asset_ids)
+            self.asset_ids.append(asset_id)
+            mapper[asset_id] = i
+        return i
+
+    def patch(self, add=None, remove=None, create_keys=(), delete_keys=()):
+        """
+        原地应用增量，增量是幂等的，重复应用不影响结果
+
+        :param add: {node_key: [asset_id, ]} 要加到这些节点上的资产，已包含祖先节点
+        :param remove: {node_key: [asset_id, ]} 要从这些节点上去掉的资产，已包含祖先节点
+        :param create_keys: 新建的节点
+        :param delete_keys: 删除的节点
+        """
+        for key in create_keys:
+            self.nodekey_idset_mapper.setdefault(key, CompactIdSet())
+
+        for key, asset_ids in (add or {}).items():
+            ids = CompactIdSet(self._intern(i) for i in asset_ids)
+            # 整体替换，读的线程拿到的要么是旧的要么是新的
+            self.nodekey_idset_mapper[key] = self.get_idset(key).union(ids)
+
+        for key, asset_ids in (remove or {}).items():
+            if key not in self.nodekey_idset_mapper:
+                continue
+            ids = self.to_idset(asset_ids)
+            self.nodekey_idset_mapper[key] = self.get_idset(key).difference(ids)
+
+        for key in delete_keys:
+            self.nodekey_idset_mapper.pop(key, None)
+
+    def memory_usage(self) -> dict:
+        """
+        估算占用的内存（字节）
+        """
+        asset_ids_bytes = sys.getsizeof(self.asset_ids)
+        asset_ids_bytes += sum(sys.getsizeof(i) for i in self.asset_ids)
+        nodes_bytes = sys.getsizeof(self.nodekey_idset_mapper)
+        for key, idset in self.nodekey_idset_mapper.items():
+            nodes_bytes += sys.getsizeof(key) + sys.getsizeof(idset) + idset.nbytes
+        return {
+            'assets': len(self.asset_ids),
+            'nodes': len(self.nodekey_idset_mapper),
+            'asset_ids_bytes': asset_ids_bytes,
+            'nodes_bytes': nodes_bytes,
+            'total_bytes': asset_ids_bytes + nodes_bytes,
+        }
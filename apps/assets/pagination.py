@@ -1,5 +1,10 @@
+import base64
+import json
+
+from django.db.models import Q
 from rest_framework.pagination import LimitOffsetPagination
 from rest_framework.request import Request
+from rest_framework.serializers import ValidationError
 
 from common.utils import get_logger
 from assets.models import Node
@@ -50,3 +55,79 @@ class NodeAssetTreePagination(AssetPaginationBase):
                 logger.debug(f'Hit node.assets_amount[{node.assets_amount}] -> {self._request.get_full_path()}')
                 return node.assets_amount
         return None
+
+
+class NodeChildrenCursorPagination:
+    """
+    节点的子节点按 (value, key) 排序后的游标分页，请求带 `limit` 参数时启用
+
+    游标是上一页最后一个节点的 (value, key)，翻页不受中间插入、删除节点的影响，
+    也不需要像 offset 那样跳过前面的行
+    """
+    limit_query_param = 'limit'
+    cursor_query_param = 'cursor'
+    max_limit = 1000
+    ordering = ('value', 'key')
+
+    def __init__(self, request: Request):
+        self.request = request
+        self.limit = self.get_limit()
+        self.total = 0
+        self.has_more = False
+        self.next_cursor = None
+
+    @property
+    def enabled(self):
+        return self.limit is not None
+
+    @property
+    def is_first_page(self):
+        return not self.request.query_params.get(self.cursor_query_param)
+
+    def get_limit(self):
+        limit = self.request.query_params.get(self.limit_query_param)
+        if not limit:
+            return None
+        try:
+            limit = int(limit)
+        except ValueError:
+            return None
+        return max(1, min(limit, self.max_limit))
+
+    @staticmethod
+    def encode_cursor(node):
+        value = json.dumps([node.value, node.key]).encode()
+        return base64.urlsafe_b64encode(value).decode()
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            value, key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        except (ValueError, TypeError):
+            raise ValidationError({'cursor': 'Invalid cursor'})
+        return value, key
+
+    def paginate_queryset(self, queryset) -> list:
+        self.total = queryset.count()
+        queryset = queryset.order_by(*self.ordering)
+
+        cursor = self.request.query_params.get(self.cursor_query_param)
+        if cursor:
+            value, key = self.decode_cursor(cursor)
+            queryset = queryset.filter(Q(value__gt=value) | Q(value=value, key__gt=key))
+
+        nodes = list(queryset[:self.limit + 1])
+        self.has_more = len(nodes) > self.limit
+        nodes = nodes[:self.limit]
+        if self.has_more:
+            self.next_cursor = self.encode_cursor(nodes[-1])
+        return nodes
+
+    def get_paginated_data(self, data, **extra) -> dict:
+        return {
+            'total': self.total,
+            'has_more': self.has_more,
+            'next_cursor': self.next_cursor,
+            'results': data,
+            **extra
+        }
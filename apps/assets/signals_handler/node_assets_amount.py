@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 #
+from collections import defaultdict
 from operator import add, sub
+from django.conf import settings
+from django.db import transaction
 from django.db.models import Q, F
 from django.dispatch import receiver
 from django.db.models.signals import (
@@ -8,10 +11,12 @@ from django.db.models.signals import (
 )
 
 from orgs.utils import ensure_in_real_or_default_org, tmp_to_org
-from common.const.signals import PRE_ADD, POST_REMOVE, PRE_CLEAR
+from common.const.signals import PRE_ADD, POST_ADD, PRE_REMOVE, POST_REMOVE, PRE_CLEAR
+from common.local import thread_local
 from common.utils import get_logger
 from assets.models import Asset, Node, compute_parent_key
 from assets.locks import NodeTreeUpdateLock
+from assets.utils import get_assets_node_keys, update_nodes_assets_amount_by_delta
 
 
 logger = get_logger(__file__)
@@ -25,6 +30,17 @@ def on_node_asset_change(sender, action, instance, reverse, pk_set, **kwargs):
     if action in refused:
         raise ValueError
 
+    if settings.NODE_ASSETS_AMOUNT_BATCH_RECOUNT:
+        # 批量模式：变化前记下资产所在的节点，事务提交后按前后差异增减一次
+        if not pk_set:
+            return
+        asset_ids = set(pk_set) if reverse else {instance.id}
+        if action in (PRE_ADD, PRE_REMOVE):
+            NodeAssetsAmountUtils.add_changed_assets(instance.org_id, asset_ids)
+        elif action in (POST_ADD, POST_REMOVE):
+            transaction.on_commit(NodeAssetsAmountUtils.update_changed_assets_nodes_amount)
+        return
+
     mapper = {
         PRE_ADD: add,
         POST_REMOVE: sub
@@ -47,6 +63,38 @@ def on_node_asset_change(sender, action, instance, reverse, pk_set, **kwargs):
 
 
 class NodeAssetsAmountUtils:
+    changed_assets_attr = 'node_assets_amount_changed_assets'
+
+    @classmethod
+    def add_changed_assets(cls, org_id, asset_ids):
+        """
+        同一个事务中的变化合并到一起，只记录资产第一次变化前所在的节点；
+        事务回滚时残留的记录就是回滚后的状态，在下次提交时一起处理
+        """
+        mapper = getattr(thread_local, cls.changed_assets_attr, None)
+        if mapper is None:
+            mapper = defaultdict(dict)
+            setattr(thread_local, cls.changed_assets_attr, mapper)
+        assets_old_node_keys = mapper[str(org_id)]
+        asset_ids = {str(i) for i in asset_ids} - assets_old_node_keys.keys()
+        if not asset_ids:
+            return
+        node_keys = get_assets_node_keys(asset_ids)
+        for asset_id in asset_ids:
+            assets_old_node_keys[asset_id] = node_keys.get(asset_id, set())
+
+    @classmethod
+    def update_changed_assets_nodes_amount(cls):
+        # 每次变化都注册回调，第一个回调执行后其他的都是空操作
+        mapper = getattr(thread_local, cls.changed_assets_attr, None)
+        if not mapper:
+            return
+        setattr(thread_local, cls.changed_assets_attr, None)
+        for org_id, assets_old_node_keys in mapper.items():
+            with tmp_to_org(org_id):
+                deltas = update_nodes_assets_amount_by_delta(assets_old_node_keys)
+            logger.debug(f'Update nodes assets amount: org={org_id} '
+                         f'assets={len(assets_old_node_keys)} nodes={len(deltas)}')
 
     @classmethod
     def _remove_ancestor_keys(cls, ancestor_key, tree_set):
@@ -58,9 +106,10 @@ class NodeAssetsAmountUtils:
 
     @classmethod
     def _is_asset_exists_in_node(cls, asset_pk, node_key):
-        exists = Asset.objects.filter(
-            Q(nodes__key__istartswith=f'{node_key}:') | Q(nodes__key=node_key)
-        ).filter(id=asset_pk).exists()
+        node_ids = Node.get_node_descendant_ids_by_key(node_key, with_self=True)
+        exists = Asset.nodes.through.objects.filter(
+            asset_id=asset_pk, node_id__in=node_ids
+        ).exists()
         return exists
 
     @classmethod
@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
 #
 import os
+import json
 import threading
+from collections import defaultdict
 
+from django.db import transaction
 from django.db.models.signals import (
     m2m_changed, post_save, post_delete
 )
@@ -12,8 +15,10 @@ from django.utils.functional import LazyObject
 from common.signals import django_ready
 from common.utils.connection import RedisPubSub
 from common.utils import get_logger
+from common.const.signals import POST_ADD, POST_REMOVE, POST_CLEAR
 from assets.models import Asset, Node
 from orgs.models import Organization
+from orgs.utils import tmp_to_org
 
 
 logger = get_logger(__file__)
@@ -21,6 +26,9 @@ logger = get_logger(__file__)
 # clear node assets mapping for memory
 # ------------------------------------
 
+MESSAGE_TYPE_EXPIRE = 'expire'
+MESSAGE_TYPE_DELTA = 'delta'
+
 
 def get_node_assets_mapping_for_memory_pub_sub():
     return RedisPubSub('fm.node_all_asset_ids_memory_mapping')
@@ -34,9 +42,7 @@ class NodeAssetsMappingForMemoryPubSub(LazyObject):
 node_assets_mapping_for_memory_pub_sub = NodeAssetsMappingForMemoryPubSub()
 
 
-def expire_node_assets_mapping_for_memory(org_id):
-    # 所有进程清除(自己的 memory 数据)
-    org_id = str(org_id)
+def expire_node_assets_mapping_cache(org_id):
     root_org_id = Organization.ROOT_ID
 
     # 当前进程清除(cache 数据)
@@ -47,30 +53,146 @@ def expire_node_assets_mapping_for_memory(org_id):
     Node.expire_node_all_asset_ids_mapping_from_cache(org_id)
     Node.expire_node_all_asset_ids_mapping_from_cache(root_org_id)
 
-    node_assets_mapping_for_memory_pub_sub.publish(org_id)
+
+def expire_node_assets_mapping_for_memory(org_id):
+    # 所有进程清除(自己的 memory 数据)
+    # 版本号递增但不记录增量，落后的映射无法再重放到新版本
+    org_id = str(org_id)
+    expire_node_assets_mapping_cache(org_id)
+    Node.incr_node_all_asset_ids_mapping_version(org_id)
+    Node.incr_node_all_asset_ids_mapping_version(Organization.ROOT_ID)
+
+    message = {'type': MESSAGE_TYPE_EXPIRE, 'org_id': org_id}
+    node_assets_mapping_for_memory_pub_sub.publish(json.dumps(message))
+
+
+def publish_node_assets_mapping_delta(org_id, delta):
+    """
+    所有进程在自己的 memory 数据上应用增量，而不是整个清除；
+    cache 中的数据不清除，读取时按版本号重放增量日志
+
+    全局组织的映射包含所有组织的节点(节点 key 全局唯一)，同样的增量也应用到全局组织上
+    """
+    if not any(delta.values()):
+        # 关系没有实际变化，例如去掉的资产仍在该节点的子树中
+        return
+    org_id = str(org_id)
+    version = Node.push_node_all_asset_ids_mapping_delta(org_id, delta)
+    root_version = None
+    if org_id != Organization.ROOT_ID:
+        root_version = Node.push_node_all_asset_ids_mapping_delta(Organization.ROOT_ID, delta)
+
+    message = {
+        'type': MESSAGE_TYPE_DELTA, 'org_id': org_id,
+        'version': version, 'root_version': root_version, 'delta': delta
+    }
+    node_assets_mapping_for_memory_pub_sub.publish(json.dumps(message))
+
+
+def on_commit_publish_node_assets_mapping_delta(org_id, delta):
+    transaction.on_commit(lambda: publish_node_assets_mapping_delta(org_id, delta))
+
+
+def compute_node_assets_relation_delta(action, node_keys, asset_ids):
+    """
+    计算节点与资产关系变化后，映射需要的增量，增量中已包含祖先节点
+    """
+    asset_ids = {str(i) for i in asset_ids}
+    delta = {}
+
+    if action == POST_ADD:
+        add = defaultdict(set)
+        for key in node_keys:
+            for ancestor_key in Node.get_node_ancestor_keys(key, with_self=True):
+                add[ancestor_key].update(asset_ids)
+        delta['add'] = {k: list(v) for k, v in add.items()}
+    elif action == POST_REMOVE:
+        # 资产现在所在的节点及祖先节点，这些节点下资产还在，不能去掉
+        asset_remain_keys_mapper = defaultdict(set)
+        pairs = Asset.nodes.through.objects.filter(
+            asset_id__in=asset_ids
+        ).values_list('asset_id', 'node__key')
+        for asset_id, key in pairs:
+            ancestor_keys = Node.get_node_ancestor_keys(key, with_self=True)
+            asset_remain_keys_mapper[str(asset_id)].update(ancestor_keys)
+
+        remove = defaultdict(set)
+        for key in node_keys:
+            for ancestor_key in Node.get_node_ancestor_keys(key, with_self=True):
+                for asset_id in asset_ids:
+                    if ancestor_key in asset_remain_keys_mapper[asset_id]:
+                        continue
+                    remove[ancestor_key].add(asset_id)
+        delta['remove'] = {k: list(v) for k, v in remove.items()}
+    return delta
 
 
 @receiver(post_save, sender=Node)
 def on_node_post_create(sender, instance, created, update_fields, **kwargs):
     if created:
-        need_expire = True
+        delta = {'create_keys': [instance.key]}
+        on_commit_publish_node_assets_mapping_delta(instance.org_id, delta)
     elif update_fields and 'key' in update_fields:
-        need_expire = True
-    else:
-        need_expire = False
-
-    if need_expire:
         expire_node_assets_mapping_for_memory(instance.org_id)
 
 
 @receiver(post_delete, sender=Node)
 def on_node_post_delete(sender, instance, **kwargs):
-    expire_node_assets_mapping_for_memory(instance.org_id)
+    # 有资产的节点不允许删除，所以只需要去掉节点
+    delta = {'delete_keys': [instance.key]}
+    on_commit_publish_node_assets_mapping_delta(instance.org_id, delta)
 
 
 @receiver(m2m_changed, sender=Asset.nodes.through)
-def on_node_asset_change(sender, instance, **kwargs):
-    expire_node_assets_mapping_for_memory(instance.org_id)
+def on_node_asset_change(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == POST_CLEAR:
+        # 没有 `pk_set`，无法计算增量
+        expire_node_assets_mapping_for_memory(instance.org_id)
+        return
+    if action not in (POST_ADD, POST_REMOVE):
+        return
+
+    if reverse:
+        node_keys = [instance.key]
+        asset_ids = pk_set
+    else:
+        asset_ids = [instance.id]
+        with tmp_to_org(instance.org_id):
+            node_keys = list(Node.objects.filter(id__in=pk_set).values_list('key', flat=True))
+
+    delta = compute_node_assets_relation_delta(action, node_keys, asset_ids)
+    on_commit_publish_node_assets_mapping_delta(instance.org_id, delta)
+
+
+def handle_node_assets_mapping_message(data):
+    root_org_id = Organization.ROOT_ID
+    try:
+        message = json.loads(data)
+    except ValueError:
+        # 兼容旧的消息，只有 org_id
+        message = {'type': MESSAGE_TYPE_EXPIRE, 'org_id': data}
+
+    org_id = message['org_id']
+    if message['type'] == MESSAGE_TYPE_DELTA:
+        patched = Node.patch_node_all_asset_ids_mapping_in_memory(
+            org_id, message['version'], message['delta']
+        )
+        logger.debug(
+            "Patch node assets id mapping in memory of org={}, version={}, patched={}, pid={}"
+            "".format(org_id, message['version'], patched, os.getpid())
+        )
+        root_version = message.get('root_version')
+        if root_version:
+            Node.patch_node_all_asset_ids_mapping_in_memory(root_org_id, root_version, message['delta'])
+        else:
+            Node.expire_node_all_asset_ids_mapping_from_memory(root_org_id)
+    else:
+        Node.expire_node_all_asset_ids_mapping_from_memory(org_id)
+        logger.debug(
+            "Expire node assets id mapping from memory of org={}, pid={}"
+            "".format(str(org_id), os.getpid())
+        )
+        Node.expire_node_all_asset_ids_mapping_from_memory(root_org_id)
 
 
 @receiver(django_ready)
@@ -84,14 +206,7 @@ def subscribe_node_assets_mapping_expire(sender, **kwargs):
                 for message in subscribe.listen():
                     if message["type"] != "message":
                         continue
-                    org_id = message['data'].decode()
-                    root_org_id = Organization.ROOT_ID
-                    Node.expire_node_all_asset_ids_mapping_from_memory(org_id)
-                    Node.expire_node_all_asset_ids_mapping_from_memory(root_org_id)
-                    logger.debug(
-                        "Expire node assets id mapping from memory of org={}, pid={}"
-                        "".format(str(org_id), os.getpid())
-                    )
+                    handle_node_assets_mapping_message(message['data'].decode())
             except Exception as e:
                 logger.exception(f'subscribe_node_assets_mapping_expire: {e}')
                 Node.expire_all_orgs_node_all_asset_ids_mapping_from_memory()
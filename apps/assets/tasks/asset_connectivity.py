@@ -2,13 +2,15 @@
 from itertools import groupby
 from collections import defaultdict
 from celery import shared_task
+from django.conf import settings
 from django.utils.translation import ugettext as _
 
 from common.utils import get_logger
 from orgs.utils import org_aware_func
 from ..models import Asset, Connectivity, AuthBook
 from . import const
-from .utils import clean_ansible_task_hosts, group_asset_by_platform
+from ..connectivity_prober import split_hosts_for_prober, probe_assets_connectivity
+from .utils import clean_ansible_task_hosts, group_asset_by_platform, merge_results_summary
 
 
 logger = get_logger(__file__)
@@ -33,6 +35,12 @@ def set_assets_accounts_connectivity(assets, results_summary):
     Asset.bulk_set_connectivity(asset_ids_ok, Connectivity.ok)
     Asset.bulk_set_connectivity(asset_ids_failed, Connectivity.failed)
 
+    # 只检测了端口的资产，管理用户的账号没有认证过，不更新
+    unverified = set(results_summary.get('unverified', []))
+    unverified_ids = {asset.id for asset in assets if asset.hostname in unverified}
+    asset_ids_ok -= unverified_ids
+    asset_ids_failed -= unverified_ids
+
     accounts_ok = AuthBook.objects.filter(asset_id__in=asset_ids_ok, systemuser__type='admin')
     accounts_failed = AuthBook.objects.filter(asset_id__in=asset_ids_failed, systemuser__type='admin')
 
@@ -44,6 +52,7 @@ def set_assets_accounts_connectivity(assets, results_summary):
 @org_aware_func("assets")
 def test_asset_connectivity_util(assets, task_name=None):
     from ops.utils import update_or_create_ansible_task
+    from ops.inventory import InventoryPrefetcher
 
     if task_name is None:
         task_name = _("Test assets connectivity")
@@ -51,6 +60,15 @@ def test_asset_connectivity_util(assets, task_name=None):
     hosts = clean_ansible_task_hosts(assets)
     if not hosts:
         return {}
+
+    results_summary = dict(
+        contacted=defaultdict(dict), dark=defaultdict(dict), success=True
+    )
+    if settings.CONNECTIVITY_PROBE_ENABLED:
+        prefetcher = InventoryPrefetcher(hosts)
+        probe_hosts, hosts = split_hosts_for_prober(prefetcher)
+        merge_results_summary(results_summary, probe_assets_connectivity(probe_hosts, prefetcher))
+
     platform_hosts_map = {}
     hosts_sorted = sorted(hosts, key=group_asset_by_platform)
     platform_hosts = groupby(hosts_sorted, key=group_asset_by_platform)
@@ -61,9 +79,6 @@ def test_asset_connectivity_util(assets, task_name=None):
         "unixlike": const.PING_UNIXLIKE_TASKS,
         "windows": const.PING_WINDOWS_TASKS
     }
-    results_summary = dict(
-        contacted=defaultdict(dict), dark=defaultdict(dict), success=True
-    )
     for platform, _hosts in platform_hosts_map.items():
         if not _hosts:
             continue
@@ -74,13 +89,7 @@ def test_asset_connectivity_util(assets, task_name=None):
             pattern='all', options=const.TASK_OPTIONS, run_as_admin=True,
         )
         raw, summary = task.run()
-        success = summary.get('success', False)
-        contacted = summary.get('contacted', {})
-        dark = summary.get('dark', {})
-
-        results_summary['success'] &= success
-        results_summary['contacted'].update(contacted)
-        results_summary['dark'].update(dark)
+        merge_results_summary(results_summary, summary)
         continue
     set_assets_accounts_connectivity(assets, results_summary)
     return results_summary
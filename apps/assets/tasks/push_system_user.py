@@ -32,49 +32,54 @@ def _dump_args(args: dict):
     return ' '.join([f'{k}={v}' for k, v in args.items() if v is not Empty])
 
 
-def get_push_unixlike_system_user_tasks(system_user, username=None):
-    comment = system_user.name
-
-    if username is None:
-        username = system_user.username
-
-    if system_user.username_same_with_user:
-        from users.models import User
-        user = User.objects.filter(username=username).only('name', 'username').first()
-        if user:
-            comment = f'{system_user.name}[{str(user)}]'
+# 每台主机要推送的用户放在主机变量 `jms_push_users` 中:
+#   [{'username': '', 'comment': '', 'has_password': bool, 'public_key': ''}, ...]
+# 密码单独放在 `jms_push_passwords` 中: {username: password}
+# ansible 会把循环的 item 放到每个结果里，所以 item 中不能有密码，使用密码的任务要设置 no_log
+# 一个平台的所有主机在同一个 play 中执行，不同主机的认证信息可以不同
+PUSH_USERS_VAR = 'jms_push_users'
+PUSH_PASSWORDS_VAR = 'jms_push_passwords'
+PUSH_USERS_LOOP = '{{ %s }}' % PUSH_USERS_VAR
+ITEM_USERNAME = '{{ item.username }}'
+ITEM_PASSWORD = '{{ %s[item.username] }}' % PUSH_PASSWORDS_VAR
+
+
+def _loop_tasks(tasks):
+    for task in tasks:
+        task.setdefault('loop', PUSH_USERS_LOOP)
+        task.setdefault('loop_control', {'label': ITEM_USERNAME})
+    return tasks
 
-    password = system_user.password
-    public_key = system_user.public_key
 
+def get_push_unixlike_system_user_tasks(system_user):
     groups = _split_by_comma(system_user.system_groups)
 
     if groups:
         groups = '"%s"' % ','.join(groups)
 
     add_user_args = {
-        'name': username,
+        'name': ITEM_USERNAME,
         'shell': system_user.shell or Empty,
         'state': 'present',
         'home': system_user.home or Empty,
         'expires': -1,
         'groups': groups or Empty,
-        'comment': comment
+        'comment': '"{{ item.comment }}"'
     }
 
     tasks = [
         {
-            'name': 'Add user {}'.format(username),
+            'name': 'Add user',
             'action': {
                 'module': 'user',
                 'args': _dump_args(add_user_args),
             }
         },
         {
-            'name': 'Add group {}'.format(username),
+            'name': 'Add group',
             'action': {
                 'module': 'group',
-                'args': 'name={} state=present'.format(username),
+                'args': 'name={} state=present'.format(ITEM_USERNAME),
             }
         }
     ]
@@ -84,7 +89,7 @@ def get_push_unixlike_system_user_tasks(system_user, username=None):
                 'name': 'Check home dir exists',
                 'action': {
                     'module': 'stat',
-                    'args': 'path=/home/{}'.format(username)
+                    'args': 'path=/home/{}'.format(ITEM_USERNAME)
                 },
                 'register': 'home_existed'
             },
@@ -92,32 +97,38 @@ def get_push_unixlike_system_user_tasks(system_user, username=None):
                 'name': "Set home dir permission",
                 'action': {
                     'module': 'file',
-                    'args': "path=/home/{0} owner={0} group={0} mode=700".format(username)
+                    'args': "path=/home/{0} owner={0} group={0} mode=700".format(
+                        '{{ item.item.username }}'
+                    )
                 },
-                'when': 'home_existed.stat.exists == true'
+                'loop': '{{ home_existed.results }}',
+                'loop_control': {'label': '{{ item.item.username }}'},
+                'when': 'item.stat.exists == true'
             }
         ])
-    if password:
-        tasks.append({
-            'name': 'Set {} password'.format(username),
+    tasks.extend([
+        {
+            'name': 'Set password',
             'action': {
                 'module': 'user',
                 'args': 'name={} shell={} state=present password={}'.format(
-                    username, system_user.shell,
-                    encrypt_password(password, salt="K3mIlKK"),
+                    ITEM_USERNAME, system_user.shell, ITEM_PASSWORD
                 ),
-            }
-        })
-    if public_key:
-        tasks.append({
-            'name': 'Set {} authorized key'.format(username),
+            },
+            'when': 'item.has_password',
+            'no_log': True
+        },
+        {
+            'name': 'Set authorized key',
             'action': {
                 'module': 'authorized_key',
                 'args': "user={} state=present key='{}'".format(
-                    username, public_key
+                    ITEM_USERNAME, '{{ item.public_key }}'
                 )
-            }
-        })
+            },
+            'when': 'item.public_key'
+        },
+    ])
     if system_user.sudo:
         sudo = system_user.sudo.replace('\r\n', '\n').replace('\r', '\n')
         sudo_list = sudo.split('\n')
@@ -126,106 +137,147 @@ def get_push_unixlike_system_user_tasks(system_user, username=None):
             sudo_tmp.append(s.strip(','))
         sudo = ','.join(sudo_tmp)
         tasks.append({
-            'name': 'Set {} sudo setting'.format(username),
+            'name': 'Set sudo setting',
             'action': {
                 'module': 'lineinfile',
                 'args': "dest=/etc/sudoers state=present regexp='^{0} ALL=' "
                         "line='{0} ALL=(ALL) NOPASSWD: {1}' "
-                        "validate='visudo -cf %s'".format(username, sudo)
+                        "validate='visudo -cf %s'".format(ITEM_USERNAME, sudo)
             }
         })
 
-    return tasks
+    return _loop_tasks(tasks)
 
 
-def get_push_windows_system_user_tasks(system_user, username=None):
-    if username is None:
-        username = system_user.username
-    password = system_user.password
+def get_push_windows_system_user_tasks(system_user):
     groups = {'Users', 'Remote Desktop Users'}
     if system_user.system_groups:
         groups.update(_split_by_comma(system_user.system_groups))
     groups = ','.join(groups)
 
-    tasks = []
-    if not password:
-        logger.error("Error: no password found")
-        return tasks
     task = {
-        'name': 'Add user {}'.format(username),
+        'name': 'Add user',
         'action': {
             'module': 'win_user',
-            'args': 'fullname={} '
-                    'name={} '
-                    'password={} '
+            'args': 'fullname={0} '
+                    'name={0} '
+                    'password={1} '
                     'state=present '
                     'update_password=always '
                     'password_expired=no '
                     'password_never_expires=yes '
-                    'groups="{}" '
+                    'groups="{2}" '
                     'groups_action=add '
-                    ''.format(username, username, password, groups),
-        }
+                    ''.format(ITEM_USERNAME, ITEM_PASSWORD, groups),
+        },
+        'when': 'item.has_password',
+        'no_log': True
     }
-    tasks.append(task)
-    return tasks
+    return _loop_tasks([task])
 
 
-def get_push_system_user_tasks(system_user, platform="unixlike", username=None):
+def get_push_system_user_tasks(system_user, platform="unixlike"):
     """
     :param system_user:
     :param platform:
-    :param username: 当动态时，近推送某个
-    :return:
+    :return: 推送的用户名和认证信息使用主机变量，所以同一平台的主机任务都相同
     """
     get_task_map = {
         "unixlike": get_push_unixlike_system_user_tasks,
         "windows": get_push_windows_system_user_tasks,
     }
     get_tasks = get_task_map.get(platform, get_push_unixlike_system_user_tasks)
-    if not system_user.username_same_with_user:
-        return get_tasks(system_user)
-    tasks = []
-    # 仅推送这个username
-    if username is not None:
-        tasks.extend(get_tasks(system_user, username))
-        return tasks
-    users = system_user.users.all().values_list('username', flat=True)
-    print(_("System user is dynamic: {}").format(list(users)))
-    for _username in users:
-        tasks.extend(get_tasks(system_user, _username))
-    return tasks
-
-
-@org_aware_func("system_user")
-def push_system_user_util(system_user, assets, task_name, username=None):
-    from ops.utils import update_or_create_ansible_task
-    assets = clean_ansible_task_hosts(assets, system_user=system_user)
-    if not assets:
-        return {}
+    return get_tasks(system_user)
 
-    assets_sorted = sorted(assets, key=group_asset_by_platform)
-    platform_hosts = groupby(assets_sorted, key=group_asset_by_platform)
-
-    def run_task(_tasks, _hosts):
-        if not _tasks:
-            return
-        task, created = update_or_create_ansible_task(
-            task_name=task_name, hosts=_hosts, tasks=_tasks, pattern='all',
-            options=const.TASK_OPTIONS, run_as_admin=True,
-        )
-        task.run()
 
+def get_push_usernames(system_user, username=None):
     if system_user.username_same_with_user:
         if username is None:
             # 动态系统用户，但是没有指定 username
             usernames = list(system_user.users.all().values_list('username', flat=True).distinct())
+            print(_("System user is dynamic: {}").format(usernames))
         else:
             usernames = [username]
     else:
         # 非动态系统用户指定 username 无效
         assert username is None, 'Only Dynamic user can assign `username`'
         usernames = [system_user.username]
+    return usernames
+
+
+def get_push_comments(system_user, usernames):
+    if not system_user.username_same_with_user:
+        return {}
+    from users.models import User
+    users = User.objects.filter(username__in=usernames).only('name', 'username')
+    return {user.username: f'{system_user.name}[{str(user)}]' for user in users}
+
+
+def get_push_system_user_host_vars(system_user, platform, assets, usernames):
+    """
+    生成每台主机要推送的用户和认证信息，资产有特殊认证(AuthBook)时使用特殊认证
+
+    :return: {asset_id: {'jms_push_users': [...], 'jms_push_passwords': {...}}}
+    """
+    comments = get_push_comments(system_user, usernames)
+    hashed_passwords = {}
+
+    def make_item(_username, password, public_key):
+        if password and platform != 'windows':
+            if password not in hashed_passwords:
+                hashed_passwords[password] = encrypt_password(password, salt="K3mIlKK")
+            password = hashed_passwords[password]
+        return {
+            'username': _username,
+            'comment': comments.get(_username, system_user.name),
+            'has_password': bool(password),
+            'public_key': public_key or '',
+        }, password or ''
+
+    default_items = {
+        _username: make_item(_username, system_user.password, system_user.public_key)
+        for _username in usernames
+    }
+    asset_items = {asset.id: dict(default_items) for asset in assets}
+
+    auth_books = AuthBook.objects.filter(asset_id__in=asset_items.keys()).filter(
+        Q(username__in=usernames) | Q(systemuser__username__in=usernames)
+    ).prefetch_related('systemuser')
+
+    for auth_book in auth_books:
+        auth_book.load_auth()
+        password = auth_book.password or system_user.password
+        if auth_book.public_key or auth_book.private_key:
+            public_key = auth_book.public_key
+        else:
+            public_key = system_user.public_key
+        item = make_item(auth_book.username, password, public_key)
+        asset_items[auth_book.asset_id][auth_book.username] = item
+
+    host_vars = {}
+    for asset_id, items in asset_items.items():
+        passwords = {_username: password for _username, (item, password) in items.items()}
+        if platform == 'windows' and not all(passwords.values()):
+            logger.error(f'Push windows system user need password: asset={asset_id}')
+        host_vars[asset_id] = {
+            PUSH_USERS_VAR: [item for item, password in items.values()],
+            PUSH_PASSWORDS_VAR: passwords,
+        }
+    return host_vars
+
+
+@org_aware_func("system_user")
+def push_system_user_util(system_user, assets, task_name, username=None):
+    from ops.utils import update_or_create_ansible_task
+    assets = clean_ansible_task_hosts(assets, system_user=system_user)
+    if not assets:
+        return {}
+
+    assets_sorted = sorted(assets, key=group_asset_by_platform)
+    platform_hosts = groupby(assets_sorted, key=group_asset_by_platform)
+    usernames = get_push_usernames(system_user, username=username)
+    if not usernames:
+        return {}
 
     for platform, _assets in platform_hosts:
         _assets = list(_assets)
@@ -234,36 +286,13 @@ def push_system_user_util(system_user, assets, task_name, username=None):
         print(_("Start push system user for platform: [{}]").format(platform))
         print(_("Hosts count: {}").format(len(_assets)))
 
-        id_asset_map = {_asset.id: _asset for _asset in _assets}
-        asset_ids = id_asset_map.keys()
-        no_special_auth = []
-        special_auth_set = set()
-
-        auth_books = AuthBook.objects.filter(asset_id__in=asset_ids).filter(
-            Q(username__in=usernames) | Q(systemuser__username__in=usernames)
-        ).prefetch_related('systemuser')
-
-        for auth_book in auth_books:
-            auth_book.load_auth()
-            special_auth_set.add((auth_book.username, auth_book.asset_id))
-
-        for _username in usernames:
-            no_special_assets = []
-            for asset_id in asset_ids:
-                if (_username, asset_id) not in special_auth_set:
-                    no_special_assets.append(id_asset_map[asset_id])
-            if no_special_assets:
-                no_special_auth.append((_username, no_special_assets))
-
-        for _username, no_special_assets in no_special_auth:
-            tasks = get_push_system_user_tasks(system_user, platform, username=_username)
-            run_task(tasks, no_special_assets)
-
-        for auth_book in auth_books:
-            system_user._merge_auth(auth_book)
-            tasks = get_push_system_user_tasks(system_user, platform, username=auth_book.username)
-            asset = id_asset_map[auth_book.asset_id]
-            run_task(tasks, [asset])
+        tasks = get_push_system_user_tasks(system_user, platform)
+        host_vars = get_push_system_user_host_vars(system_user, platform, _assets, usernames)
+        task, created = update_or_create_ansible_task(
+            task_name=task_name, hosts=_assets, tasks=tasks, pattern='all',
+            options=const.TASK_OPTIONS, run_as_admin=True,
+        )
+        task.run(host_vars=host_vars)
 
 
 @shared_task(queue="ansible")
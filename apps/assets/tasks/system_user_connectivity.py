@@ -3,6 +3,7 @@ from itertools import groupby
 from collections import defaultdict
 
 from celery import shared_task
+from django.conf import settings
 from django.utils.translation import ugettext as _
 
 from assets.models import Asset
@@ -10,8 +11,9 @@ from common.utils import get_logger
 from orgs.utils import tmp_to_org, org_aware_func
 from ..models import SystemUser, Connectivity, AuthBook
 from . import const
+from ..connectivity_prober import split_hosts_for_prober, probe_assets_connectivity
 from .utils import (
-    clean_ansible_task_hosts, group_asset_by_platform
+    clean_ansible_task_hosts, group_asset_by_platform, merge_results_summary
 )
 
 logger = get_logger(__name__)
@@ -27,8 +29,12 @@ def set_assets_accounts_connectivity(system_user, assets, results_summary):
     asset_ids_failed = set()
 
     asset_hostnames_ok = results_summary.get('contacted', {}).keys()
+    # 只检测了端口的资产，系统用户的账号没有认证过，不更新
+    unverified = set(results_summary.get('unverified', []))
 
     for asset in assets:
+        if asset.hostname in unverified:
+            continue
         if asset.hostname in asset_hostnames_ok:
             asset_ids_ok.add(asset.id)
         else:
@@ -51,6 +57,7 @@ def test_system_user_connectivity_util(system_user, assets, task_name):
     :return:
     """
     from ops.utils import update_or_create_ansible_task
+    from ops.inventory import InventoryPrefetcher
 
     if system_user.username_same_with_user:
         logger.error(_("Dynamic system user not support test"))
@@ -62,6 +69,17 @@ def test_system_user_connectivity_util(system_user, assets, task_name):
     hosts = clean_ansible_task_hosts(assets)
     if not hosts:
         return {}
+
+    results_summary = dict(
+        contacted=defaultdict(dict), dark=defaultdict(dict), success=True
+    )
+    checked_hosts = hosts
+    if settings.CONNECTIVITY_PROBE_ENABLED and system_user.protocol == SystemUser.Protocol.ssh:
+        prefetcher = InventoryPrefetcher(hosts, system_user=system_user)
+        probe_hosts, hosts = split_hosts_for_prober(prefetcher)
+        summary = probe_assets_connectivity(probe_hosts, prefetcher, system_user=system_user)
+        merge_results_summary(results_summary, summary)
+
     platform_hosts_map = {}
     hosts_sorted = sorted(hosts, key=group_asset_by_platform)
     platform_hosts = groupby(hosts_sorted, key=group_asset_by_platform)
@@ -73,10 +91,6 @@ def test_system_user_connectivity_util(system_user, assets, task_name):
         "windows": const.PING_WINDOWS_TASKS
     }
 
-    results_summary = dict(
-        contacted=defaultdict(dict), dark=defaultdict(dict), success=True
-    )
-
     def run_task(_tasks, _hosts, _username):
         old_name = "{}".format(system_user)
         new_name = "{}({})".format(system_user.name, _username)
@@ -87,13 +101,7 @@ def test_system_user_connectivity_util(system_user, assets, task_name):
             run_as=_username, system_user=system_user
         )
         raw, summary = _task.run()
-        success = summary.get('success', False)
-        contacted = summary.get('contacted', {})
-        dark = summary.get('dark', {})
-
-        results_summary['success'] &= success
-        results_summary['contacted'].update(contacted)
-        results_summary['dark'].update(dark)
+        merge_results_summary(results_summary, summary)
 
     for platform, _hosts in platform_hosts_map.items():
         if not _hosts:
@@ -108,7 +116,7 @@ def test_system_user_connectivity_util(system_user, assets, task_name):
         logger.debug("System user not has special auth")
         run_task(tasks, _hosts, system_user.username)
 
-    set_assets_accounts_connectivity(system_user, hosts, results_summary)
+    set_assets_accounts_connectivity(system_user, checked_hosts, results_summary)
     return results_summary
 
 
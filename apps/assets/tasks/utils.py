@@ -8,7 +8,7 @@ from common.utils import get_logger
 logger = get_logger(__file__)
 __all__ = [
     'check_asset_can_run_ansible', 'clean_ansible_task_hosts',
-    'group_asset_by_platform',
+    'group_asset_by_platform', 'merge_results_summary',
 ]
 
 
@@ -63,3 +63,11 @@ def group_asset_by_platform(asset):
         return 'windows'
     else:
         return 'other'
+
+
+def merge_results_summary(results_summary, summary):
+    results_summary['success'] &= summary.get('success', False)
+    results_summary['contacted'].update(summary.get('contacted', {}))
+    results_summary['dark'].update(summary.get('dark', {}))
+    if summary.get('unverified'):
+        results_summary.setdefault('unverified', []).extend(summary['unverified'])
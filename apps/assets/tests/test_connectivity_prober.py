@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+#
+import asyncio
+import socket
+import threading
+import unittest
+
+from assets.connectivity_prober import AsyncConnectivityProber, ProbeTarget
+
+
+class StubServers:
+    """
+    在后台线程的事件循环中运行 TCP 桩服务，连接后发送固定的 banner
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.servers = []
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        for server in self.servers:
+            server.close()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def add(self, banner: bytes):
+        async def handle(reader, writer):
+            writer.write(banner)
+            await writer.drain()
+            writer.close()
+
+        async def serve():
+            return await asyncio.start_server(handle, '127.0.0.1', 0)
+
+        server = asyncio.run_coroutine_threadsafe(serve(), self.loop).result()
+        self.servers.append(server)
+        return server.sockets[0].getsockname()[1]
+
+
+def get_closed_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class TestAsyncConnectivityProber(unittest.TestCase):
+    def setUp(self):
+        self.servers = StubServers()
+        self.servers.start()
+        self.ssh_port = self.servers.add(b'SSH-2.0-OpenSSH_stub\r\n')
+        self.http_port = self.servers.add(b'HTTP/1.1 400 Bad Request\r\n')
+        self.closed_port = get_closed_port()
+        self.prober = AsyncConnectivityProber(concurrency=10, timeout=2, auth_workers=1)
+
+    def tearDown(self):
+        self.servers.stop()
+
+    def test_probe(self):
+        targets = [
+            ProbeTarget('open', '127.0.0.1', self.ssh_port, 'ssh', None),
+            ProbeTarget('closed', '127.0.0.1', self.closed_port, 'ssh', None),
+            ProbeTarget('bad_banner', '127.0.0.1', self.http_port, 'ssh', None),
+            # 非 ssh 协议只检查端口
+            ProbeTarget('rdp', '127.0.0.1', self.http_port, 'rdp', None),
+        ]
+        results = self.prober.probe(targets)
+        self.assertEqual(results['open'], (True, ''))
+        self.assertFalse(results['closed'][0])
+        self.assertEqual(results['bad_banner'], (False, f'ssh/{self.http_port}: Invalid ssh banner'))
+        self.assertEqual(results['rdp'], (True, ''))
+
+    def test_probe_all_ports_of_host(self):
+        targets = [
+            ProbeTarget('host', '127.0.0.1', self.ssh_port, 'ssh', None),
+            ProbeTarget('host', '127.0.0.1', self.closed_port, 'rdp', None),
+        ]
+        ok, error = self.prober.probe(targets)['host']
+        self.assertFalse(ok)
+        self.assertTrue(error.startswith(f'rdp/{self.closed_port}: '))
+
+    def test_probe_empty(self):
+        self.assertEqual(self.prober.probe([]), {})
+
+    def test_probe_ssh_auth(self):
+        auth = {'username': 'root', 'password': 'password'}
+        targets = [
+            ProbeTarget('auth', '127.0.0.1', self.ssh_port, 'ssh', auth),
+            ProbeTarget('closed', '127.0.0.1', self.closed_port, 'ssh', auth),
+            ProbeTarget('no_auth', '127.0.0.1', self.ssh_port, 'ssh', None),
+        ]
+        authed = []
+
+        def ssh_auth(target):
+            authed.append(target.name)
+            return False, 'Authentication failed'
+
+        self.prober.ssh_auth = ssh_auth
+        results = self.prober.probe(targets)
+        # 只有端口可达且有认证信息的 ssh 才认证
+        self.assertEqual(authed, ['auth'])
+        self.assertEqual(results['auth'], (False, f'ssh/{self.ssh_port}: Authentication failed'))
+        self.assertFalse(results['closed'][0])
+        self.assertEqual(results['no_auth'], (True, ''))
+
+    def test_ssh_auth_against_stub(self):
+        # 桩服务发送 banner 后就关闭连接，paramiko 认证应该失败而不是抛出异常
+        auth = {'username': 'root', 'password': 'password'}
+        target = ProbeTarget('auth', '127.0.0.1', self.ssh_port, 'ssh', auth)
+        ok, error = self.prober.ssh_auth(target)
+        self.assertFalse(ok)
+        self.assertTrue(error)
+
+
+if __name__ == '__main__':
+    unittest.main()
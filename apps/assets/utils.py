@@ -1,6 +1,8 @@
 # ~*~ coding: utf-8 ~*~
 #
 from collections import defaultdict
+from django.db.models import Count, F
+
 from common.utils import get_logger, dict_get_any, is_uuid, get_object_or_none, timeit
 from common.http import is_true
 from common.struct import Stack
@@ -13,35 +15,109 @@ from .models import Node, Asset
 logger = get_logger(__file__)
 
 
-@NodeTreeUpdateLock()
-@ensure_in_real_or_default_org
-def check_node_assets_amount():
-    logger.info(f'Check node assets amount {current_org}')
-    nodes = list(Node.objects.all().only('id', 'key', 'assets_amount'))
-    nodeid_assetid_pairs = list(Asset.nodes.through.objects.all().values_list('node_id', 'asset_id'))
+def compute_nodes_assets_amount(node_ids, chunk_size=1000) -> dict:
+    """
+    用一个聚合查询（经过节点闭包表）计算节点及其后代节点下的资产数量
 
-    nodekey_assetids_mapper = defaultdict(set)
-    nodeid_nodekey_mapper = {}
-    for node in nodes:
-        nodeid_nodekey_mapper[node.id] = node.key
+    :return: {node_id: assets_amount}，没有资产的节点不在结果里
+    """
+    node_ids = list(node_ids)
+    amounts = {}
+    ancestor_field = 'node__ancestor_rels__ancestor_id'
+    for i in range(0, len(node_ids), chunk_size):
+        chunk = node_ids[i:i + chunk_size]
+        rows = Asset.nodes.through.objects.filter(
+            **{f'{ancestor_field}__in': chunk}
+        ).order_by().values(ancestor_field).annotate(
+            amount=Count('asset_id', distinct=True)
+        ).values_list(ancestor_field, 'amount')
+        amounts.update(rows)
+    return amounts
 
-    for nodeid, assetid in nodeid_assetid_pairs:
-        if nodeid not in nodeid_nodekey_mapper:
-            continue
-        nodekey = nodeid_nodekey_mapper[nodeid]
-        nodekey_assetids_mapper[nodekey].add(assetid)
 
-    util = NodeAssetsUtil(nodes, nodekey_assetids_mapper)
-    util.generate()
+@NodeTreeUpdateLock()
+@ensure_in_real_or_default_org
+def recount_nodes_assets_amount(node_ids, log_changed=False):
+    """
+    批量重新计算节点的资产数量，只更新变化的节点；需要聚合查询，只在定期检查时使用，
+    资产关系变化时使用 `update_nodes_assets_amount_by_delta`
+
+    :param node_ids: 要计算的节点
+    :param log_changed: 是否记录数量不一致的节点
+    """
+    nodes = Node.objects.filter(id__in=set(node_ids)).only('id', 'key', 'assets_amount')
+    nodes = list(nodes)
+    amounts = compute_nodes_assets_amount([node.id for node in nodes])
 
     to_updates = []
     for node in nodes:
-        assets_amount = util.get_assets_amount(node.key)
-        if node.assets_amount != assets_amount:
+        assets_amount = amounts.get(node.id, 0)
+        if node.assets_amount == assets_amount:
+            continue
+        if log_changed:
             logger.error(f'Node[{node.key}] assets amount error {node.assets_amount} != {assets_amount}')
-            node.assets_amount = assets_amount
-            to_updates.append(node)
+        node.assets_amount = assets_amount
+        to_updates.append(node)
     Node.objects.bulk_update(to_updates, fields=('assets_amount',))
+    return to_updates
+
+
+def get_assets_node_keys(asset_ids) -> dict:
+    """
+    :return: {asset_id(str): {资产直接所在节点的 key}}
+    """
+    mapper = defaultdict(set)
+    pairs = Asset.nodes.through.objects.filter(
+        asset_id__in=asset_ids
+    ).values_list('asset_id', 'node__key')
+    for asset_id, node_key in pairs:
+        mapper[str(asset_id)].add(node_key)
+    return mapper
+
+
+def _get_subtree_keys(node_keys) -> set:
+    # 资产在这些节点的子树中，即这些节点及其祖先节点
+    keys = set()
+    for key in node_keys:
+        keys.update(Node.get_node_ancestor_keys(key, with_self=True))
+    return keys
+
+
+@NodeTreeUpdateLock()
+@ensure_in_real_or_default_org
+def update_nodes_assets_amount_by_delta(assets_old_node_keys):
+    """
+    比较资产变化前后所在的节点，只有资产进入或离开了某个节点的子树，
+    才增减这个节点的资产数量，不做聚合查询；并发导致的偏差由定期检查修正
+
+    :param assets_old_node_keys: {asset_id(str): {变化前资产直接所在节点的 key}}
+    :return: {node_key: delta}
+    """
+    assets_new_node_keys = get_assets_node_keys(assets_old_node_keys.keys())
+    deltas = defaultdict(int)
+    for asset_id, old_node_keys in assets_old_node_keys.items():
+        old_keys = _get_subtree_keys(old_node_keys)
+        new_keys = _get_subtree_keys(assets_new_node_keys.get(asset_id, ()))
+        for key in new_keys - old_keys:
+            deltas[key] += 1
+        for key in old_keys - new_keys:
+            deltas[key] -= 1
+
+    delta_keys = defaultdict(list)
+    for key, delta in deltas.items():
+        if delta:
+            delta_keys[delta].append(key)
+    for delta, keys in delta_keys.items():
+        Node.objects.filter(key__in=keys).update(assets_amount=F('assets_amount') + delta)
+    return deltas
+
+
+@NodeTreeUpdateLock()
+@ensure_in_real_or_default_org
+def check_node_assets_amount():
+    logger.info(f'Check node assets amount {current_org}')
+    node_ids = Node.objects.all().values_list('id', flat=True)
+    recount_nodes_assets_amount(node_ids, log_changed=True)
 
 
 def is_query_node_all_assets(request):
@@ -314,7 +314,7 @@ class UserConnectionTokenViewSet(
         from users.models import User
         from assets.models import SystemUser, Asset
         from applications.models import Application
-        from perms.utils.asset.permission import validate_permission as asset_validate_permission
+        from perms.utils.asset.permission import validate_permission_with_cache as asset_validate_permission
         from perms.utils.application.permission import validate_permission as app_validate_permission
 
         key = self.CACHE_KEY_PREFIX.format(token)
@@ -340,9 +340,23 @@ class Config(dict):
         'WINDOWS_SKIP_ALL_MANUAL_PASSWORD': False,
         'CONNECTION_TOKEN_ENABLED': False,
 
+        'NODE_ASSETS_AMOUNT_BATCH_RECOUNT': True,
         'PERM_SINGLE_ASSET_TO_UNGROUP_NODE': False,
+        'PERM_TREE_REBUILD_DELTA': True,
+        'PERM_BOUNDARY_CHECK_INTERVAL': 60,
+        'PERM_ASSET_SYSTEM_USERS_MAP_MAX_ASSETS': 20000,
+        'PERM_TREE_BATCH_REBUILD_THRESHOLD': 50,
+        'PERM_DECISION_CACHE_TTL': 60 * 10,
+        'PERM_ACCESS_REPORT_KEEP_DAYS': 7,
         'WINDOWS_SSH_DEFAULT_SHELL': 'cmd',
         'PERIOD_TASK_ENABLED': True,
+        'CONNECTIVITY_PROBE_ENABLED': True,
+        'CONNECTIVITY_PROBE_SSH_AUTH': True,
+        'CONNECTIVITY_PROBE_CONCURRENCY': 200,
+        'CONNECTIVITY_PROBE_AUTH_WORKERS': 20,
+        'CONNECTIVITY_PROBE_TIMEOUT': 10,
+        'ANSIBLE_SHARD_SIZE': 500,
+        'ANSIBLE_SHARD_TIMEOUT': 3600,
 
         'TICKETS_ENABLED': True,
         'FORGOT_PASSWORD_URL': '',
@@ -75,14 +75,32 @@ TERMINAL_TELNET_REGEX = CONFIG.TERMINAL_TELNET_REGEX
 # Asset user auth external backend, default AuthBook backend
 BACKEND_ASSET_USER_AUTH_VAULT = False
 
+NODE_ASSETS_AMOUNT_BATCH_RECOUNT = CONFIG.NODE_ASSETS_AMOUNT_BATCH_RECOUNT
 PERM_SINGLE_ASSET_TO_UNGROUP_NODE = CONFIG.PERM_SINGLE_ASSET_TO_UNGROUP_NODE
 PERM_EXPIRED_CHECK_PERIODIC = CONFIG.PERM_EXPIRED_CHECK_PERIODIC
+PERM_TREE_REBUILD_DELTA = CONFIG.PERM_TREE_REBUILD_DELTA
+PERM_BOUNDARY_CHECK_INTERVAL = CONFIG.PERM_BOUNDARY_CHECK_INTERVAL
+PERM_ASSET_SYSTEM_USERS_MAP_MAX_ASSETS = CONFIG.PERM_ASSET_SYSTEM_USERS_MAP_MAX_ASSETS
+PERM_TREE_BATCH_REBUILD_THRESHOLD = CONFIG.PERM_TREE_BATCH_REBUILD_THRESHOLD
+PERM_DECISION_CACHE_TTL = CONFIG.PERM_DECISION_CACHE_TTL
+PERM_ACCESS_REPORT_KEEP_DAYS = CONFIG.PERM_ACCESS_REPORT_KEEP_DAYS
 WINDOWS_SSH_DEFAULT_SHELL = CONFIG.WINDOWS_SSH_DEFAULT_SHELL
 FLOWER_URL = CONFIG.FLOWER_URL
 
 # Enable internal period task
 PERIOD_TASK_ENABLED = CONFIG.PERIOD_TASK_ENABLED
 
+# 资产可连接性检测
+CONNECTIVITY_PROBE_ENABLED = CONFIG.CONNECTIVITY_PROBE_ENABLED
+CONNECTIVITY_PROBE_SSH_AUTH = CONFIG.CONNECTIVITY_PROBE_SSH_AUTH
+CONNECTIVITY_PROBE_CONCURRENCY = CONFIG.CONNECTIVITY_PROBE_CONCURRENCY
+CONNECTIVITY_PROBE_AUTH_WORKERS = CONFIG.CONNECTIVITY_PROBE_AUTH_WORKERS
+CONNECTIVITY_PROBE_TIMEOUT = CONFIG.CONNECTIVITY_PROBE_TIMEOUT
+
+# 主机很多的 ansible 执行按主机分片到多个 worker, 0 不分片
+ANSIBLE_SHARD_SIZE = CONFIG.ANSIBLE_SHARD_SIZE
+ANSIBLE_SHARD_TIMEOUT = CONFIG.ANSIBLE_SHARD_TIMEOUT
+
 # only allow single machine login with the same account
 USER_LOGIN_SINGLE_MACHINE_ENABLED = CONFIG.USER_LOGIN_SINGLE_MACHINE_ENABLED
 
@@ -100,12 +100,11 @@ class BaseInventory(InventoryManager):
         group_list: [
           {"name: "", children: [""]},
         ]
-        :param host_list:
+        :param host_list: 也可以是生成器，解析时只遍历一次
         :param group_list
         """
-        self.host_list = host_list or []
+        self.host_list = host_list if host_list is not None else []
         self.group_list = group_list or []
-        assert isinstance(host_list, list)
         self.loader = self.loader_class()
         self.variable_manager = self.variable_manager_class()
         super().__init__(self.loader)
@@ -59,5 +59,15 @@ class TestJMSInventory(unittest.TestCase):
         print(group.hosts)
 
 
+class TestGeneratorInventory(unittest.TestCase):
+    def test_hosts(self):
+        host_list = (
+            {"hostname": "testserver{}".format(i), "ip": "10.1.1.{}".format(i), "port": 22}
+            for i in range(3)
+        )
+        inventory = BaseInventory(host_list=host_list)
+        self.assertEqual(len(inventory.get_group('all').hosts), 3)
+
+
 if __name__ == '__main__':
     unittest.main()
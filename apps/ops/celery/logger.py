@@ -1,14 +1,18 @@
 from logging import StreamHandler
-from threading import get_ident
+from threading import get_ident, local
 
+import redis
 from django.conf import settings
 from celery import current_task
 from celery.signals import task_prerun, task_postrun
 from kombu import Connection, Exchange, Queue, Producer
 from kombu.mixins import ConsumerMixin
 
+from common.utils import get_logger
 from .utils import get_celery_task_log_path
 
+logger = get_logger(__file__)
+
 routing_key = 'celery_log'
 celery_log_exchange = Exchange('celery_log_exchange', type='direct')
 celery_log_queue = [Queue('celery_log', celery_log_exchange, routing_key=routing_key)]
@@ -80,6 +84,58 @@ class CeleryLoggerProducer:
         return self.publish(payload)
 
 
+class CeleryTaskLogStream:
+    """
+    任务日志在写文件的同时追加到 redis stream，websocket 阻塞读取 stream，不需要轮询日志文件
+
+    每条记录带上写入后日志文件的位置 `offset`，读取端先读日志文件补齐历史，
+    再跳过位置不超过已读长度的记录
+    """
+    key_prefix = 'ops.task_log.stream.'
+    maxlen = 10000
+    ttl = 3600 * 24
+
+    FIELD_MSG = 'msg'
+    FIELD_OFFSET = 'offset'
+    FIELD_END = 'end'
+
+    def __init__(self):
+        self.client = redis.Redis.from_url(settings.CHANNEL_REDIS)
+        self.local = local()
+
+    @classmethod
+    def get_key(cls, task_id):
+        return cls.key_prefix + task_id
+
+    def add(self, task_id, fields, expire=False):
+        key = self.get_key(task_id)
+        try:
+            with self.client.pipeline(transaction=False) as p:
+                p.xadd(key, fields, maxlen=self.maxlen, approximate=True)
+                if expire:
+                    p.expire(key, self.ttl)
+                p.execute()
+        except redis.RedisError as e:
+            # 日志流只用于实时查看，失败时仍然可以从日志文件读取；
+            # 任务中记录的错误会再次写入日志流，失败时不再记录，避免递归
+            if getattr(self.local, 'logging_error', False):
+                return
+            self.local.logging_error = True
+            try:
+                logger.error(f'Add task log stream failed: task={task_id} {e}')
+            finally:
+                self.local.logging_error = False
+
+    def start(self, task_id):
+        self.add(task_id, {self.FIELD_OFFSET: 0}, expire=True)
+
+    def log(self, task_id, msg, offset):
+        self.add(task_id, {self.FIELD_MSG: msg, self.FIELD_OFFSET: offset})
+
+    def end(self, task_id, offset):
+        self.add(task_id, {self.FIELD_END: 1, self.FIELD_OFFSET: offset}, expire=True)
+
+
 class CeleryTaskLoggerHandler(StreamHandler):
     terminator = '\r\n'
 
@@ -166,41 +222,53 @@ class CeleryTaskMQLoggerHandler(CeleryTaskLoggerHandler):
 class CeleryTaskFileHandler(CeleryTaskLoggerHandler):
     def __init__(self, *args, **kwargs):
         self.f = None
+        self.task_id = None
+        self.stream = CeleryTaskLogStream()
         super().__init__(*args, **kwargs)
 
     def emit(self, record):
         msg = self.format(record)
         if not self.f or self.f.closed:
             return
+        msg += self.terminator
         self.f.write(msg)
-        self.f.write(self.terminator)
         self.flush()
+        self.stream.log(self.task_id, msg, self.f.tell())
 
     def flush(self):
         self.f and self.f.flush()
 
     def handle_task_start(self, task_id):
         log_path = get_celery_task_log_path(task_id)
+        # 先创建日志流再创建文件，读取端看到文件时日志流一定存在
+        self.stream.start(task_id)
+        self.task_id = task_id
         self.f = open(log_path, 'a')
 
     def handle_task_end(self, task_id):
-        self.f and self.f.close()
+        if self.f and not self.f.closed:
+            self.stream.end(task_id, self.f.tell())
+            self.f.close()
 
 
 class CeleryThreadTaskFileHandler(CeleryThreadingLoggerHandler):
     def __init__(self, *args, **kwargs):
         self.thread_id_fd_mapper = {}
         self.task_id_thread_id_mapper = {}
+        self.thread_id_task_id_mapper = {}
+        self.stream = CeleryTaskLogStream()
         super().__init__(*args, **kwargs)
 
     def write_thread_task_log(self, thread_id, record):
         f = self.thread_id_fd_mapper.get(thread_id, None)
         if not f:
             raise ValueError('Not found thread task file')
-        msg = self.format(record)
+        msg = self.format(record) + self.terminator
         f.write(msg)
-        f.write(self.terminator)
         f.flush()
+        task_id = self.thread_id_task_id_mapper.get(thread_id)
+        if task_id:
+            self.stream.log(task_id, msg, f.tell())
 
     def flush(self):
         for f in self.thread_id_fd_mapper.values():
@@ -210,6 +278,9 @@ class CeleryThreadTaskFileHandler(CeleryThreadingLoggerHandler):
         log_path = get_celery_task_log_path(task_id)
         thread_id = self.get_current_thread_id()
         self.task_id_thread_id_mapper[task_id] = thread_id
+        self.thread_id_task_id_mapper[thread_id] = task_id
+        # 先创建日志流再创建文件，读取端看到文件时日志流一定存在
+        self.stream.start(task_id)
         f = open(log_path, 'a')
         self.thread_id_fd_mapper[thread_id] = f
 
@@ -217,5 +288,7 @@ class CeleryThreadTaskFileHandler(CeleryThreadingLoggerHandler):
         ident_id = self.task_id_thread_id_mapper.get(task_id, '')
         f = self.thread_id_fd_mapper.pop(ident_id, None)
         if f and not f.closed:
+            self.stream.end(task_id, f.tell())
             f.close()
         self.task_id_thread_id_mapper.pop(task_id, None)
+        self.thread_id_task_id_mapper.pop(ident_id, None)
@@ -1,23 +1,126 @@
 # -*- coding: utf-8 -*-
 #
+import random
+import time
+from collections import defaultdict
 
 from django.conf import settings
+from django.db.models import QuerySet
 from .ansible.inventory import BaseInventory
 
 from common.utils import get_logger
 
 __all__ = [
-    'JMSInventory', 'JMSCustomInventory',
+    'JMSInventory', 'JMSCustomInventory', 'InventoryPrefetcher',
 ]
 
 
 logger = get_logger(__file__)
 
 
+class InventoryPrefetcher:
+    """
+    生成 inventory 前批量查询资产和它的平台、网域、网关、管理用户以及特殊认证(AuthBook)，
+    加密字段在这几次查询中一起解密，避免每台资产再单独查询
+
+    相同的私钥只解析和写文件一次
+    """
+
+    def __init__(self, assets, system_user=None):
+        from assets.models import Asset, Gateway, SystemUser, AuthBook
+        from orgs.utils import tmp_to_root_org
+
+        if isinstance(assets, QuerySet):
+            asset_ids = list(assets.values_list('id', flat=True))
+        else:
+            asset_ids = [asset.id for asset in assets]
+        self.system_user = system_user
+        self._key_files = {}
+
+        # 资产已经在调用方按组织过滤，这里按 id 查询
+        with tmp_to_root_org():
+            assets = Asset.objects.filter(id__in=asset_ids)\
+                .select_related('platform', 'domain')\
+                .prefetch_related('labels')
+            id_asset_map = {asset.id: asset for asset in assets}
+            self.assets = [id_asset_map[i] for i in asset_ids if i in id_asset_map]
+
+            domain_ids = {asset.domain_id for asset in self.assets if asset.domain_id}
+            self.domain_gateways = defaultdict(list)
+            gateways = Gateway.objects.filter(domain_id__in=domain_ids, is_active=True)
+            for gateway in gateways:
+                self.domain_gateways[gateway.domain_id].append(gateway)
+
+            admin_user_ids = {asset.admin_user_id for asset in self.assets if asset.admin_user_id}
+            self.admin_users = SystemUser.objects.in_bulk(admin_user_ids)
+
+            users = dict(self.admin_users)
+            if system_user:
+                users[system_user.id] = system_user
+            self.auth_books = defaultdict(list)
+            auth_books = AuthBook.objects.filter(asset_id__in=asset_ids, systemuser_id__in=users.keys())
+            for auth_book in auth_books:
+                # 避免 load_auth 时再查系统用户
+                auth_book.systemuser = users[auth_book.systemuser_id]
+                self.auth_books[(auth_book.asset_id, auth_book.systemuser_id)].append(auth_book)
+
+    def has_gateway(self, asset):
+        return bool(asset.domain_id and self.domain_gateways.get(asset.domain_id))
+
+    def random_gateway(self, asset):
+        gateways = self.domain_gateways[asset.domain_id]
+        connective_gateways = [gw for gw in gateways if gw.is_connective]
+        if connective_gateways:
+            return random.choice(connective_gateways)
+        logger.warn(f'Gateway all bad. domain={asset.domain}, gateway_num={len(gateways)}.')
+        return random.choice(gateways)
+
+    def get_private_key_file(self, user):
+        if not user.private_key:
+            return None
+        if user.private_key not in self._key_files:
+            self._key_files[user.private_key] = user.private_key_file
+        return self._key_files[user.private_key]
+
+    def get_auth_user(self, system_user, asset, username=''):
+        """
+        与 `SystemUser.load_asset_special_auth` 相同的规则选择认证，但不修改系统用户
+        """
+        auth_books = self.auth_books.get((asset.id, system_user.id))
+        if not auth_books:
+            return system_user
+        auth_books = sorted(auth_books, key=lambda x: 1 if x.username == username else 0, reverse=True)
+        auth_book = auth_books[0]
+        auth_book.load_auth()
+        return auth_book
+
+    def get_admin_auth_info(self, asset):
+        admin_user = self.admin_users.get(asset.admin_user_id)
+        if not admin_user:
+            return {}
+        auth = self.get_auth_user(admin_user, asset)
+        return {
+            'username': admin_user.username,
+            'password': auth.password,
+            'private_key': self.get_private_key_file(auth),
+        }
+
+    def get_system_user_auth_info(self, asset, username=''):
+        system_user = self.system_user
+        auth = self.get_auth_user(system_user, asset, username=username)
+        return {
+            'name': system_user.name,
+            'username': system_user.username,
+            'password': auth.password,
+            'public_key': auth.public_key,
+            'private_key': self.get_private_key_file(auth),
+        }
+
+
 class JMSBaseInventory(BaseInventory):
     windows_ssh_default_shell = settings.WINDOWS_SSH_DEFAULT_SHELL
 
-    def convert_to_ansible(self, asset, run_as_admin=False):
+    def convert_to_ansible(self, asset, run_as_admin=False, prefetcher=None):
         info = {
             'id': asset.id,
             'hostname': asset.hostname,
@@ -26,10 +129,17 @@ class JMSBaseInventory(BaseInventory):
             'vars': dict(),
             'groups': [],
         }
-        if asset.domain and asset.domain.has_gateway():
-            info["vars"].update(self.make_proxy_command(asset))
+        if prefetcher:
+            has_gateway = prefetcher.has_gateway(asset)
+        else:
+            has_gateway = asset.domain and asset.domain.has_gateway()
+        if has_gateway:
+            info["vars"].update(self.make_proxy_command(asset, prefetcher=prefetcher))
         if run_as_admin:
-            info.update(asset.get_auth_info())
+            if prefetcher:
+                info.update(prefetcher.get_admin_auth_info(asset))
+            else:
+                info.update(asset.get_auth_info())
             if asset.is_unixlike():
                 info["become"] = {
                     "method": 'sudo',
@@ -52,8 +162,13 @@ class JMSBaseInventory(BaseInventory):
         return info
 
     @staticmethod
-    def make_proxy_command(asset):
-        gateway = asset.domain.random_gateway()
+    def make_proxy_command(asset, prefetcher=None):
+        if prefetcher:
+            gateway = prefetcher.random_gateway(asset)
+            private_key_file = prefetcher.get_private_key_file(gateway)
+        else:
+            gateway = asset.domain.random_gateway()
+            private_key_file = gateway.private_key_file
         proxy_command_list = [
             "ssh", "-o", "Port={}".format(gateway.port),
             "-o", "StrictHostKeyChecking=no",
@@ -66,7 +181,7 @@ class JMSBaseInventory(BaseInventory):
                 0, "sshpass -p '{}'".format(gateway.password)
             )
         if gateway.private_key:
-            proxy_command_list.append("-i {}".format(gateway.private_key_file))
+            proxy_command_list.append("-i {}".format(private_key_file))
 
         proxy_command = "'-o ProxyCommand={}'".format(
             " ".join(proxy_command_list)
@@ -80,45 +195,49 @@ class JMSInventory(JMSBaseInventory):
     write you own inventory, construct you inventory,
     user_info  is obtained from admin_user or asset_user
     """
-    def __init__(self, assets, run_as_admin=False, run_as=None, become_info=None, system_user=None):
+    def __init__(self, assets, run_as_admin=False, run_as=None, become_info=None, system_user=None,
+                 host_vars=None):
         """
         :param assets: assets
         :param run_as_admin: True 是否使用管理用户去执行, 每台服务器的管理用户可能不同
         :param run_as: 用户名(添加了统一的资产用户管理器之后AssetUserManager加上之后修改为username)
         :param become_info: 是否become成某个用户去执行
+        :param host_vars: {asset_id: {var: value}} 每台主机额外的变量
         """
-        self.assets = assets
         self.using_admin = run_as_admin
         self.run_as = run_as
         self.system_user = system_user
         self.become_info = become_info
+        self.host_vars = host_vars or {}
 
-        host_list = []
+        t_start = time.time()
+        self.prefetcher = InventoryPrefetcher(assets, system_user=system_user)
+        self.assets = self.prefetcher.assets
+        self.prefetch_time = time.time() - t_start
 
-        for asset in assets:
-            host = self.convert_to_ansible(asset, run_as_admin=run_as_admin)
-            if run_as is not None:
-                run_user_info = self.get_run_user_info(host)
-                host.update(run_user_info)
-            if become_info and asset.is_unixlike():
-                host.update(become_info)
-            host_list.append(host)
+        super().__init__(host_list=self.iter_hosts())
+        self.build_time = time.time() - t_start
+        logger.info(f'Build inventory: hosts={len(self.assets)} '
+                    f'prefetch={self.prefetch_time:.3f}s total={self.build_time:.3f}s')
 
-        super().__init__(host_list=host_list)
+    def iter_hosts(self):
+        for asset in self.assets:
+            host = self.convert_to_ansible(asset, run_as_admin=self.using_admin, prefetcher=self.prefetcher)
+            if self.run_as is not None:
+                run_user_info = self.get_run_user_info(asset)
+                host.update(run_user_info)
+            if self.become_info and asset.is_unixlike():
+                host.update(self.become_info)
+            if asset.id in self.host_vars:
+                host['vars'].update(self.host_vars[asset.id])
+            yield host
 
-    def get_run_user_info(self, host):
+    def get_run_user_info(self, asset):
         if not self.run_as and not self.system_user:
             return {}
 
-        asset_id = host.get('id', '')
-        asset = self.assets.filter(id=asset_id).first()
-        if not asset:
-            logger.error('Host not found: ', asset_id)
-            return {}
-
         if self.system_user:
-            self.system_user.load_asset_special_auth(asset=asset, username=self.run_as)
-            return self.system_user._to_secret_json()
+            return self.prefetcher.get_system_user_auth_info(asset, username=self.run_as)
         else:
             return {}
 
@@ -99,10 +99,10 @@ class Task(PeriodTaskModelMixin, OrgModelMixin):
     def get_run_execution(self):
         return self.execution.all()
 
-    def run(self):
+    def run(self, host_vars=None):
         latest_adhoc = self.get_latest_adhoc()
         if latest_adhoc:
-            return latest_adhoc.run()
+            return latest_adhoc.run(host_vars=host_vars)
         else:
             return {'error': 'No adhoc'}
 
@@ -157,6 +157,11 @@ class AdHoc(OrgModelMixin):
 
     @property
     def inventory(self):
+        return self.get_inventory()
+
+    def get_inventory(self, hosts=None, host_vars=None):
+        if hosts is None:
+            hosts = self.hosts.all()
         if self.become:
             become_info = {
                 'become': {
@@ -167,8 +172,9 @@ class AdHoc(OrgModelMixin):
             become_info = None
 
         inventory = JMSInventory(
-            self.hosts.all(), run_as_admin=self.run_as_admin,
-            run_as=self.run_as, become_info=become_info, system_user=self.run_system_user
+            hosts, run_as_admin=self.run_as_admin,
+            run_as=self.run_as, become_info=become_info, system_user=self.run_system_user,
+            host_vars=host_vars
         )
         return inventory
 
@@ -178,7 +184,10 @@ class AdHoc(OrgModelMixin):
             return self.become.get("user", "")
         return ""
 
-    def run(self):
+    def run(self, host_vars=None):
+        """
+        :param host_vars: {asset_id: {var: value}} 本次执行附加的主机变量，不保存
+        """
         try:
             celery_task_id = current_task.request.id
         except AttributeError:
@@ -192,6 +201,7 @@ class AdHoc(OrgModelMixin):
             hosts_amount=self.hosts.count(),
         )
         execution.save()
+        execution.host_vars = host_vars
         return execution.start()
 
     @property
@@ -248,6 +258,8 @@ class AdHocExecution(OrgModelMixin):
     is_success = models.BooleanField(default=False, verbose_name=_('Is success'))
     result = JsonDictTextField(blank=True, null=True, verbose_name=_('Adhoc raw result'))
     summary = JsonDictTextField(blank=True, null=True, verbose_name=_('Adhoc result summary'))
+    # 运行时附加的主机变量，可能包含认证信息，只在当前进程中使用
+    host_vars = None
 
     @property
     def short_id(self):
@@ -266,7 +278,14 @@ class AdHocExecution(OrgModelMixin):
         return os.path.join(log_dir, str(self.id) + '.log')
 
     def start_runner(self):
-        runner = AdHocRunner(self.adhoc.inventory, options=self.adhoc.options)
+        from ..sharding import AdHocShardRunner
+
+        if AdHocShardRunner.need_shard(self):
+            return AdHocShardRunner(self).run()
+
+        inventory = self.adhoc.get_inventory(host_vars=self.host_vars)
+        print('Inventory built: hosts={} cost={:.3f}s'.format(len(inventory.assets), inventory.build_time))
+        runner = AdHocRunner(inventory, options=self.adhoc.options)
         try:
             result = runner.run(
                 self.adhoc.tasks,
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+#
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+
+from common.utils import get_logger
+from .ansible import AdHocRunner
+
+__all__ = ['AdHocShardRunner']
+
+logger = get_logger(__file__)
+
+
+class AdHocShardRunner:
+    """
+    主机很多时把一次 AdHoc 执行按主机分片，分片作为 celery 子任务分发到多个 ansible worker，
+    最后合并成一个 `AdHocExecution` 的结果
+
+    每个分片执行前先在 redis 中认领，认领成功的才执行：
+    发起执行的 worker 先执行第一片，然后认领还没有被其它 worker 执行的分片自己执行，
+    只有一个 worker 时也不会一直等待
+
+    认领是一个短租约，执行期间定期续期；执行分片的 worker 退出后租约过期，
+    还没有结果的分片会被重新认领执行
+    """
+    claim_key_template = 'ops.adhoc.shard.claim.{execution_id}.{index}'
+    result_key_template = 'ops.adhoc.shard.result.{execution_id}.{index}'
+    key_ttl = 3600 * 24
+    lease_ttl = 60
+    poll_interval = 1
+
+    def __init__(self, execution):
+        self.execution = execution
+        self.adhoc = execution.adhoc
+
+    @staticmethod
+    def need_shard(execution):
+        # 运行时的主机变量不保存，其它 worker 拿不到，只能在本地执行
+        if execution.host_vars:
+            return False
+        shard_size = settings.ANSIBLE_SHARD_SIZE
+        return bool(shard_size) and execution.hosts_amount > shard_size
+
+    def get_host_id_batches(self):
+        shard_size = settings.ANSIBLE_SHARD_SIZE
+        host_ids = list(self.adhoc.hosts.all().order_by('id').values_list('id', flat=True))
+        return [host_ids[i:i + shard_size] for i in range(0, len(host_ids), shard_size)]
+
+    @classmethod
+    def claim(cls, execution_id, index):
+        """
+        :return: 认领成功时返回租约的 token，否则返回 None
+        """
+        client = cache.client.get_client(write=True)
+        key = cls.claim_key_template.format(execution_id=execution_id, index=index)
+        token = uuid.uuid4().hex
+        if client.set(key, token, nx=True, ex=cls.lease_ttl):
+            return token
+        return None
+
+    @classmethod
+    def keep_lease(cls, execution_id, index, token, stopped: threading.Event):
+        """
+        在线程中定期续期租约，直到 `stopped` 被设置
+        """
+        client = cache.client.get_client(write=True)
+        key = cls.claim_key_template.format(execution_id=execution_id, index=index)
+        while not stopped.wait(cls.lease_ttl / 3):
+            try:
+                value = client.get(key)
+                if value is None or value.decode() != token:
+                    logger.error(f'Adhoc shard lease lost: execution={execution_id} index={index}')
+                    return
+                client.expire(key, cls.lease_ttl)
+            except Exception as e:
+                logger.error(f'Renew adhoc shard lease failed: execution={execution_id} index={index} {e}')
+
+    @classmethod
+    def get_result(cls, execution_id, index):
+        return cache.get(cls.result_key_template.format(execution_id=execution_id, index=index))
+
+    @classmethod
+    def run_shard(cls, execution, index, host_ids):
+        """
+        执行一个分片，已经被认领的分片直接跳过
+        """
+        token = cls.claim(execution.id, index)
+        if not token:
+            logger.info(f'Adhoc shard has been claimed: execution={execution.id} index={index}')
+            return None
+        # 认领之前租约过期的 worker 可能刚好写入了结果
+        value = cls.get_result(execution.id, index)
+        if value is not None:
+            return value
+
+        stopped = threading.Event()
+        lease_thread = threading.Thread(
+            target=cls.keep_lease, args=(execution.id, index, token, stopped), daemon=True
+        )
+        lease_thread.start()
+        try:
+            return cls._run_shard(execution, index, host_ids)
+        finally:
+            stopped.set()
+
+    @classmethod
+    def _run_shard(cls, execution, index, host_ids):
+        from assets.models import Asset
+
+        adhoc = execution.adhoc
+        hosts = Asset.objects.filter(id__in=host_ids)
+        inventory = adhoc.get_inventory(hosts)
+        print('Inventory built: shard={} hosts={} cost={:.3f}s'.format(
+            index, len(inventory.assets), inventory.build_time
+        ))
+        runner = AdHocRunner(inventory, options=adhoc.options)
+        t_start = time.time()
+        try:
+            result = runner.run(adhoc.tasks, adhoc.pattern, adhoc.task.name, execution_id=execution.id)
+            value = (result.results_raw, result.results_summary)
+        except Exception as e:
+            logger.error(f'Failed run adhoc shard: execution={execution.id} index={index} {e}', exc_info=True)
+            value = ({}, {'success': False})
+        cache.set(
+            cls.result_key_template.format(execution_id=execution.id, index=index),
+            value, cls.key_ttl
+        )
+        logger.info(f'Run adhoc shard ok: cost={time.time() - t_start} execution={execution.id} '
+                    f'index={index} hosts={len(host_ids)}')
+        return value
+
+    def dispatch(self, batches):
+        from .tasks import run_adhoc_shard
+
+        for index, host_ids in enumerate(batches):
+            if index == 0:
+                continue
+            run_adhoc_shard.apply_async(args=(str(self.execution.id), index, host_ids), queue='ansible')
+
+    def wait(self, batches):
+        execution_id = self.execution.id
+        results = {}
+        t_start = time.time()
+        timeout = settings.ANSIBLE_SHARD_TIMEOUT
+
+        while len(results) < len(batches):
+            waiting = False
+            for index, host_ids in enumerate(batches):
+                if index in results:
+                    continue
+                value = self.get_result(execution_id, index)
+                if value is None:
+                    # 还没有结果的分片，没有被认领或者执行它的 worker 租约已过期时自己执行
+                    value = self.run_shard(self.execution, index, host_ids)
+                if value is None:
+                    waiting = True
+                    continue
+                results[index] = value
+
+            if not waiting:
+                continue
+            if time.time() - t_start > timeout:
+                logger.error(f'Wait adhoc shards timeout: execution={execution_id} '
+                             f'done={len(results)} total={len(batches)}')
+                break
+            time.sleep(self.poll_interval)
+        return [results.get(index, ({}, {'success': False})) for index in range(len(batches))]
+
+    @staticmethod
+    def merge(results):
+        raw = defaultdict(dict)
+        summary = dict(contacted=defaultdict(dict), dark=defaultdict(dict), success=True)
+        for _raw, _summary in results:
+            for k, v in (_raw or {}).items():
+                raw[k].update(v)
+            summary['contacted'].update(_summary.get('contacted', {}))
+            summary['dark'].update(_summary.get('dark', {}))
+            summary['success'] &= _summary.get('success', False)
+        return dict(raw), summary
+
+    def run(self):
+        batches = self.get_host_id_batches()
+        logger.info(f'Run adhoc in shards: execution={self.execution.id} '
+                    f'hosts={self.execution.hosts_amount} shards={len(batches)}')
+        self.dispatch(batches)
+        results = self.wait(batches)
+        return self.merge(results)
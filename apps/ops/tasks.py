@@ -19,7 +19,8 @@ from .celery.utils import (
     create_or_update_celery_periodic_tasks, get_celery_periodic_task,
     disable_celery_periodic_task, delete_celery_periodic_task
 )
-from .models import Task, CommandExecution, CeleryTask
+from .models import Task, CommandExecution, CeleryTask, AdHocExecution
+from .sharding import AdHocShardRunner
 from .notifications import ServerPerformanceCheckUtil
 
 logger = get_logger(__file__)
@@ -48,6 +49,20 @@ def run_ansible_task(tid, callback=None, **kwargs):
         return result
 
 
+@shared_task(queue="ansible")
+def run_adhoc_shard(execution_id, index, host_ids):
+    """
+    执行 AdHoc 的一个主机分片，结果由发起执行的 worker 合并
+    """
+    with tmp_to_root_org():
+        execution = get_object_or_none(AdHocExecution, id=execution_id)
+    if not execution or not execution.adhoc:
+        logger.error("No adhoc execution found: {}".format(execution_id))
+        return
+    with tmp_to_org(execution.adhoc.org):
+        AdHocShardRunner.run_shard(execution, index, host_ids)
+
+
 @shared_task(soft_time_limit=60, queue="ansible")
 def run_command_execution(cid, **kwargs):
     with tmp_to_root_org():
@@ -1,88 +1,182 @@
-import time
+import asyncio
 import os
-import threading
-import json
+import time
+
+import aioredis
+from django.conf import settings
 
 from common.utils import get_logger
 
+from .celery.logger import CeleryTaskLogStream
 from .celery.utils import get_celery_task_log_path
 from .ansible.utils import get_ansible_task_log_path
-from channels.generic.websocket import JsonWebsocketConsumer
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
 
 logger = get_logger(__name__)
 
 
-class TaskLogWebsocket(JsonWebsocketConsumer):
-    disconnected = False
+class TaskLogWebsocket(AsyncJsonWebsocketConsumer):
+    """
+    celery 任务的日志先从日志文件补齐历史，再阻塞读取任务的 redis stream，
+    空闲的连接不占用线程，也不需要轮询
+
+    ansible 的日志没有写入 stream，仍然读取日志文件；
+    一个连接可以同时查看多个任务，每个任务一个读取协程
+
+    任务还没有开始(没有日志文件也没有 stream)时发送等待的点，
+    超过 `wait_stream_timeout` 秒还没有 stream 或者日志文件已经出现(stream 写入失败)，改为读取日志文件
+    """
 
     log_types = {
         'celery': get_celery_task_log_path,
         'ansible': get_ansible_task_log_path
     }
+    stream_log_types = ('celery',)
+    read_size = 4096
+    block_timeout = 5000
+    wait_block_timeout = 500
+    wait_stream_timeout = 60
 
-    def connect(self):
+    async def connect(self):
+        self.log_tasks = {}
         user = self.scope["user"]
         if user.is_authenticated:
-            self.accept()
+            await self.accept()
         else:
-            self.close()
+            await self.close()
 
     def get_log_path(self, task_id):
         func = self.log_types.get(self.log_type)
         if func:
             return func(task_id)
 
-    def receive(self, text_data=None, bytes_data=None, **kwargs):
-        data = json.loads(text_data)
-        task_id = data.get('task')
-        self.log_type = data.get('type', 'celery')
+    async def receive_json(self, content, **kwargs):
+        task_id = content.get('task')
+        self.log_type = content.get('type', 'celery')
         if task_id:
             self.handle_task(task_id)
 
-    def wait_util_log_path_exist(self, task_id):
-        log_path = self.get_log_path(task_id)
-        while not self.disconnected:
-            if not os.path.exists(log_path):
-                self.send_json({'message': '.', 'task': task_id})
-                time.sleep(0.5)
-                continue
-            self.send_json({'message': '\r\n'})
-            try:
-                logger.debug('Task log path: {}'.format(log_path))
-                task_log_f = open(log_path, 'rb')
-                return task_log_f
-            except OSError:
-                return None
-
-    def read_log_file(self, task_id):
-        task_log_f = self.wait_util_log_path_exist(task_id)
-        if not task_log_f:
-            logger.debug('Task log file is None: {}'.format(task_id))
-            return
+    async def send_log(self, task_id, data: bytes):
+        data = data.replace(b'\n', b'\r\n')
+        await self.send_json({'message': data.decode(errors='ignore'), 'task': task_id})
 
-        task_end_mark = []
-        while not self.disconnected:
-            data = task_log_f.read(4096)
-            if data:
-                data = data.replace(b'\n', b'\r\n')
-                self.send_json(
-                    {'message': data.decode(errors='ignore'), 'task': task_id}
-                )
-                if data.find(b'succeeded in') != -1:
-                    task_end_mark.append(1)
-                if data.find(bytes(task_id, 'utf8')) != -1:
-                    task_end_mark.append(1)
-            elif len(task_end_mark) == 2:
+    @staticmethod
+    async def run_in_executor(func, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, func, *args)
+
+    async def send_log_file(self, task_id, log_path):
+        """
+        分块发送日志文件中已有的完整行，读文件在线程池中执行，不阻塞其它连接
+
+        :return: 已发送的字节数，文件不存在时返回 None
+        """
+        try:
+            f = await self.run_in_executor(open, log_path, 'rb')
+        except OSError:
+            return None
+
+        sent = 0
+        pending = b''
+        try:
+            while True:
+                data = await self.run_in_executor(f.read, self.read_size)
+                if not data:
+                    break
+                data = pending + data
+                # 最后一行可能还没有写完，由 stream 中的记录发送
+                end = data.rfind(b'\n') + 1
+                pending = data[end:]
+                if end:
+                    await self.send_log(task_id, data[:end])
+                    sent += end
+        finally:
+            f.close()
+        return sent
+
+    async def stream_log(self, task_id, log_path):
+        key = CeleryTaskLogStream.get_key(task_id)
+        client = await aioredis.create_redis(settings.CHANNEL_REDIS)
+        try:
+            # 先记下 stream 的位置再读文件，之后的记录用 offset 去重
+            last_entries = await client.xrevrange(key, count=1)
+            last_id = last_entries[0][0] if last_entries else b'0-0'
+            offset = await self.send_log_file(task_id, log_path)
+            if offset is not None and not last_entries:
+                # 日志文件存在但 stream 已经过期，任务早已结束
                 logger.debug('Task log end: {}'.format(task_id))
-                break
-            time.sleep(0.2)
-        task_log_f.close()
+                return
+            waiting = offset is None and not last_entries
+            offset = offset or 0
+            t_start = time.monotonic()
+
+            while True:
+                timeout = self.wait_block_timeout if waiting else self.block_timeout
+                entries = await client.xread(
+                    [key], timeout=timeout, latest_ids=[last_id], count=100
+                )
+                if waiting:
+                    if entries:
+                        waiting = False
+                        await self.send_json({'message': '\r\n'})
+                    elif os.path.exists(log_path) or time.monotonic() - t_start > self.wait_stream_timeout:
+                        logger.debug('Task log stream not found, tail log file: {}'.format(task_id))
+                        break
+                    else:
+                        await self.send_json({'message': '.', 'task': task_id})
+                        continue
+                for _key, entry_id, fields in entries:
+                    last_id = entry_id
+                    msg = fields.get(CeleryTaskLogStream.FIELD_MSG.encode())
+                    entry_offset = int(fields.get(CeleryTaskLogStream.FIELD_OFFSET.encode(), 0))
+                    if msg and entry_offset > offset:
+                        await self.send_log(task_id, msg)
+                    if CeleryTaskLogStream.FIELD_END.encode() in fields:
+                        logger.debug('Task log end: {}'.format(task_id))
+                        return
+        finally:
+            client.close()
+            await client.wait_closed()
+        await self.tail_log_file(task_id, log_path)
+
+    async def tail_log_file(self, task_id, log_path):
+        while not os.path.exists(log_path):
+            await self.send_json({'message': '.', 'task': task_id})
+            await asyncio.sleep(0.5)
+        await self.send_json({'message': '\r\n'})
+        logger.debug('Task log path: {}'.format(log_path))
+
+        task_end_mark = []
+        with open(log_path, 'rb') as task_log_f:
+            while True:
+                data = await self.run_in_executor(task_log_f.read, self.read_size)
+                if data:
+                    await self.send_log(task_id, data)
+                    if data.find(b'succeeded in') != -1:
+                        task_end_mark.append(1)
+                    if data.find(bytes(task_id, 'utf8')) != -1:
+                        task_end_mark.append(1)
+                elif len(task_end_mark) == 2:
+                    logger.debug('Task log end: {}'.format(task_id))
+                    break
+                await asyncio.sleep(0.2)
 
     def handle_task(self, task_id):
         logger.info("Task id: {}".format(task_id))
-        thread = threading.Thread(target=self.read_log_file, args=(task_id,))
-        thread.start()
+        log_path = self.get_log_path(task_id)
+        if not log_path:
+            return
+        log_task = self.log_tasks.get(task_id)
+        if log_task and not log_task.done():
+            return
+        if self.log_type in self.stream_log_types:
+            coro = self.stream_log(task_id, log_path)
+        else:
+            coro = self.tail_log_file(task_id, log_path)
+        log_task = asyncio.ensure_future(coro)
+        log_task.add_done_callback(lambda t: self.log_tasks.pop(task_id, None))
+        self.log_tasks[task_id] = log_task
 
-    def disconnect(self, close_code):
-        self.disconnected = True
-        self.close()
+    async def disconnect(self, close_code):
+        for log_task in list(self.log_tasks.values()):
+            log_task.cancel()
@@ -2,3 +2,4 @@ from .user_permission import *
 from .asset_permission import *
 from .asset_permission_relation import *
 from .user_group_permission import *
+from .asset_permission_reverse import *
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+#
+import codecs
+import csv
+from io import StringIO
+
+import os
+import uuid
+
+from celery.result import AsyncResult
+from django.http import StreamingHttpResponse, FileResponse
+from django.utils.translation import ugettext as _
+from rest_framework import generics, status
+from rest_framework.views import APIView
+from rest_framework.response import Response
+
+from common.permissions import IsOrgAdminOrAppUser, IsOrgAuditor, IsSuperUser, IsSuperAuditor
+from common.utils import get_logger
+from common.utils.timezone import now, as_current_tz
+from perms.models import AssetPermReverseIndex
+from perms.exceptions import AssetPermReverseIndexBuilding
+from perms.hands import Asset
+from perms.utils.asset.reverse_index import AssetPermReverseIndexUtil
+from perms.utils.asset.access_report import get_access_report_path
+
+logger = get_logger(__name__)
+
+__all__ = ['AssetGrantedSubjectsApi', 'AssetGrantedSubjectsExportApi', 'AssetAccessReportApi']
+
+
+class AssetGrantedSubjectsApi(generics.ListAPIView):
+    """
+    资产可以被哪些用户、用户组通过哪些系统用户和动作登录
+    """
+    permission_classes = [IsOrgAdminOrAppUser | IsOrgAuditor]
+    filterset_fields = ('id', 'hostname', 'ip')
+    search_fields = ('hostname', 'ip')
+
+    def get_queryset(self):
+        # 索引在 celery 中重建，重建完成前返回 409，前端稍后重试
+        org_ids = AssetPermReverseIndexUtil.get_current_org_ids()
+        if AssetPermReverseIndexUtil.rebuild_orgs_async_if_need(org_ids):
+            raise AssetPermReverseIndexBuilding
+
+        asset_ids = AssetPermReverseIndex.objects.values('asset_id')
+        queryset = Asset.objects.filter(id__in=asset_ids)\
+            .only('id', 'hostname', 'ip', 'org_id')\
+            .order_by('hostname')
+        return queryset
+
+    @staticmethod
+    def get_assets_data(assets):
+        subjects = AssetPermReverseIndexUtil.get_assets_granted_subjects([asset.id for asset in assets])
+        return [
+            {
+                'asset': {'id': asset.id, 'hostname': asset.hostname, 'ip': asset.ip},
+                **subjects[str(asset.id)]
+            }
+            for asset in assets
+        ]
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(self.get_assets_data(page))
+        return generics.ListAPIView.list(self, request, *args, **kwargs)
+
+
+class AssetGrantedSubjectsExportApi(AssetGrantedSubjectsApi):
+    """
+    导出为 csv，每个资产的每条有效授权规则一行，分批查询并流式输出
+    """
+    chunk_size = 1000
+    pagination_class = None
+
+    def get_header(self):
+        return [
+            _('Hostname'), _('IP'), _('Asset permission'), _('Actions'), _('Date expired'),
+            _('User'), _('User group'), _('System user'),
+        ]
+
+    def get_rows(self, assets):
+        data = self.get_assets_data(assets)
+        for item in data:
+            asset = item['asset']
+            users = {str(u['id']): u['username'] for u in item['users']}
+            groups = {str(g['id']): g['name'] for g in item['user_groups']}
+            system_users = {
+                str(s['id']): '{}({})'.format(s['name'], s['username'])
+                for s in item['system_users']
+            }
+            for perm in item['permissions']:
+                yield [
+                    asset['hostname'], asset['ip'], perm['name'],
+                    ','.join(perm['actions']),
+                    as_current_tz(perm['date_expired']).strftime('%Y-%m-%d %H:%M:%S'),
+                    ','.join(users[i] for i in perm['users'] if i in users),
+                    ','.join(groups[i] for i in perm['user_groups'] if i in groups),
+                    ','.join(system_users[i] for i in perm['system_users'] if i in system_users),
+                ]
+
+    def iter_content(self, queryset):
+        buffer = StringIO()
+        writer = csv.writer(buffer)
+
+        def flush():
+            value = buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            return value
+
+        yield codecs.BOM_UTF8.decode()
+        writer.writerow(self.get_header())
+        yield flush()
+
+        asset_ids = list(queryset.values_list('id', flat=True))
+        for i in range(0, len(asset_ids), self.chunk_size):
+            assets = Asset.objects.filter(id__in=asset_ids[i:i + self.chunk_size])\
+                .only('id', 'hostname', 'ip', 'org_id')\
+                .order_by('hostname')
+            for row in self.get_rows(assets):
+                writer.writerow(row)
+            yield flush()
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        response = StreamingHttpResponse(self.iter_content(queryset), content_type='text/csv')
+        filename = 'asset-granted-subjects-{}.csv'.format(now().strftime('%Y-%m-%d_%H-%M-%S'))
+        response['Content-Disposition'] = 'attachment; filename="{}"'.format(filename)
+        return response
+
+
+class AssetAccessReportApi(APIView):
+    """
+    所有组织的有效访问矩阵报表
+
+    POST: 提交生成任务，参数 `format` 为 csv 或 xlsx
+    GET: 参数 `task_id`，任务完成时下载报表，否则返回任务状态和进度
+    """
+    permission_classes = [IsSuperUser | IsSuperAuditor]
+    formats = ('csv', 'xlsx')
+
+    def post(self, request, *args, **kwargs):
+        from perms.tasks import generate_asset_access_report
+
+        file_format = request.data.get('format', 'csv')
+        if file_format not in self.formats:
+            return Response({'error': _('Invalid format')}, status=status.HTTP_400_BAD_REQUEST)
+        task = generate_asset_access_report.delay(file_format)
+        return Response({'task': task.id}, status=status.HTTP_201_CREATED)
+
+    def get(self, request, *args, **kwargs):
+        task_id = request.query_params.get('task_id', '')
+        file_format = request.query_params.get('format', 'csv')
+        if file_format not in self.formats:
+            return Response({'error': _('Invalid params')}, status=status.HTTP_400_BAD_REQUEST)
+        # task_id 会用来拼接文件路径
+        try:
+            task_id = str(uuid.UUID(task_id))
+        except ValueError:
+            return Response({'error': _('Invalid params')}, status=status.HTTP_400_BAD_REQUEST)
+
+        result = AsyncResult(task_id)
+        path = get_access_report_path(task_id, file_format)
+        if result.successful() and os.path.isfile(path):
+            filename = 'asset-access-report-{}.{}'.format(task_id, file_format)
+            return FileResponse(open(path, 'rb'), as_attachment=True, filename=filename)
+
+        progress = result.info if isinstance(result.info, dict) else {}
+        if result.failed():
+            progress = {'error': str(result.info)}
+        return Response({'state': result.state, 'progress': progress})
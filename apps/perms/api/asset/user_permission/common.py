@@ -12,8 +12,13 @@ from rest_framework.generics import (
 )
 
 from orgs.utils import tmp_to_root_org
-from perms.utils.asset.permission import get_asset_system_user_ids_with_actions_by_user, validate_permission
-from common.permissions import IsOrgAdminOrAppUser, IsOrgAdmin, IsValidUser
+from django.utils.translation import ugettext as _
+from perms.utils.asset.permission import (
+    get_asset_system_user_ids_with_actions_by_user, validate_permission,
+    AssetPermissionBatchValidator
+)
+from perms.utils.asset.user_permission import AssetPermissionDecisionCache
+from common.permissions import IsOrgAdminOrAppUser, IsOrgAdmin, IsValidUser, IsSuperUser
 from common.utils import get_logger, lazyproperty
 
 from perms.hands import User, Asset, SystemUser
@@ -25,9 +30,11 @@ __all__ = [
     'RefreshAssetPermissionCacheApi',
     'UserGrantedAssetSystemUsersForAdminApi',
     'ValidateUserAssetPermissionApi',
+    'ValidateUserAssetPermissionInBatchApi',
     'GetUserAssetPermissionActionsApi',
     'UserAssetPermissionsCacheApi',
     'MyGrantedAssetSystemUsersApi',
+    'AssetPermissionDecisionCacheStatsApi',
 ]
 
 
@@ -84,6 +91,42 @@ class ValidateUserAssetPermissionApi(APIView):
         return Response({'has_permission': has_permission, 'expire_at': int(expire_at)}, status=status_code)
 
 
+@method_decorator(tmp_to_root_org(), name='post')
+class ValidateUserAssetPermissionInBatchApi(APIView):
+    """
+    批量校验连接权限，供 koko, lion, omnidb 等组件一次校验多个会话
+
+    请求: [{"user_id", "asset_id", "system_user_id", "action_name"}, ]
+    响应: 按请求顺序返回 [{"has_permission", "expire_at", "actions"}, ]
+    """
+    permission_classes = (IsOrgAdminOrAppUser,)
+    max_items = 1000
+
+    def get_cache_policy(self):
+        return 0
+
+    def post(self, request, *args, **kwargs):
+        serializer = serializers.ValidateAssetPermissionItemSerializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        items = serializer.validated_data
+        if len(items) > self.max_items:
+            error = _('The number of items cannot exceed {}').format(self.max_items)
+            return Response({'error': error}, status=status.HTTP_400_BAD_REQUEST)
+
+        results = AssetPermissionBatchValidator(items).validate()
+        return Response(results)
+
+
+class AssetPermissionDecisionCacheStatsApi(APIView):
+    """
+    连接授权判定缓存的命中统计
+    """
+    permission_classes = (IsSuperUser,)
+
+    def get(self, request, *args, **kwargs):
+        return Response(AssetPermissionDecisionCache.get_stats())
+
+
 # TODO 删除
 class RefreshAssetPermissionCacheApi(RetrieveAPIView):
     permission_classes = (IsOrgAdmin,)
@@ -1,24 +1,66 @@
 # -*- coding: utf-8 -*-
 #
+from django.http import HttpResponseNotModified
+from django.utils.translation import get_language
 from rest_framework.request import Request
 
 from common.permissions import IsOrgAdminOrAppUser, IsValidUser
 from common.http import is_true
 from common.mixins.api import RoleAdminMixin as _RoleAdminMixin
 from common.mixins.api import RoleUserMixin as _RoleUserMixin
-from orgs.utils import tmp_to_root_org
+from orgs.utils import tmp_to_root_org, current_org
 from users.models import User
 from perms.utils.asset.user_permission import UserGrantedTreeRefreshController
 
 
-class PermBaseMixin:
+class GrantedTreeETagMixin:
+    """
+    授权树和授权资产接口的条件请求，`If-None-Match` 匹配时直接返回 304，
+    不查询授权树和资产
+
+    ETag 在查询之前生成，查询期间提交的变更最多让响应比 ETag 新，下次请求会返回新内容
+    """
+    request: Request
+
+    def get_tree_etag(self, controller: UserGrantedTreeRefreshController):
+        return controller.get_tree_etag(
+            self.request.get_full_path(), get_language(), str(current_org.id)
+        )
+
+    def get_not_modified_response(self, controller: UserGrantedTreeRefreshController):
+        if_none_match = self.request.META.get('HTTP_IF_NONE_MATCH')
+        if not if_none_match:
+            return None
+        etag = self.get_tree_etag(controller)
+        if not etag or etag not in [i.strip() for i in if_none_match.split(',')]:
+            return None
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        return response
+
+    @staticmethod
+    def set_etag(response, etag):
+        if response.status_code != 200:
+            return response
+        if etag:
+            response['ETag'] = etag
+        return response
+
+
+class PermBaseMixin(GrantedTreeETagMixin):
     user: User
 
     def get(self, request: Request, *args, **kwargs):
         force = is_true(request.query_params.get('rebuild_tree'))
         controller = UserGrantedTreeRefreshController(self.user)
+        if not force:
+            response = self.get_not_modified_response(controller)
+            if response:
+                return response
         controller.refresh_if_need(force)
-        return super().get(request, *args, **kwargs)
+        etag = self.get_tree_etag(controller)
+        response = super().get(request, *args, **kwargs)
+        return self.set_etag(response, etag)
 
 
 class RoleAdminMixin(PermBaseMixin, _RoleAdminMixin):
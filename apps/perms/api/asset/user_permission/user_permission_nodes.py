@@ -8,7 +8,8 @@ from rest_framework.response import Response
 from rest_framework.request import Request
 
 from assets.api.mixin import SerializeToTreeNodeMixin
-from common.utils import get_logger
+from assets.pagination import NodeChildrenCursorPagination
+from common.utils import get_logger, lazyproperty
 from .mixin import RoleAdminMixin, RoleUserMixin
 from perms.hands import User
 from perms import serializers
@@ -41,8 +42,18 @@ class _GrantedNodeStructApi(ListAPIView, metaclass=abc.ABCMeta):
         # `get_nodes` 返回的不一定是 `queryset`
         raise NotImplementedError
 
+    def get_nodes_response(self, data):
+        return Response(data=data)
+
 
 class NodeChildrenMixin:
+    request: Request
+
+    @lazyproperty
+    def children_paginator(self):
+        # 请求带 `limit` 参数时，子节点按游标分页
+        return NodeChildrenCursorPagination(self.request)
+
     def get_children(self):
         raise NotImplementedError
 
@@ -50,6 +61,11 @@ class NodeChildrenMixin:
         nodes = self.get_children()
         return nodes
 
+    def get_nodes_response(self, data):
+        if not self.children_paginator.enabled:
+            return Response(data=data)
+        return Response(data=self.children_paginator.get_paginated_data(data))
+
 
 class BaseGrantedNodeApi(_GrantedNodeStructApi, metaclass=abc.ABCMeta):
     serializer_class = serializers.NodeGrantedSerializer
@@ -57,7 +73,7 @@ class BaseGrantedNodeApi(_GrantedNodeStructApi, metaclass=abc.ABCMeta):
     def list(self, request, *args, **kwargs):
         nodes = self.get_nodes()
         serializer = self.get_serializer(nodes, many=True)
-        return Response(serializer.data)
+        return self.get_nodes_response(serializer.data)
 
 
 class BaseNodeChildrenApi(NodeChildrenMixin, BaseGrantedNodeApi, metaclass=abc.ABCMeta):
@@ -68,7 +84,7 @@ class BaseGrantedNodeAsTreeApi(SerializeToTreeNodeMixin, _GrantedNodeStructApi,
     def list(self, request: Request, *args, **kwargs):
         nodes = self.get_nodes()
         nodes = self.serialize_nodes(nodes, with_asset_amount=True)
-        return Response(data=nodes)
+        return self.get_nodes_response(nodes)
 
 
 class BaseNodeChildrenAsTreeApi(NodeChildrenMixin, BaseGrantedNodeAsTreeApi, metaclass=abc.ABCMeta):
@@ -78,11 +94,15 @@ class BaseNodeChildrenAsTreeApi(NodeChildrenMixin, BaseGrantedNodeAsTreeApi, met
 class UserGrantedNodeChildrenMixin:
     user: User
     request: Request
+    children_paginator: NodeChildrenCursorPagination
 
     def get_children(self):
         user = self.user
         key = self.request.query_params.get('key')
-        nodes = UserGrantedNodesQueryUtils(user).get_node_children(key)
+        utils = UserGrantedNodesQueryUtils(user)
+        if self.children_paginator.enabled:
+            return utils.get_node_children_page(key, self.children_paginator)
+        nodes = utils.get_node_children(key)
         return nodes
 
 
@@ -1,82 +1,89 @@
 # -*- coding: utf-8 -*-
 #
+import json
+from itertools import islice
+
 from rest_framework.generics import ListAPIView
 from rest_framework.request import Request
 from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
 from django.db.models import F, Value, CharField
+from django.http import StreamingHttpResponse
 from django.conf import settings
 
 from common.utils.common import timeit
+from common.http import is_true
 from orgs.utils import tmp_to_root_org
 from common.permissions import IsValidUser
 from common.utils import get_logger, get_object_or_none
-from .mixin import RoleUserMixin, RoleAdminMixin
+from .mixin import RoleUserMixin, RoleAdminMixin, GrantedTreeETagMixin
 from perms.utils.asset.user_permission import (
-    UserGrantedTreeBuildUtils, get_user_all_asset_perm_ids,
+    UserGrantedTreeBuildUtils, get_user_all_asset_perm_ids, UserGrantedTreeRefreshController,
     UserGrantedNodesQueryUtils, UserGrantedAssetsQueryUtils,
 )
 from perms.models import AssetPermission, PermNode
 from assets.models import Asset
 from assets.api import SerializeToTreeNodeMixin
+from assets.pagination import NodeChildrenCursorPagination
 from perms.hands import Node
 
 logger = get_logger(__name__)
 
 
-class MyGrantedNodesWithAssetsAsTreeApi(SerializeToTreeNodeMixin, ListAPIView):
+class MyGrantedNodesWithAssetsAsTreeApi(GrantedTreeETagMixin, SerializeToTreeNodeMixin, ListAPIView):
+    """
+    参数 `stream=1` 时使用流式响应，先输出所有节点再分批输出资产，
+    格式与非流式的一致
+    """
     permission_classes = (IsValidUser,)
+    stream_chunk_size = 2000
 
     @timeit
-    def add_ungrouped_resource(self, data: list, nodes_query_utils, assets_query_utils):
+    def get_ungrouped_resource(self, nodes_query_utils, assets_query_utils):
         if not settings.PERM_SINGLE_ASSET_TO_UNGROUP_NODE:
-            return
+            return None
         ungrouped_node = nodes_query_utils.get_ungrouped_node()
 
         direct_granted_assets = assets_query_utils.get_direct_granted_assets().annotate(
             parent_key=Value(ungrouped_node.key, output_field=CharField())
-        ).prefetch_related('platform')
-
-        data.extend(self.serialize_nodes([ungrouped_node], with_asset_amount=True))
-        data.extend(self.serialize_assets(direct_granted_assets))
+        )
+        return [ungrouped_node], direct_granted_assets
 
     @timeit
-    def add_favorite_resource(self, data: list, nodes_query_utils, assets_query_utils):
+    def get_favorite_resource(self, nodes_query_utils, assets_query_utils):
         favorite_node = nodes_query_utils.get_favorite_node()
 
         favorite_assets = assets_query_utils.get_favorite_assets()
         favorite_assets = favorite_assets.annotate(
             parent_key=Value(favorite_node.key, output_field=CharField())
-        ).prefetch_related('platform')
-
-        data.extend(self.serialize_nodes([favorite_node], with_asset_amount=True))
-        data.extend(self.serialize_assets(favorite_assets))
+        )
+        return [favorite_node], favorite_assets
 
     @timeit
-    def add_node_filtered_by_system_user(self, data: list, user, asset_perm_ids):
+    def get_node_filtered_by_system_user(self, user, asset_perm_ids):
         utils = UserGrantedTreeBuildUtils(user, asset_perm_ids)
         nodes = utils.get_whole_tree_nodes()
-        data.extend(self.serialize_nodes(nodes, with_asset_amount=True))
+        return nodes
 
-    def add_assets(self, data: list, assets_query_utils: UserGrantedAssetsQueryUtils):
+    def get_assets(self, assets_query_utils: UserGrantedAssetsQueryUtils):
         if settings.PERM_SINGLE_ASSET_TO_UNGROUP_NODE:
             all_assets = assets_query_utils.get_direct_granted_nodes_assets()
         else:
             all_assets = assets_query_utils.get_all_granted_assets()
-        all_assets = all_assets.annotate(parent_key=F('nodes__key')).prefetch_related('platform')
-        data.extend(self.serialize_assets(all_assets))
+        all_assets = all_assets.annotate(parent_key=F('nodes__key'))
+        return all_assets
 
-    @tmp_to_root_org()
-    def list(self, request: Request, *args, **kwargs):
+    def get_resources(self, request: Request):
         """
         此算法依赖 UserGrantedMappingNode
         获取所有授权的节点和资产
 
         Node = UserGrantedMappingNode + 授权节点的子节点
         Asset = 授权节点的资产 + 直接授权的资产
-        """
 
+        :return: [(nodes, assets_queryset or None), ]
+        """
         user = request.user
-        data = []
         asset_perm_ids = get_user_all_asset_perm_ids(user)
 
         system_user_id = request.query_params.get('system_user')
@@ -88,18 +95,75 @@ class MyGrantedNodesWithAssetsAsTreeApi(SerializeToTreeNodeMixin, ListAPIView):
         nodes_query_utils = UserGrantedNodesQueryUtils(user, asset_perm_ids)
         assets_query_utils = UserGrantedAssetsQueryUtils(user, asset_perm_ids)
 
-        self.add_ungrouped_resource(data, nodes_query_utils, assets_query_utils)
-        self.add_favorite_resource(data, nodes_query_utils, assets_query_utils)
+        resources = []
+        ungrouped_resource = self.get_ungrouped_resource(nodes_query_utils, assets_query_utils)
+        if ungrouped_resource:
+            resources.append(ungrouped_resource)
+        resources.append(self.get_favorite_resource(nodes_query_utils, assets_query_utils))
 
         if system_user_id:
             # 有系统用户筛选的需要重新计算树结构
-            self.add_node_filtered_by_system_user(data, user, asset_perm_ids)
+            all_nodes = self.get_node_filtered_by_system_user(user, asset_perm_ids)
         else:
             all_nodes = nodes_query_utils.get_whole_tree_nodes(with_special=False)
-            data.extend(self.serialize_nodes(all_nodes, with_asset_amount=True))
+        resources.append((all_nodes, None))
+        resources.append(([], self.get_assets(assets_query_utils)))
+        return resources
+
+    def dump_items(self, items, first):
+        content = json.dumps(items, cls=JSONEncoder, ensure_ascii=False)[1:-1]
+        if not content:
+            return ''
+        if not first:
+            content = ',' + content
+        return content
+
+    def iter_stream_content(self, resources):
+        with tmp_to_root_org():
+            yield '['
+            first = True
+            # 先输出所有节点，客户端可以先画出树
+            for nodes, __ in resources:
+                content = self.dump_items(self.serialize_nodes(nodes, with_asset_amount=True), first)
+                if content:
+                    first = False
+                    yield content
+
+            for __, assets in resources:
+                if assets is None:
+                    continue
+                assets = assets.select_related('platform').iterator(chunk_size=self.stream_chunk_size)
+                while True:
+                    chunk = list(islice(assets, self.stream_chunk_size))
+                    if not chunk:
+                        break
+                    content = self.dump_items(self.serialize_assets(chunk), first)
+                    if content:
+                        first = False
+                        yield content
+            yield ']'
 
-        self.add_assets(data, assets_query_utils)
-        return Response(data=data)
+    @tmp_to_root_org()
+    def list(self, request: Request, *args, **kwargs):
+        controller = UserGrantedTreeRefreshController(request.user)
+        response = self.get_not_modified_response(controller)
+        if response:
+            return response
+
+        etag = self.get_tree_etag(controller)
+        resources = self.get_resources(request)
+
+        if is_true(request.query_params.get('stream')):
+            content = self.iter_stream_content(resources)
+            response = StreamingHttpResponse(content, content_type='application/json')
+            return self.set_etag(response, etag)
+
+        data = []
+        for nodes, assets in resources:
+            data.extend(self.serialize_nodes(nodes, with_asset_amount=True))
+            if assets is not None:
+                data.extend(self.serialize_assets(assets.prefetch_related('platform')))
+        return self.set_etag(Response(data=data), etag)
 
 
 class GrantedNodeChildrenWithAssetsAsTreeApiMixin(SerializeToTreeNodeMixin,
@@ -127,6 +191,10 @@ class GrantedNodeChildrenWithAssetsAsTreeApiMixin(SerializeToTreeNodeMixin,
         nodes_query_utils = UserGrantedNodesQueryUtils(user)
         assets_query_utils = UserGrantedAssetsQueryUtils(user)
 
+        paginator = NodeChildrenCursorPagination(request)
+        if paginator.enabled:
+            return self.list_page(key, paginator, nodes_query_utils, assets_query_utils)
+
         nodes = PermNode.objects.none()
         assets = Asset.objects.none()
 
@@ -145,6 +213,27 @@ class GrantedNodeChildrenWithAssetsAsTreeApiMixin(SerializeToTreeNodeMixin,
         tree_assets = self.serialize_assets(assets, key)
         return Response(data=[*tree_nodes, *tree_assets])
 
+    def list_page(self, key, paginator, nodes_query_utils, assets_query_utils):
+        """
+        子节点按游标分页，节点下的资产只在第一页返回
+        """
+        nodes = nodes_query_utils.get_node_children_page(key, paginator)
+
+        assets = Asset.objects.none()
+        if paginator.is_first_page:
+            if key == PermNode.UNGROUPED_NODE_KEY:
+                assets = assets_query_utils.get_ungroup_assets()
+            elif key == PermNode.FAVORITE_NODE_KEY:
+                assets = assets_query_utils.get_favorite_assets()
+            elif key:
+                assets = assets_query_utils.get_node_assets(key)
+        assets = assets.prefetch_related('platform')
+
+        tree_nodes = self.serialize_nodes(nodes, with_asset_amount=True)
+        tree_assets = self.serialize_assets(assets, key)
+        data = paginator.get_paginated_data([*tree_nodes, *tree_assets])
+        return Response(data=data)
+
 
 class UserGrantedNodeChildrenWithAssetsAsTreeApi(RoleAdminMixin, GrantedNodeChildrenWithAssetsAsTreeApiMixin):
     pass
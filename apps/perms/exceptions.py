@@ -12,3 +12,8 @@ class AdminIsModifyingPerm(JMSException):
 class CanNotRemoveAssetPermNow(JMSException):
     status_code = status.HTTP_409_CONFLICT
     default_detail = _('The authorization cannot be revoked for the time being')
+
+
+class AssetPermReverseIndexBuilding(JMSException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = _('The asset permission index is being built. Please try again later')
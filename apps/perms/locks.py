@@ -9,3 +9,13 @@ class UserGrantedTreeRebuildLock(DistributedLock):
             user_id=user_id
         )
         super().__init__(name=name, release_on_transaction_commit=True)
+
+
+class AssetPermReverseIndexRebuildLock(DistributedLock):
+    name_template = 'perms.asset.reverse_index.rebuild.<org_id:{org_id}>'
+
+    def __init__(self, org_id):
+        name = self.name_template.format(
+            org_id=org_id
+        )
+        super().__init__(name=name, release_on_transaction_commit=True, reentrant=True)
@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+#
+# 权限引擎压测只提供这个管理命令，没有 pytest-benchmark 用例：
+# 项目的测试(apps/*/tests)使用 unittest 和 django 的测试运行器，依赖中没有 pytest、pytest-django
+#
+import json
+import os
+import random
+import statistics
+import subprocess
+import time
+import tracemalloc
+import uuid
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from common.utils import get_logger
+from orgs.models import Organization, OrganizationMember
+from orgs.utils import tmp_to_org
+from assets.models import Asset, Node, NodeAncestry, SystemUser
+from assets.utils import compute_nodes_assets_amount, recount_nodes_assets_amount
+from users.models import User, UserGroup
+from perms.models import AssetPermission, PermNode, Action
+from perms.utils.asset.permission import validate_permission
+from perms.utils.asset.user_permission import UserGrantedTreeBuildUtils, UserGrantedTreeRefreshController
+from perms import api
+
+logger = get_logger(__file__)
+
+
+class SyntheticOrgGenerator:
+    """
+    生成一个用于压测的组织：节点树、资产、用户、用户组和授权规则
+    数据直接批量写入，不触发信号
+    """
+    batch_size = 2000
+
+    def __init__(self, depth=3, fanout=10, assets=10000, users=1000, groups=50,
+                 perms=200, node_grant_ratio=0.5, users_per_group=50,
+                 subjects_per_perm=10, targets_per_perm=5, seed=0):
+        self.depth = depth
+        self.fanout = fanout
+        self.assets_amount = assets
+        self.users_amount = users
+        self.groups_amount = groups
+        self.perms_amount = perms
+        self.node_grant_ratio = node_grant_ratio
+        self.users_per_group = users_per_group
+        self.subjects_per_perm = subjects_per_perm
+        self.targets_per_perm = targets_per_perm
+        self.random = random.Random(seed)
+        self.tag = uuid.uuid4().hex[:8]
+        self.org = None
+
+    @property
+    def params(self):
+        return {
+            'depth': self.depth, 'fanout': self.fanout, 'assets': self.assets_amount,
+            'users': self.users_amount, 'groups': self.groups_amount,
+            'perms': self.perms_amount, 'node_grant_ratio': self.node_grant_ratio,
+        }
+
+    def bulk_create(self, model, objs):
+        return model.objects.bulk_create(objs, batch_size=self.batch_size)
+
+    def generate(self):
+        t_start = time.time()
+        self.org = Organization.objects.create(name=f'benchmark-{self.tag}')
+        with tmp_to_org(self.org), transaction.atomic():
+            nodes = self.generate_nodes()
+            system_users = self.generate_system_users()
+            assets = self.generate_assets(nodes)
+            users = self.generate_users()
+            groups = self.generate_groups(users)
+            self.generate_perms(nodes, assets, users, groups, system_users)
+        with tmp_to_org(self.org):
+            recount_nodes_assets_amount([node.id for node in nodes])
+        logger.info(f'Generate benchmark org {self.org}: cost={time.time() - t_start} {self.params}')
+        return self.org
+
+    def generate_nodes(self):
+        root = Node.org_root()
+        nodes = [root]
+        parents = [root]
+        for __ in range(self.depth):
+            children = []
+            for parent in parents:
+                for i in range(1, self.fanout + 1):
+                    key = f'{parent.key}:{i}'
+                    children.append(Node(
+                        key=key, value=f'node-{key}', parent_key=parent.key,
+                        org_id=self.org.id
+                    ))
+            self.bulk_create(Node, children)
+            Node.objects.filter(id__in=[p.id for p in parents]).update(child_mark=self.fanout)
+            nodes.extend(children)
+            parents = children
+
+        key_id_mapper = {node.key: node.id for node in nodes}
+        ancestries = []
+        for node in nodes:
+            if node is root:
+                continue
+            ancestor_keys = Node.get_node_ancestor_keys(node.key, with_self=True)
+            for depth, key in enumerate(ancestor_keys):
+                if key in key_id_mapper:
+                    ancestries.append(NodeAncestry(
+                        ancestor_id=key_id_mapper[key], descendant_id=node.id, depth=depth
+                    ))
+        self.bulk_create(NodeAncestry, ancestries)
+        return nodes
+
+    def generate_system_users(self):
+        system_users = [
+            SystemUser(name=f'{protocol}-{self.tag}', username='root', protocol=protocol, org_id=self.org.id)
+            for protocol in (SystemUser.Protocol.ssh, SystemUser.Protocol.rdp)
+        ]
+        return self.bulk_create(SystemUser, system_users)
+
+    def generate_assets(self, nodes):
+        leaf_nodes = [node for node in nodes if node.key.count(':') == self.depth] or nodes
+        assets = [
+            Asset(hostname=f'asset-{self.tag}-{i}', ip=f'10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}',
+                  protocols='ssh/22 rdp/3389', org_id=self.org.id)
+            for i in range(self.assets_amount)
+        ]
+        self.bulk_create(Asset, assets)
+        relations = [
+            Asset.nodes.through(asset_id=asset.id, node_id=self.random.choice(leaf_nodes).id)
+            for asset in assets
+        ]
+        self.bulk_create(Asset.nodes.through, relations)
+        return assets
+
+    def generate_users(self):
+        users = [
+            User(username=f'benchmark-{self.tag}-{i}', name=f'benchmark-{self.tag}-{i}',
+                 email=f'benchmark-{self.tag}-{i}@example.com', password='!')
+            for i in range(self.users_amount)
+        ]
+        self.bulk_create(User, users)
+        members = [OrganizationMember(org=self.org, user=user) for user in users]
+        self.bulk_create(OrganizationMember, members)
+        return users
+
+    def generate_groups(self, users):
+        groups = [
+            UserGroup(name=f'group-{self.tag}-{i}', org_id=self.org.id)
+            for i in range(self.groups_amount)
+        ]
+        self.bulk_create(UserGroup, groups)
+        relations = []
+        for group in groups:
+            for user in self.sample(users, self.users_per_group):
+                relations.append(User.groups.through(user_id=user.id, usergroup_id=group.id))
+        self.bulk_create(User.groups.through, relations)
+        return groups
+
+    def generate_perms(self, nodes, assets, users, groups, system_users):
+        perms = [
+            AssetPermission(name=f'perm-{self.tag}-{i}', actions=Action.ALL, org_id=self.org.id)
+            for i in range(self.perms_amount)
+        ]
+        self.bulk_create(AssetPermission, perms)
+
+        model = AssetPermission
+        user_rels, group_rels, node_rels, asset_rels, su_rels = [], [], [], [], []
+        for perm in perms:
+            for user in self.sample(users, self.subjects_per_perm // 2):
+                user_rels.append(model.users.through(assetpermission_id=perm.id, user_id=user.id))
+            for group in self.sample(groups, max(1, self.subjects_per_perm // 10)):
+                group_rels.append(model.user_groups.through(assetpermission_id=perm.id, usergroup_id=group.id))
+            if self.random.random() < self.node_grant_ratio:
+                for node in self.sample(nodes[1:] or nodes, self.targets_per_perm):
+                    node_rels.append(model.nodes.through(assetpermission_id=perm.id, node_id=node.id))
+            else:
+                for asset in self.sample(assets, self.targets_per_perm):
+                    asset_rels.append(model.assets.through(assetpermission_id=perm.id, asset_id=asset.id))
+            for system_user in system_users:
+                su_rels.append(model.system_users.through(assetpermission_id=perm.id, systemuser_id=system_user.id))
+
+        self.bulk_create(model.users.through, user_rels)
+        self.bulk_create(model.user_groups.through, group_rels)
+        self.bulk_create(model.nodes.through, node_rels)
+        self.bulk_create(model.assets.through, asset_rels)
+        self.bulk_create(model.system_users.through, su_rels)
+        return perms
+
+    def sample(self, population, k):
+        return self.random.sample(population, min(k, len(population)))
+
+    def cleanup(self):
+        if not self.org:
+            return
+        with tmp_to_org(self.org):
+            AssetPermission.objects.all().delete()
+            Asset.objects.all().delete()
+            Node.objects.all().delete()
+            UserGroup.objects.all().delete()
+            SystemUser.objects.all().delete()
+        User.objects.filter(username__startswith=f'benchmark-{self.tag}-').delete()
+        self.org.delete()
+
+
+class PermsBenchmark:
+    """
+    对权限相关的热点路径计时并统计内存峰值
+
+    每一项分别统计冷启动(先清除节点资产映射和授权树缓存)和缓存已经预热的耗时，
+    各重复多次取最小、中位数和最大值；内存峰值在单独的一次冷启动中用 tracemalloc 统计，
+    不影响计时
+    """
+
+    def __init__(self, org, repeat=3, sample_size=20, seed=0):
+        self.org = org
+        self.repeat = repeat
+        self.sample_size = sample_size
+        self.random = random.Random(seed)
+        self.results = {}
+
+    def reset_caches(self):
+        org_id = str(self.org.id)
+        Node.expire_node_all_asset_ids_mapping_from_memory(org_id)
+        Node.expire_node_all_asset_ids_mapping_from_cache(org_id)
+        UserGrantedTreeRefreshController.clean_org_tree_built_mark(org_id)
+
+    @staticmethod
+    def timeit(func):
+        t_start = time.perf_counter()
+        func()
+        return time.perf_counter() - t_start
+
+    @staticmethod
+    def stats(costs):
+        return {'min': min(costs), 'median': statistics.median(costs), 'max': max(costs)}
+
+    def measure(self, name, func):
+        cold_costs = []
+        for __ in range(self.repeat):
+            self.reset_caches()
+            cold_costs.append(self.timeit(func))
+
+        # 上面最后一次执行之后缓存已经是热的
+        warm_costs = [self.timeit(func) for __ in range(self.repeat)]
+
+        self.reset_caches()
+        tracemalloc.start()
+        try:
+            func()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        self.results[name] = {
+            'cold': self.stats(cold_costs), 'warm': self.stats(warm_costs),
+            'peak_memory_bytes': peak, 'repeat': self.repeat,
+        }
+        logger.info(f'Benchmark {name}: {self.results[name]}')
+
+    def sample_users(self):
+        users = list(self.org.members.all()[:self.sample_size * 10])
+        return self.random.sample(users, min(self.sample_size, len(users)))
+
+    def run(self):
+        org_id = str(self.org.id)
+        users = self.sample_users()
+        with tmp_to_org(self.org):
+            node_ids = list(Node.objects.values_list('id', flat=True))
+            assets = list(Asset.objects.all()[:self.sample_size * 10])
+            assets = self.random.sample(assets, min(self.sample_size, len(assets)))
+            system_user = SystemUser.objects.filter(protocol=SystemUser.Protocol.ssh).first()
+
+            self.measure('generate_node_all_asset_ids_mapping',
+                         lambda: PermNode.generate_node_all_asset_ids_mapping(org_id))
+            self.measure('compute_nodes_assets_amount',
+                         lambda: compute_nodes_assets_amount(node_ids))
+
+            def rebuild_user_granted_tree():
+                for user in users:
+                    UserGrantedTreeBuildUtils(user).rebuild_user_granted_tree()
+            self.measure('rebuild_user_granted_tree', rebuild_user_granted_tree)
+
+            def compute_node_assets_amount():
+                for user in users:
+                    utils = UserGrantedTreeBuildUtils(user)
+                    utils.compute_node_assets_amount(utils.compute_perm_nodes_tree())
+            self.measure('compute_node_assets_amount', compute_node_assets_amount)
+
+            def _validate_permission():
+                for user in users:
+                    for asset in assets:
+                        validate_permission(user, asset, system_user, 'connect')
+            self.measure('validate_permission', _validate_permission)
+
+        self.measure_tree_apis(users)
+        return self.results
+
+    def measure_tree_apis(self, users):
+        factory = APIRequestFactory()
+        views = {
+            'api.nodes_as_tree': (api.MyGrantedNodesAsTreeApi, '/api/v1/perms/users/nodes/tree/'),
+            'api.nodes_with_assets_as_tree': (
+                api.MyGrantedNodesWithAssetsAsTreeApi, '/api/v1/perms/users/nodes-with-assets/tree/'
+            ),
+            'api.node_children_with_assets_as_tree': (
+                api.MyGrantedNodeChildrenWithAssetsAsTreeApi,
+                '/api/v1/perms/users/nodes/children-with-assets/tree/'
+            ),
+        }
+        for name, (view_cls, path) in views.items():
+            view = view_cls.as_view()
+
+            def request_tree():
+                for user in users:
+                    request = factory.get(path)
+                    force_authenticate(request, user=user)
+                    response = view(request)
+                    response.render()
+            self.measure(name, request_tree)
+
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+class Command(BaseCommand):
+    help = 'Benchmark permission engine with a synthetic organization'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--depth', type=int, default=3, help='Node tree depth')
+        parser.add_argument('--fanout', type=int, default=10, help='Children of every node')
+        parser.add_argument('--assets', type=int, default=10000)
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--groups', type=int, default=50)
+        parser.add_argument('--perms', type=int, default=200)
+        parser.add_argument('--node-grant-ratio', type=float, default=0.5,
+                            help='Ratio of permissions granting nodes, others grant assets')
+        parser.add_argument('--repeat', type=int, default=3)
+        parser.add_argument('--sample', type=int, default=20, help='Users and assets sampled per item')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--org', type=str, default='', help='Benchmark an existing org instead')
+        parser.add_argument('--yes-i-know', action='store_true',
+                            help='Allow --org on a non benchmark org, its caches and users tree will be rebuilt')
+        parser.add_argument('--keep', action='store_true', help='Keep the generated org')
+        parser.add_argument('-o', '--output', type=str, default='', help='JSON result file')
+
+    def handle(self, *args, **options):
+        generator = None
+        if options['org']:
+            org = Organization.objects.get(id=options['org'])
+            # 冷启动会清除组织的节点资产映射和授权树缓存，并重建真实用户的授权树
+            if not org.name.startswith('benchmark-') and not options['yes_i_know']:
+                raise CommandError(
+                    f'Org {org.name} is not a benchmark org, cold runs will expire its caches '
+                    f'and rebuild users tree, pass --yes-i-know to continue'
+                )
+            params = {'org': str(org.id)}
+        else:
+            generator = SyntheticOrgGenerator(
+                depth=options['depth'], fanout=options['fanout'], assets=options['assets'],
+                users=options['users'], groups=options['groups'], perms=options['perms'],
+                node_grant_ratio=options['node_grant_ratio'], seed=options['seed'],
+            )
+            params = generator.params
+
+        try:
+            if generator:
+                org = generator.generate()
+            benchmark = PermsBenchmark(
+                org, repeat=options['repeat'], sample_size=options['sample'], seed=options['seed']
+            )
+            results = benchmark.run()
+        finally:
+            if generator and not options['keep']:
+                generator.cleanup()
+
+        data = {
+            'commit': get_git_commit(),
+            'timestamp': int(time.time()),
+            'params': params,
+            'repeat': options['repeat'],
+            'sample': options['sample'],
+            'results': results,
+        }
+        output = options['output'] or os.path.join(
+            settings.PROJECT_DIR, 'data', 'benchmark', f'perms-{data["timestamp"]}.json'
+        )
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        with open(output, 'w') as f:
+            json.dump(data, f, indent=2)
+        self.stdout.write(json.dumps(results, indent=2))
+        self.stdout.write(self.style.SUCCESS(f'Benchmark result saved to {output}'))
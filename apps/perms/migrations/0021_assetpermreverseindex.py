@@ -0,0 +1,29 @@
+# Generated by Django 3.1.12 on 2021-09-23 11:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('assets', '0077_nodeancestry'),
+        ('perms', '0020_auto_20210910_1103'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AssetPermReverseIndex',
+            fields=[
+                ('org_id', models.CharField(blank=True, db_index=True, default='', max_length=36, verbose_name='Organization')),
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('asset', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='perm_reverse_index_rels', to='assets.asset')),
+                ('assetpermission', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='asset_reverse_index_rels', to='perms.assetpermission')),
+            ],
+            options={
+                'verbose_name': 'Asset permission reverse index',
+                'unique_together': {('asset', 'assetpermission')},
+                'index_together': {('assetpermission', 'asset')},
+            },
+        ),
+    ]
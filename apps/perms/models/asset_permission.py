@@ -15,6 +15,7 @@ from .base import BasePermission
 
 __all__ = [
     'AssetPermission', 'Action', 'PermNode', 'UserAssetGrantedTreeNodeRelation',
+    'AssetPermReverseIndex',
 ]
 
 # 使用场景
@@ -199,6 +200,31 @@ class UserAssetGrantedTreeNodeRelation(OrgModelMixin, FamilyMixin, models.JMSBas
         return '', None
 
 
+class AssetPermReverseIndex(OrgModelMixin, models.Model):
+    """
+    资产到授权规则的反向索引，包含直接授权和通过节点（含祖先节点）授权的资产
+
+    不考虑授权规则是否有效，查询时再过滤
+    """
+    id = models.BigAutoField(primary_key=True)
+    asset = models.ForeignKey(
+        'assets.Asset', db_constraint=False, on_delete=models.CASCADE,
+        related_name='perm_reverse_index_rels'
+    )
+    assetpermission = models.ForeignKey(
+        'perms.AssetPermission', db_constraint=False, on_delete=models.CASCADE,
+        related_name='asset_reverse_index_rels'
+    )
+
+    class Meta:
+        verbose_name = _('Asset permission reverse index')
+        unique_together = [('asset', 'assetpermission')]
+        index_together = [('assetpermission', 'asset')]
+
+    def __str__(self):
+        return f'{self.asset_id} <- {self.assetpermission_id}'
+
+
 class PermNode(Node):
     class Meta:
         proxy = True
@@ -12,6 +12,7 @@ __all__ = [
     'NodeGrantedSerializer',
     'AssetGrantedSerializer',
     'ActionsSerializer', 'AssetSystemUserSerializer',
+    'ValidateAssetPermissionItemSerializer',
     'RemoteAppSystemUserSerializer',
     'DatabaseAppSystemUserSerializer',
     'K8sAppSystemUserSerializer',
@@ -66,6 +67,16 @@ class ActionsSerializer(serializers.Serializer):
     actions = ActionsField(read_only=True)
 
 
+class ValidateAssetPermissionItemSerializer(serializers.Serializer):
+    """
+    批量校验连接权限的一项
+    """
+    user_id = serializers.UUIDField()
+    asset_id = serializers.UUIDField()
+    system_user_id = serializers.UUIDField()
+    action_name = serializers.CharField(max_length=32)
+
+
 # TODO: 删除
 class RemoteAppSystemUserSerializer(serializers.ModelSerializer):
     class Meta:
@@ -1,6 +1,6 @@
 import itertools
 
-from django.db.models.signals import m2m_changed
+from django.db.models.signals import m2m_changed, pre_delete, pre_save
 from django.dispatch import receiver
 
 from users.models import User, UserGroup
@@ -9,8 +9,9 @@ from applications.models import Application
 from common.utils import get_logger
 from common.exceptions import M2MReverseNotAllowed
 from common.decorator import on_transaction_commit
-from common.const.signals import POST_ADD
+from common.const.signals import POST_ADD, POST_REMOVE, POST_CLEAR, PRE_CLEAR
 from perms.models import ApplicationPermission
+from perms.utils.application.user_permission import UserGrantedApplicationsCache
 from applications.models import Account as AppAccount
 
 
@@ -102,3 +103,94 @@ def on_app_permission_user_groups_changed(sender, instance, action, reverse, pk_
     logger.debug("Application permission user groups change signal received")
     groups = UserGroup.objects.filter(pk__in=pk_set)
     set_remote_app_asset_system_users_if_need(instance, groups=groups)
+
+
+# 用户授权应用索引的失效
+# ----------------------------------------------------------------
+
+@receiver(pre_delete, sender=ApplicationPermission)
+def on_app_permission_pre_delete(sender, instance, **kwargs):
+    # 删除之前查出所有相关用户
+    UserGrantedApplicationsCache.expire_by_app_perm_ids([instance.id])
+
+
+@receiver(pre_save, sender=ApplicationPermission)
+def on_app_permission_pre_save(sender, instance, **kwargs):
+    old = ApplicationPermission.objects.filter(id=instance.id)\
+        .values('is_active', 'date_start', 'date_expired').first()
+    if not old:
+        return
+    new = {
+        'is_active': instance.is_active,
+        'date_start': instance.date_start,
+        'date_expired': instance.date_expired
+    }
+    if old != new:
+        UserGrantedApplicationsCache.expire_by_app_perm_ids([instance.id])
+
+
+@receiver(m2m_changed, sender=ApplicationPermission.users.through)
+def on_app_permission_users_changed_expire_index(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse:
+        raise M2MReverseNotAllowed
+    if action in (POST_ADD, POST_REMOVE):
+        UserGrantedApplicationsCache.expire_by_user_ids(pk_set)
+    elif action == PRE_CLEAR:
+        UserGrantedApplicationsCache.expire_by_app_perm_ids([instance.id])
+
+
+@receiver(m2m_changed, sender=ApplicationPermission.user_groups.through)
+def on_app_permission_user_groups_changed_expire_index(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse:
+        raise M2MReverseNotAllowed
+    if action in (POST_ADD, POST_REMOVE):
+        UserGrantedApplicationsCache.expire_by_group_ids(pk_set)
+    elif action == PRE_CLEAR:
+        UserGrantedApplicationsCache.expire_by_app_perm_ids([instance.id])
+
+
+@receiver(m2m_changed, sender=ApplicationPermission.applications.through)
+@receiver(m2m_changed, sender=ApplicationPermission.system_users.through)
+def on_app_permission_resources_changed_expire_index(sender, instance, action, reverse, **kwargs):
+    if reverse:
+        raise M2MReverseNotAllowed
+    if action not in (POST_ADD, POST_REMOVE, POST_CLEAR):
+        return
+    UserGrantedApplicationsCache.expire_by_app_perm_ids([instance.id])
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def on_user_groups_change_expire_app_index(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == PRE_CLEAR:
+        # `clear` 的 post 信号没有 pk_set，先记下被清除的关系
+        if reverse:
+            pk_set = set(instance.users.all().values_list('id', flat=True))
+        else:
+            pk_set = set(instance.groups.all().values_list('id', flat=True))
+        instance._app_index_cleared_pk_set = pk_set
+        return
+    if action == POST_CLEAR:
+        pk_set = getattr(instance, '_app_index_cleared_pk_set', None)
+    elif action not in (POST_ADD, POST_REMOVE):
+        return
+    if not pk_set:
+        return
+    if reverse:
+        group_ids = [instance.id]
+        user_ids = pk_set
+    else:
+        group_ids = pk_set
+        user_ids = [instance.id]
+
+    exists = ApplicationPermission.user_groups.through.objects.filter(usergroup_id__in=group_ids).exists()
+    if not exists:
+        return
+    UserGrantedApplicationsCache.expire_by_user_ids(user_ids)
+
+
+@receiver(pre_delete, sender=UserGroup)
+def on_user_group_delete_expire_app_index(sender, instance, **kwargs):
+    exists = ApplicationPermission.user_groups.through.objects.filter(usergroup_id=instance.id).exists()
+    if not exists:
+        return
+    UserGrantedApplicationsCache.expire_by_group_ids([instance.id])
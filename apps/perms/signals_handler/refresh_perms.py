@@ -1,16 +1,20 @@
 # -*- coding: utf-8 -*-
 #
-from django.db.models.signals import m2m_changed, pre_delete, pre_save, post_save
+from django.db.models.signals import m2m_changed, pre_delete, pre_save, post_save, post_delete
 from django.dispatch import receiver
 
 from users.models import User, UserGroup
-from assets.models import Asset
-from orgs.utils import current_org, tmp_to_org
+from assets.models import Asset, Node, FavoriteAsset
+from orgs.utils import tmp_to_org
 from common.utils import get_logger
 from common.exceptions import M2MReverseNotAllowed
 from common.const.signals import POST_ADD, POST_REMOVE, POST_CLEAR
 from perms.models import AssetPermission
-from perms.utils.asset.user_permission import UserGrantedTreeRefreshController
+from perms.utils.asset.user_permission import (
+    UserGrantedTreeRefreshController, UserGrantedTreeRefreshAccumulator,
+    AssetPermissionBoundarySchedule
+)
+from perms.utils.asset.reverse_index import AssetPermReverseIndexUtil
 
 
 logger = get_logger(__file__)
@@ -24,7 +28,7 @@ def on_user_group_delete(sender, instance: UserGroup, using, **kwargs):
 
     org_id = instance.org_id
     user_ids = UserGroup.users.through.objects.filter(usergroup_id=instance.id).values_list('user_id', flat=True)
-    UserGrantedTreeRefreshController.add_need_refresh_orgs_for_users([org_id], list(user_ids))
+    UserGrantedTreeRefreshAccumulator.add_user_ids(org_id, list(user_ids))
 
 
 @receiver(m2m_changed, sender=User.groups.through)
@@ -45,15 +49,15 @@ def on_user_groups_change(sender, instance, action, reverse, pk_set, **kwargs):
     if not exists:
         return
 
-    org_ids = [org_id]
-    UserGrantedTreeRefreshController.add_need_refresh_orgs_for_users(org_ids, user_ids)
+    UserGrantedTreeRefreshAccumulator.add_user_ids(org_id, user_ids)
 
 
 @receiver([pre_delete], sender=AssetPermission)
 def on_asset_perm_pre_delete(sender, instance, **kwargs):
     # 授权删除之前，查出所有相关用户
     with tmp_to_org(instance.org):
-        UserGrantedTreeRefreshController.add_need_refresh_by_asset_perm_ids([instance.id])
+        user_ids = UserGrantedTreeRefreshController.get_user_ids_by_asset_perm_ids([instance.id])
+    UserGrantedTreeRefreshAccumulator.add_user_ids(instance.org_id, user_ids)
 
 
 @receiver([pre_save], sender=AssetPermission)
@@ -61,19 +65,32 @@ def on_asset_perm_pre_save(sender, instance, **kwargs):
     try:
         old = AssetPermission.objects.get(id=instance.id)
 
-        if old.is_valid != instance.is_valid:
-            with tmp_to_org(instance.org):
-                UserGrantedTreeRefreshController.add_need_refresh_by_asset_perm_ids([instance.id])
+        # 未生效或已过期的授权被禁用时 is_valid 不变，但到期后不应再生效
+        if (old.is_valid, old.is_active) != (instance.is_valid, instance.is_active):
+            UserGrantedTreeRefreshAccumulator.add_asset_perm_ids(instance.org_id, [instance.id])
+        elif (old.actions, old.date_start, old.date_expired) != \
+                (instance.actions, instance.date_start, instance.date_expired):
+            # 不影响授权树，只影响连接授权的判定
+            UserGrantedTreeRefreshAccumulator.add_decision_asset_perm_ids(instance.org_id, [instance.id])
     except AssetPermission.DoesNotExist:
         pass
 
 
+@receiver([post_save], sender=AssetPermission)
+def on_asset_perm_post_save_schedule_boundaries(sender, instance, **kwargs):
+    AssetPermissionBoundarySchedule.schedule(instance.id, instance.date_start, instance.date_expired)
+
+
+@receiver([post_delete], sender=AssetPermission)
+def on_asset_perm_post_delete(sender, instance, **kwargs):
+    AssetPermissionBoundarySchedule.unschedule(instance.id)
+
+
 @receiver([post_save], sender=AssetPermission)
 def on_asset_perm_post_save(sender, instance, created, **kwargs):
     if not created:
         return
-    with tmp_to_org(instance.org):
-        UserGrantedTreeRefreshController.add_need_refresh_by_asset_perm_ids([instance.id])
+    UserGrantedTreeRefreshAccumulator.add_asset_perm_ids(instance.org_id, [instance.id])
 
 
 def need_rebuild_mapping_node(action):
@@ -88,8 +105,7 @@ def on_permission_nodes_changed(sender, instance, action, reverse, **kwargs):
     if not need_rebuild_mapping_node(action):
         return
 
-    with tmp_to_org(instance.org):
-        UserGrantedTreeRefreshController.add_need_refresh_by_asset_perm_ids([instance.id])
+    UserGrantedTreeRefreshAccumulator.add_asset_perm_ids(instance.org_id, [instance.id])
 
 
 @receiver(m2m_changed, sender=AssetPermission.assets.through)
@@ -99,8 +115,17 @@ def on_permission_assets_changed(sender, instance, action, reverse, pk_set, mode
 
     if not need_rebuild_mapping_node(action):
         return
-    with tmp_to_org(instance.org):
-        UserGrantedTreeRefreshController.add_need_refresh_by_asset_perm_ids([instance.id])
+    UserGrantedTreeRefreshAccumulator.add_asset_perm_ids(instance.org_id, [instance.id])
+
+
+@receiver(m2m_changed, sender=AssetPermission.system_users.through)
+def on_permission_system_users_changed(sender, instance, action, reverse, **kwargs):
+    if reverse:
+        raise M2MReverseNotAllowed
+
+    if not need_rebuild_mapping_node(action):
+        return
+    UserGrantedTreeRefreshAccumulator.add_decision_asset_perm_ids(instance.org_id, [instance.id])
 
 
 @receiver(m2m_changed, sender=AssetPermission.users.through)
@@ -111,10 +136,7 @@ def on_asset_permission_users_changed(sender, action, reverse, instance, pk_set,
     if not need_rebuild_mapping_node(action):
         return
 
-    with tmp_to_org(instance.org):
-        UserGrantedTreeRefreshController.add_need_refresh_orgs_for_users(
-            [current_org.id], pk_set
-        )
+    UserGrantedTreeRefreshAccumulator.add_user_ids(instance.org_id, pk_set)
 
 
 @receiver(m2m_changed, sender=AssetPermission.user_groups.through)
@@ -125,13 +147,7 @@ def on_asset_permission_user_groups_changed(sender, instance, action, pk_set, re
     if not need_rebuild_mapping_node(action):
         return
 
-    user_ids = User.groups.through.objects.filter(usergroup_id__in=pk_set) \
-        .values_list('user_id', flat=True) \
-        .distinct()
-    with tmp_to_org(instance.org):
-        UserGrantedTreeRefreshController.add_need_refresh_orgs_for_users(
-            [current_org.id], user_ids
-        )
+    UserGrantedTreeRefreshAccumulator.add_user_group_ids(instance.org_id, pk_set)
 
 
 @receiver(m2m_changed, sender=Asset.nodes.through)
@@ -146,5 +162,33 @@ def on_node_asset_change(action, instance, reverse, pk_set, **kwargs):
         asset_pk_set = [instance.id]
         node_pk_set = pk_set
 
-    with tmp_to_org(instance.org):
-        UserGrantedTreeRefreshController.add_need_refresh_on_nodes_assets_relate_change(node_pk_set, asset_pk_set)
+    UserGrantedTreeRefreshAccumulator.add_nodes_assets(instance.org_id, node_pk_set, asset_pk_set)
+
+
+@receiver([post_save, post_delete], sender=Asset)
+@receiver([post_save, post_delete], sender=Node)
+def on_asset_or_node_content_change(sender, instance, **kwargs):
+    # 资产、节点属性的变化不影响授权树，但会使授权树接口的 ETag 失效
+    UserGrantedTreeRefreshController.incr_org_content_version(instance.org_id)
+
+
+@receiver(post_save, sender=Node)
+def on_node_key_change(sender, instance, created, **kwargs):
+    # 节点移动后祖先节点变化，通过节点授权的资产都可能变化
+    loaded_key = getattr(instance, '_loaded_key', None)
+    if created or loaded_key is None or loaded_key == instance.key:
+        return
+    UserGrantedTreeRefreshController.clean_org_tree_built_mark(instance.org_id)
+    AssetPermReverseIndexUtil.rebuild_org_async(instance.org_id)
+
+
+@receiver(post_delete, sender=Node)
+def on_node_delete(sender, instance, **kwargs):
+    # 节点删除时资产关系被级联删除，没有 m2m 信号
+    UserGrantedTreeRefreshController.clean_org_tree_built_mark(instance.org_id)
+    AssetPermReverseIndexUtil.rebuild_org_async(instance.org_id)
+
+
+@receiver([post_save, post_delete], sender=FavoriteAsset)
+def on_favorite_asset_change(sender, instance, **kwargs):
+    UserGrantedTreeRefreshController.incr_tree_versions([instance.user_id])
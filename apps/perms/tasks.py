@@ -8,8 +8,14 @@ from celery import shared_task
 from common.utils import get_logger
 from common.utils.timezone import now, dt_formater, dt_parser
 from ops.celery.decorator import register_as_period_task
+from orgs.utils import tmp_to_org
 from perms.models import AssetPermission
-from perms.utils.asset.user_permission import UserGrantedTreeRefreshController
+from perms.utils.asset.user_permission import (
+    UserGrantedTreeRefreshController, AssetPermissionBoundarySchedule, UserAssetSystemUsersMap
+)
+from perms.utils.asset.batch_user_permission import UserGrantedTreeBatchBuildUtils
+from perms.utils.asset.reverse_index import AssetPermReverseIndexUtil
+from perms.utils.asset.access_report import AssetAccessReport, clean_expired_access_reports
 
 logger = get_logger(__file__)
 
@@ -20,9 +26,16 @@ logger = get_logger(__file__)
 def check_asset_permission_expired():
     """
     这里的任务要足够短，不要影响周期任务
+
+    时间表已经加载时，过期由 `check_asset_permission_boundaries` 处理，这里直接跳过；
+    周期任务保存在数据库中，所以保留注册，只在时间表不可用时兜底
     """
     from settings.models import Setting
 
+    if AssetPermissionBoundarySchedule.is_seeded():
+        logger.debug('Asset permission boundaries seeded, skip expired check')
+        return
+
     setting_name = 'last_asset_perm_expired_check'
 
     end = now()
@@ -45,3 +58,96 @@ def check_asset_permission_expired():
     asset_perm_ids = list(asset_perm_ids)
     logger.info(f'>>> checking {start} to {end} have {asset_perm_ids} expired')
     UserGrantedTreeRefreshController.add_need_refresh_by_asset_perm_ids_cross_orgs(asset_perm_ids)
+
+
+@register_as_period_task(interval=settings.PERM_BOUNDARY_CHECK_INTERVAL)
+@shared_task()
+def check_asset_permission_boundaries():
+    """
+    授权规则到达开始或过期时间时，刷新相关用户的授权树
+    """
+    AssetPermissionBoundarySchedule.refresh_due_perms()
+
+
+@shared_task()
+def rebuild_users_granted_tree_in_batch(org_id, user_ids, tree_versions=None):
+    """
+    一个组织里大量用户需要重建授权树时，共用一份节点和资产的快照批量计算
+
+    :param tree_versions: 提交任务时用户的树版本，版本已经变化的用户已经自己重建过，跳过
+    """
+    all_user_ids = list(user_ids)
+    controller = UserGrantedTreeRefreshController
+    client = controller.get_redis_client()
+    try:
+        current_versions = controller.get_tree_versions(client, all_user_ids)
+        if tree_versions is None:
+            user_ids = all_user_ids
+        else:
+            user_ids = [
+                user_id for user_id in all_user_ids
+                if current_versions.get(user_id) == tree_versions.get(user_id)
+            ]
+        logger.info(f'Batch rebuild user tree: org={org_id} users={len(user_ids)} '
+                    f'skipped={len(all_user_ids) - len(user_ids)}')
+        if not user_ids:
+            return
+
+        epochs = controller.get_epochs(client, [org_id])
+        # 重建时每个用户的树版本加一，提交后版本不一致说明期间又有变更
+        expected_versions = {user_id: current_versions[user_id] + 1 for user_id in user_ids}
+        with tmp_to_org(org_id):
+            UserGrantedTreeBatchBuildUtils(user_ids).rebuild()
+        controller.set_org_as_built_for_users(
+            org_id, user_ids, epochs=epochs, tree_versions=expected_versions
+        )
+    finally:
+        controller.remove_batch_pending_users(org_id, all_user_ids)
+
+
+@shared_task()
+def build_user_asset_system_users_map(user_id, org_id):
+    """
+    重建用户在一个组织内的 资产 -> 系统用户 映射
+    """
+    from users.models import User
+
+    user = User.objects.filter(id=user_id).first()
+    if not user:
+        return
+    UserAssetSystemUsersMap(user, org_id).build()
+
+
+@shared_task()
+def rebuild_asset_perm_reverse_index(org_id, perm_ids=None):
+    """
+    重建资产到授权规则的反向索引，没有指定授权规则时重建整个组织
+    """
+    util = AssetPermReverseIndexUtil(org_id)
+    if perm_ids is None:
+        util.rebuild()
+    else:
+        util.rebuild_perms(perm_ids)
+
+
+@shared_task(bind=True)
+def generate_asset_access_report(self, file_format='csv'):
+    """
+    生成所有组织的有效访问矩阵报表，进度保存在任务的状态中
+    """
+    def update_progress(progress):
+        self.update_state(state='PROGRESS', meta=progress)
+
+    report = AssetAccessReport(self.request.id, file_format, progress_callback=update_progress)
+    return report.generate()
+
+
+@register_as_period_task(interval=3600 * 24)
+@shared_task()
+def clean_expired_asset_access_reports():
+    """
+    清理过期的访问矩阵报表
+    """
+    keep_days = settings.PERM_ACCESS_REPORT_KEEP_DAYS
+    deleted = clean_expired_access_reports(keep_days)
+    logger.info(f'Clean expired asset access reports: keep_days={keep_days} deleted={deleted}')
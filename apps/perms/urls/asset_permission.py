@@ -98,10 +98,17 @@ permission_urlpatterns = [
 
     # 验证用户是否有某个资产和系统用户的权限
     path('user/validate/', api.ValidateUserAssetPermissionApi.as_view(), name='validate-user-asset-permission'),
+    path('user/validate/batch/', api.ValidateUserAssetPermissionInBatchApi.as_view(), name='validate-user-asset-permission-in-batch'),
     path('user/actions/', api.GetUserAssetPermissionActionsApi.as_view(), name='get-user-asset-permission-actions'),
 
+    # 资产可以被哪些用户、用户组通过哪些系统用户登录
+    path('assets/granted-subjects/', api.AssetGrantedSubjectsApi.as_view(), name='asset-granted-subjects'),
+    path('assets/granted-subjects/export/', api.AssetGrantedSubjectsExportApi.as_view(), name='asset-granted-subjects-export'),
+    path('access-report/', api.AssetAccessReportApi.as_view(), name='asset-access-report'),
+
     # 刷新缓存
     path('cache/refresh/', api.RefreshAssetPermissionCacheApi.as_view(), name='refresh-asset-permission-cache'),
+    path('decision-cache/stats/', api.AssetPermissionDecisionCacheStatsApi.as_view(), name='asset-permission-decision-cache-stats'),
 ]
 
 asset_permission_urlpatterns = [
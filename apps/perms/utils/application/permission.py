@@ -1,9 +1,6 @@
-import time
-
-from django.db.models import Q
-
 from common.utils import get_logger
 from perms.models import ApplicationPermission
+from perms.utils.application.user_permission import UserGrantedApplicationsCache
 
 logger = get_logger(__file__)
 
@@ -34,39 +31,13 @@ def get_user_all_app_perm_ids(user) -> set:
 
 
 def validate_permission(user, application, system_user):
-    app_perm_ids = get_user_all_app_perm_ids(user)
-    app_perm_ids = ApplicationPermission.applications.through.objects.filter(
-        applicationpermission_id__in=app_perm_ids,
-        application_id=application.id
-    ).values_list('applicationpermission_id', flat=True)
-
-    app_perm_ids = set(app_perm_ids)
-
-    app_perm_ids = ApplicationPermission.system_users.through.objects.filter(
-        applicationpermission_id__in=app_perm_ids,
-        systemuser_id=system_user.id
-    ).values_list('applicationpermission_id', flat=True)
-
-    app_perm_ids = set(app_perm_ids)
-
-    app_perm = ApplicationPermission.objects.filter(
-        id__in=app_perm_ids
-    ).order_by('-date_expired').first()
-
-    app_perm: ApplicationPermission
-    if app_perm:
-        return True, app_perm.date_expired.timestamp()
-    else:
-        return False, time.time()
+    cache = UserGrantedApplicationsCache(user)
+    return cache.validate_permission(application.id, system_user.id)
 
 
 def get_application_system_user_ids(user, application):
-    queryset = ApplicationPermission.objects.valid()\
-        .filter(
-            Q(users=user) | Q(user_groups__users=user),
-            Q(applications=application)
-        ).values_list('system_users', flat=True)
-    return queryset
+    cache = UserGrantedApplicationsCache(user)
+    return cache.get_application_system_user_ids(application.id)
 
 
 def has_application_system_permission(user, application, system_user):
@@ -1,6 +1,19 @@
+from collections import defaultdict
+import json
+import time
+import uuid
+
+from django.core.cache import cache
 from django.db.models import Q
+
+from common.decorator import on_transaction_commit
+from common.utils import get_logger
+from orgs.utils import current_org, tmp_to_root_org
 from perms.models import ApplicationPermission
 from applications.models import Application
+from users.models import User
+
+logger = get_logger(__file__)
 
 
 def get_user_all_applicationpermission_ids(user):
@@ -11,8 +24,150 @@ def get_user_all_applicationpermission_ids(user):
 
 
 def get_user_granted_all_applications(user):
-    application_perm_ids = get_user_all_applicationpermission_ids(user)
-    applications = Application.objects.filter(
-        granted_by_permissions__id__in=application_perm_ids
-    ).distinct()
+    application_ids = UserGrantedApplicationsCache(user).get_granted_application_ids()
+    applications = Application.objects.filter(id__in=application_ids)
     return applications
+
+
+class UserGrantedApplicationsCache:
+    """
+    用户授权应用的索引，缓存在 redis 中，相当于资产的授权树
+
+    {app_id: [[system_user_id, org_id, date_start, date_expired], ]}
+
+    没有系统用户的授权规则也会授权应用，system_user_id 为 None，由调用方按系统用户过滤
+
+    只包含激活的授权规则，有效期在读取时按当前时间过滤；
+    授权规则或其关系变化时递增用户的版本号，版本号不一致的索引会被重建
+    """
+    key_template = 'perms.user.app.granted.user_id:{user_id}'
+    version_key_template = 'perms.user.app.granted.version.user_id:{user_id}'
+    ttl = 3600 * 24
+
+    def __init__(self, user):
+        self.user = user
+        self.key = self.key_template.format(user_id=user.id)
+        self.version_key = self.version_key_template.format(user_id=user.id)
+        self.client = self.get_redis_client()
+
+    @classmethod
+    def get_redis_client(cls):
+        return cache.client.get_client(write=True)
+
+    def compute_index(self) -> dict:
+        with tmp_to_root_org():
+            perm_ids = set(ApplicationPermission.users.through.objects.filter(
+                user_id=self.user.id
+            ).values_list('applicationpermission_id', flat=True))
+            group_ids = User.groups.through.objects.filter(
+                user_id=self.user.id
+            ).values_list('usergroup_id', flat=True)
+            perm_ids.update(ApplicationPermission.user_groups.through.objects.filter(
+                usergroup_id__in=list(group_ids)
+            ).values_list('applicationpermission_id', flat=True))
+
+            perms = ApplicationPermission.objects.filter(
+                id__in=perm_ids
+            ).active().values_list('id', 'org_id', 'date_start', 'date_expired')
+            perms = {
+                perm_id: (org_id, date_start.timestamp(), date_expired.timestamp())
+                for perm_id, org_id, date_start, date_expired in perms
+            }
+
+        perm_system_user_ids = defaultdict(set)
+        pairs = ApplicationPermission.system_users.through.objects.filter(
+            applicationpermission_id__in=perms.keys()
+        ).values_list('applicationpermission_id', 'systemuser_id')
+        for perm_id, system_user_id in pairs:
+            perm_system_user_ids[perm_id].add(str(system_user_id))
+
+        index = defaultdict(list)
+        pairs = ApplicationPermission.applications.through.objects.filter(
+            applicationpermission_id__in=perms.keys()
+        ).values_list('applicationpermission_id', 'application_id')
+        for perm_id, app_id in pairs:
+            org_id, date_start, date_expired = perms[perm_id]
+            system_user_ids = perm_system_user_ids[perm_id] or [None]
+            for system_user_id in system_user_ids:
+                index[str(app_id)].append([system_user_id, org_id, date_start, date_expired])
+        return index
+
+    def get_index(self) -> dict:
+        # 先读版本号再查询，查询期间有变化时写入的索引会因为版本号旧而被丢弃
+        with self.client.pipeline() as p:
+            p.get(self.version_key)
+            p.get(self.key)
+            version, value = p.execute()
+        version = int(version or 0)
+        if value:
+            value = json.loads(value)
+            if value['version'] == version:
+                return value['apps']
+
+        logger.debug(f'Rebuild user granted applications index: user={self.user}')
+        index = self.compute_index()
+        value = json.dumps({'version': version, 'apps': index})
+        self.client.set(self.key, value, ex=self.ttl)
+        return index
+
+    @staticmethod
+    def filter_valid_entries(entries):
+        now = time.time()
+        org_id = None if (not current_org or current_org.is_root()) else str(current_org.id)
+        return [
+            entry for entry in entries
+            if entry[2] < now < entry[3] and (org_id is None or entry[1] == org_id)
+        ]
+
+    def get_granted_application_ids(self) -> set:
+        return {
+            uuid.UUID(app_id) for app_id, entries in self.get_index().items()
+            if self.filter_valid_entries(entries)
+        }
+
+    def get_application_system_user_ids(self, application_id) -> set:
+        entries = self.get_index().get(str(application_id), [])
+        return {uuid.UUID(entry[0]) for entry in self.filter_valid_entries(entries) if entry[0]}
+
+    def validate_permission(self, application_id, system_user_id):
+        """
+        :return: (has_permission, expire_at)
+        """
+        entries = self.get_index().get(str(application_id), [])
+        expire_ats = [
+            entry[3] for entry in self.filter_valid_entries(entries)
+            if entry[0] == str(system_user_id)
+        ]
+        if expire_ats:
+            return True, max(expire_ats)
+        return False, time.time()
+
+    @classmethod
+    @on_transaction_commit
+    def expire_by_user_ids(cls, user_ids):
+        client = cls.get_redis_client()
+        with client.pipeline() as p:
+            for user_id in user_ids:
+                p.incr(cls.version_key_template.format(user_id=user_id))
+            p.execute()
+        logger.debug(f'Expire user granted applications index: users={len(user_ids)}')
+
+    @classmethod
+    def expire_by_group_ids(cls, group_ids):
+        user_ids = User.groups.through.objects.filter(
+            usergroup_id__in=group_ids
+        ).values_list('user_id', flat=True)
+        cls.expire_by_user_ids(set(user_ids))
+
+    @classmethod
+    def expire_by_app_perm_ids(cls, app_perm_ids):
+        user_ids = set(ApplicationPermission.users.through.objects.filter(
+            applicationpermission_id__in=app_perm_ids
+        ).values_list('user_id', flat=True))
+        group_ids = ApplicationPermission.user_groups.through.objects.filter(
+            applicationpermission_id__in=app_perm_ids
+        ).values_list('usergroup_id', flat=True)
+        user_ids.update(User.groups.through.objects.filter(
+            usergroup_id__in=list(group_ids)
+        ).values_list('user_id', flat=True))
+        cls.expire_by_user_ids(user_ids)
@@ -1,2 +1,5 @@
 from .permission import *
 from .user_permission import *
+from .batch_user_permission import *
+from .reverse_index import *
+from .access_report import *
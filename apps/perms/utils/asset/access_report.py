@@ -0,0 +1,314 @@
+import csv
+import os
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.utils.translation import ugettext as _
+from openpyxl import Workbook
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+
+from common.utils import get_logger
+from common.utils.timezone import as_current_tz
+from orgs.models import Organization
+from orgs.utils import tmp_to_org
+from assets.models import Asset, SystemUser, ProtocolsMixin
+from assets.node_assets_index import CompactIdSet
+from perms.models import AssetPermission, PermNode, Action
+from users.models import User
+
+__all__ = ['AssetAccessReport', 'get_access_report_path', 'clean_expired_access_reports']
+
+logger = get_logger(__name__)
+
+# 报表包含所有组织的授权，不能放在 MEDIA_ROOT 等公开访问的目录，只通过 `AssetAccessReportApi` 下载
+REPORT_DIR = os.path.join(settings.PROJECT_DIR, 'data', 'perms', 'access_reports')
+
+
+def get_access_report_path(report_id, file_format):
+    return os.path.join(REPORT_DIR, f'{report_id}.{file_format}')
+
+
+def clean_expired_access_reports(keep_days):
+    """
+    删除超过保留天数的报表
+
+    :return: 删除的文件数
+    """
+    if not os.path.isdir(REPORT_DIR):
+        return 0
+    expired_at = time.time() - keep_days * 24 * 3600
+    deleted = 0
+    with os.scandir(REPORT_DIR) as entries:
+        for entry in entries:
+            if not entry.is_file() or entry.stat().st_mtime >= expired_at:
+                continue
+            try:
+                os.remove(entry.path)
+                deleted += 1
+            except OSError as e:
+                logger.error(f'Remove access report failed: {entry.path} {e}')
+    return deleted
+
+
+class CSVReportWriter:
+    def __init__(self, path):
+        self.f = open(path, 'w', encoding='utf-8-sig', newline='')
+        self.writer = csv.writer(self.f)
+
+    def write_rows(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.f.close()
+
+
+class XLSXReportWriter:
+    """
+    只写模式，行直接写入临时文件，内存不随行数增长；
+    超过单个 sheet 的行数上限时新建 sheet
+    """
+    max_rows_per_sheet = 1048576
+
+    def __init__(self, path, header):
+        self.path = path
+        self.header = header
+        self.workbook = Workbook(write_only=True)
+        self.sheet = None
+        self.sheet_rows = 0
+
+    def _new_sheet(self):
+        index = len(self.workbook.worksheets) + 1
+        self.sheet = self.workbook.create_sheet(title=f'Sheet{index}')
+        self.sheet.append(self.header)
+        self.sheet_rows = 1
+
+    @staticmethod
+    def _clean(value):
+        if isinstance(value, str):
+            return ILLEGAL_CHARACTERS_RE.sub('', value)
+        return value
+
+    def write_rows(self, rows):
+        for row in rows:
+            if self.sheet is None or self.sheet_rows >= self.max_rows_per_sheet:
+                self._new_sheet()
+            self.sheet.append([self._clean(v) for v in row])
+            self.sheet_rows += 1
+
+    def close(self):
+        self.workbook.save(self.path)
+
+
+class OrgAccessMatrix:
+    """
+    一个组织的 (用户, 资产, 系统用户, 动作, 过期时间) 矩阵
+
+    授权规则的资产由节点资产映射做集合运算得到，只保存每个授权规则的资产集合；
+    逐个用户合并其授权规则后输出，内存只和单个用户的授权范围有关
+    """
+
+    def __init__(self, org_id):
+        self.org_id = str(org_id)
+        self.index = PermNode.get_node_all_asset_ids_mapping(self.org_id)
+        # 不在节点资产映射中的资产（直接授权但没有节点）使用额外的编号
+        self.extra_asset_int_mapper = {}
+
+    def intern_asset_ids(self, asset_ids) -> CompactIdSet:
+        mapper = self.index.asset_id_int_mapper
+        ints = []
+        for asset_id in asset_ids:
+            i = mapper.get(asset_id)
+            if i is None:
+                i = self.extra_asset_int_mapper.setdefault(
+                    asset_id, len(self.index.asset_ids) + len(self.extra_asset_int_mapper)
+                )
+            ints.append(i)
+        return CompactIdSet(ints)
+
+    def prepare(self):
+        perms = AssetPermission.objects.valid().filter(actions__gt=0)\
+            .values_list('id', 'actions', 'date_expired')
+        self.perms = {
+            perm_id: (actions, as_current_tz(date_expired).strftime('%Y-%m-%d %H:%M:%S'))
+            for perm_id, actions, date_expired in perms
+        }
+        perm_ids = self.perms.keys()
+
+        def relation_mapper(through, field, value_func=lambda v: v):
+            mapper = defaultdict(set)
+            pairs = through.objects.filter(assetpermission_id__in=perm_ids)\
+                .values_list('assetpermission_id', field)
+            for perm_id, value in pairs:
+                mapper[perm_id].add(value_func(value))
+            return mapper
+
+        perm_node_keys = relation_mapper(AssetPermission.nodes.through, 'node__key')
+        perm_asset_ids = relation_mapper(AssetPermission.assets.through, 'asset_id', str)
+        self.perm_system_user_ids = relation_mapper(AssetPermission.system_users.through, 'systemuser_id')
+
+        # 授权规则 -> 资产集合
+        self.perm_idsets = {}
+        for perm_id in perm_ids:
+            idset = self.index.union(perm_node_keys.get(perm_id, ()))
+            direct_asset_ids = perm_asset_ids.get(perm_id)
+            if direct_asset_ids:
+                idset = idset.union(self.intern_asset_ids(direct_asset_ids))
+            self.perm_idsets[perm_id] = idset
+
+        # 用户 -> 授权规则
+        self.user_perm_ids = defaultdict(set)
+        for perm_id, user_id in AssetPermission.users.through.objects\
+                .filter(assetpermission_id__in=perm_ids)\
+                .values_list('assetpermission_id', 'user_id'):
+            self.user_perm_ids[user_id].add(perm_id)
+        group_perm_ids = relation_mapper(AssetPermission.user_groups.through, 'usergroup_id')
+        perm_group_pairs = [(p, g) for p, groups in group_perm_ids.items() for g in groups]
+        group_ids = {g for __, g in perm_group_pairs}
+        group_user_ids = defaultdict(set)
+        for user_id, group_id in User.groups.through.objects\
+                .filter(usergroup_id__in=group_ids)\
+                .values_list('user_id', 'usergroup_id'):
+            group_user_ids[group_id].add(user_id)
+        for perm_id, group_id in perm_group_pairs:
+            for user_id in group_user_ids[group_id]:
+                self.user_perm_ids[user_id].add(perm_id)
+
+        # 输出用的名称
+        self.users = dict(
+            User.objects.filter(id__in=self.user_perm_ids.keys(), is_active=True)
+            .values_list('id', 'username')
+        )
+        system_user_ids = set()
+        for ids in self.perm_system_user_ids.values():
+            system_user_ids.update(ids)
+        self.system_users = {}
+        self.system_user_protocols = {}
+        for su_id, name, username, protocol in SystemUser.objects.filter(id__in=system_user_ids)\
+                .values_list('id', 'name', 'username', 'protocol'):
+            self.system_users[su_id] = f'{name}({username})'
+            self.system_user_protocols[su_id] = protocol
+        asset_int_mapper = {**self.index.asset_id_int_mapper, **self.extra_asset_int_mapper}
+        self.assets = {}
+        protocols_parser = ProtocolsMixin()
+        for asset_id, hostname, ip, protocols in Asset.objects.filter(is_active=True)\
+                .values_list('id', 'hostname', 'ip', 'protocols').iterator():
+            i = asset_int_mapper.get(str(asset_id))
+            if i is not None:
+                protocols_parser.protocols = protocols
+                self.assets[i] = (hostname, ip, frozenset(protocols_parser.protocols_as_dict))
+
+    @property
+    def user_ids(self):
+        return [user_id for user_id in self.user_perm_ids if user_id in self.users]
+
+    def iter_user_rows(self, user_id):
+        """
+        合并用户的授权规则，同一 (资产, 系统用户) 取动作的并集和最晚的过期时间；
+        与 `get_asset_system_user_ids_with_actions` 一致，跳过资产不支持其协议的系统用户
+        """
+        username = self.users[user_id]
+        system_user_perm_ids = defaultdict(list)
+        for perm_id in self.user_perm_ids[user_id]:
+            for su_id in self.perm_system_user_ids.get(perm_id, ()):
+                system_user_perm_ids[su_id].append(perm_id)
+
+        for su_id, perm_ids in system_user_perm_ids.items():
+            if su_id not in self.system_users:
+                continue
+            protocol = self.system_user_protocols[su_id]
+            merged = {}
+            for perm_id in perm_ids:
+                actions, date_expired = self.perms[perm_id]
+                for i in self.perm_idsets[perm_id]:
+                    if i not in merged:
+                        merged[i] = (actions, date_expired)
+                    else:
+                        _actions, _date_expired = merged[i]
+                        merged[i] = (_actions | actions, max(_date_expired, date_expired))
+            for i, (actions, date_expired) in merged.items():
+                asset = self.assets.get(i)
+                if not asset or protocol not in asset[2]:
+                    continue
+                yield [
+                    username, asset[0], asset[1], self.system_users[su_id],
+                    ','.join(Action.value_to_choices(actions)), date_expired,
+                ]
+
+
+class AssetAccessReport:
+    """
+    所有组织的有效访问矩阵，按块写入磁盘，每处理一批用户报告一次进度
+    """
+    user_batch_size = 100
+    row_chunk_size = 10000
+
+    def __init__(self, report_id, file_format='csv', progress_callback=None):
+        self.report_id = str(report_id)
+        self.file_format = file_format
+        self.path = get_access_report_path(self.report_id, file_format)
+        self.progress_callback = progress_callback
+
+    @staticmethod
+    def get_header():
+        return [
+            _('Organization'), _('Username'), _('Hostname'), _('IP'),
+            _('System user'), _('Actions'), _('Date expired'),
+        ]
+
+    def get_writer(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        if self.file_format == 'xlsx':
+            return XLSXReportWriter(self.path, self.get_header())
+        writer = CSVReportWriter(self.path)
+        writer.write_rows([self.get_header()])
+        return writer
+
+    @staticmethod
+    def get_orgs():
+        orgs = list(Organization.objects.all())
+        if not any(org.is_default() for org in orgs):
+            orgs.insert(0, Organization.default())
+        return orgs
+
+    def report_progress(self, **progress):
+        logger.info(f'Access report progress: {progress}')
+        if self.progress_callback:
+            self.progress_callback(progress)
+
+    def generate(self):
+        t_start = time.time()
+        orgs = self.get_orgs()
+        writer = self.get_writer()
+        rows_count = 0
+        buffer = []
+
+        def flush():
+            nonlocal rows_count, buffer
+            writer.write_rows(buffer)
+            rows_count += len(buffer)
+            buffer = []
+
+        try:
+            for org_index, org in enumerate(orgs, 1):
+                org_name = str(org)
+                with tmp_to_org(org):
+                    matrix = OrgAccessMatrix(org.id)
+                    matrix.prepare()
+                user_ids = matrix.user_ids
+                for i, user_id in enumerate(user_ids, 1):
+                    for row in matrix.iter_user_rows(user_id):
+                        buffer.append([org_name, *row])
+                        if len(buffer) >= self.row_chunk_size:
+                            flush()
+                    if i % self.user_batch_size == 0 or i == len(user_ids):
+                        flush()
+                        self.report_progress(
+                            orgs=len(orgs), org_index=org_index, org=org_name,
+                            users=len(user_ids), users_done=i, rows=rows_count
+                        )
+                flush()
+        finally:
+            writer.close()
+        logger.info(f'Access report generated: cost={time.time() - t_start} rows={rows_count} path={self.path}')
+        return {'path': self.path, 'rows': rows_count}
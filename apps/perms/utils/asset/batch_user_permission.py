@@ -0,0 +1,235 @@
+from collections import defaultdict
+from contextlib import ExitStack
+import time
+
+from django.conf import settings
+from django.db import transaction
+
+from common.db.models import output_as_string
+from common.utils.common import lazyproperty, timeit
+from common.utils import get_logger
+from assets.utils import NodeAssetsUtil
+from orgs.utils import current_org, ensure_in_real_or_default_org
+from assets.models import Asset
+from perms.models import (
+    AssetPermission, PermNode, UserAssetGrantedTreeNodeRelation,
+)
+from perms.locks import UserGrantedTreeRebuildLock
+from perms.utils.asset.user_permission import UserGrantedTreeRefreshController, get_users_all_asset_perm_ids
+
+NodeFrom = UserAssetGrantedTreeNodeRelation.NodeFrom
+
+logger = get_logger(__name__)
+
+
+class OrgGrantedTreeSnapshot:
+    """
+    一个组织的节点树、节点资产映射和授权关系的快照
+    批量重建多个用户的授权树时共用，避免每个用户都重新查询一遍
+    """
+
+    def __init__(self, org_id):
+        self.org_id = str(org_id)
+
+    @lazyproperty
+    def nodes(self) -> list:
+        nodes = PermNode.objects.all().only('id', 'key', 'parent_key', 'org_id')
+        return list(nodes)
+
+    @lazyproperty
+    def key_node_mapper(self) -> dict:
+        return {node.key: node for node in self.nodes}
+
+    @lazyproperty
+    def id_node_mapper(self) -> dict:
+        return {node.id: node for node in self.nodes}
+
+    @lazyproperty
+    def nodekey_all_asset_ids_mapper(self) -> dict:
+        # 直接使用进程内的节点资产映射
+        return PermNode.get_node_all_asset_ids_mapping(self.org_id)
+
+    @lazyproperty
+    def valid_perm_ids(self) -> set:
+        perm_ids = AssetPermission.objects.valid().values_list('id', flat=True)
+        return set(perm_ids)
+
+    @lazyproperty
+    def perm_node_ids_mapper(self) -> dict:
+        mapper = defaultdict(set)
+        pairs = AssetPermission.nodes.through.objects.filter(
+            assetpermission_id__in=self.valid_perm_ids
+        ).values_list('assetpermission_id', 'node_id')
+        for perm_id, node_id in pairs:
+            mapper[perm_id].add(node_id)
+        return mapper
+
+    @lazyproperty
+    def perm_asset_ids_mapper(self) -> dict:
+        mapper = defaultdict(set)
+        pairs = AssetPermission.assets.through.objects.filter(
+            assetpermission_id__in=self.valid_perm_ids
+        ).annotate(
+            asset_id_str=output_as_string('asset_id')
+        ).values_list('assetpermission_id', 'asset_id_str')
+        for perm_id, asset_id in pairs:
+            mapper[perm_id].add(asset_id)
+        return mapper
+
+    @lazyproperty
+    def asset_node_ids_mapper(self) -> dict:
+        """
+        只包含直接授权过的资产
+        """
+        asset_ids = set()
+        for _asset_ids in self.perm_asset_ids_mapper.values():
+            asset_ids.update(_asset_ids)
+
+        mapper = defaultdict(set)
+        pairs = Asset.nodes.through.objects.filter(
+            asset_id__in=asset_ids
+        ).annotate(
+            asset_id_str=output_as_string('asset_id')
+        ).values_list('asset_id_str', 'node_id')
+        for asset_id, node_id in pairs:
+            mapper[asset_id].add(node_id)
+        return mapper
+
+    def get_users_perm_ids_mapper(self, user_ids) -> dict:
+        """
+        :return: {user_id(str): {perm_id, ...}}
+        """
+        return get_users_all_asset_perm_ids(user_ids, valid_perm_ids=self.valid_perm_ids)
+
+
+class UserGrantedTreeBatchBuildUtils:
+    """
+    基于一个组织的快照，批量计算多个用户的授权树，并批量写入
+    """
+    user_batch_size = 100
+
+    def __init__(self, user_ids, snapshot: OrgGrantedTreeSnapshot = None):
+        self.user_ids = [str(user_id) for user_id in user_ids]
+        self.snapshot = snapshot or OrgGrantedTreeSnapshot(current_org.id)
+
+    def _has_ancestor_granted(self, node, granted_key_set):
+        ancestor_keys = set(node.get_ancestor_keys())
+        return ancestor_keys & granted_key_set
+
+    def compute_user_tree(self, user_id, perm_ids) -> list:
+        """
+        与 `UserGrantedTreeBuildUtils.compute_perm_nodes_tree` 以及
+        `compute_node_assets_amount` 的算法一致，只是数据都来自快照
+
+        :return: [UserAssetGrantedTreeNodeRelation, ...]
+        """
+        snapshot = self.snapshot
+        if not perm_ids:
+            return []
+
+        granted_nodes = set()
+        granted_asset_ids = set()
+        for perm_id in perm_ids:
+            for node_id in snapshot.perm_node_ids_mapper.get(perm_id, ()):
+                node = snapshot.id_node_mapper.get(node_id)
+                if node:
+                    granted_nodes.add(node)
+            granted_asset_ids.update(snapshot.perm_asset_ids_mapper.get(perm_id, ()))
+
+        granted_key_set = {node.key for node in granted_nodes}
+        # node.key -> (node, node_from)
+        key_leaf_mapper = {}
+        nodekey_assetsid_mapper = defaultdict(set)
+
+        for node in granted_nodes:
+            if self._has_ancestor_granted(node, granted_key_set):
+                continue
+            key_leaf_mapper[node.key] = (node, NodeFrom.granted)
+            asset_ids = snapshot.nodekey_all_asset_ids_mapper.get(node.key, ())
+            nodekey_assetsid_mapper[node.key].update(asset_ids)
+
+        # 直接授权资产关联的节点
+        asset_id_nodes_pairs = []
+        for asset_id in granted_asset_ids:
+            node_ids = snapshot.asset_node_ids_mapper.get(asset_id, ())
+            nodes = [snapshot.id_node_mapper[i] for i in node_ids if i in snapshot.id_node_mapper]
+            asset_id_nodes_pairs.append((asset_id, nodes))
+
+        if not settings.PERM_SINGLE_ASSET_TO_UNGROUP_NODE:
+            for __, nodes in asset_id_nodes_pairs:
+                for node in nodes:
+                    if node.key in key_leaf_mapper:
+                        continue
+                    if self._has_ancestor_granted(node, granted_key_set):
+                        continue
+                    key_leaf_mapper[node.key] = (node, NodeFrom.asset)
+
+        ancestor_keys = set()
+        for node, __ in key_leaf_mapper.values():
+            ancestor_keys.update(node.get_ancestor_keys())
+        ancestor_keys -= key_leaf_mapper.keys()
+
+        node_from_mapper = {key: node_from for key, (__, node_from) in key_leaf_mapper.items()}
+        tree_nodes = [node for node, __ in key_leaf_mapper.values()]
+        for key in ancestor_keys:
+            node = snapshot.key_node_mapper.get(key)
+            if not node:
+                continue
+            node_from_mapper[key] = NodeFrom.child
+            tree_nodes.append(node)
+
+        if not tree_nodes:
+            return []
+
+        for asset_id, nodes in asset_id_nodes_pairs:
+            for node in nodes:
+                if node.key in node_from_mapper:
+                    nodekey_assetsid_mapper[node.key].add(asset_id)
+
+        util = NodeAssetsUtil(tree_nodes, nodekey_assetsid_mapper)
+        util.generate()
+
+        rels = []
+        for node in tree_nodes:
+            rels.append(UserAssetGrantedTreeNodeRelation(
+                user_id=user_id,
+                node_id=node.id,
+                node_key=node.key,
+                node_parent_key=node.parent_key,
+                node_from=node_from_mapper[node.key],
+                node_assets_amount=util.get_assets_amount(node.key),
+                org_id=node.org_id
+            ))
+        return rels
+
+    @timeit
+    def _rebuild_users(self, user_ids):
+        users_perm_ids_mapper = self.snapshot.get_users_perm_ids_mapper(user_ids)
+
+        to_create = []
+        for user_id in user_ids:
+            perm_ids = users_perm_ids_mapper.get(user_id, set())
+            to_create.extend(self.compute_user_tree(user_id, perm_ids))
+
+        with transaction.atomic():
+            with ExitStack() as stack:
+                # 锁会在事务提交后释放，按顺序加锁避免两个批次互相等待
+                for user_id in sorted(user_ids):
+                    stack.enter_context(UserGrantedTreeRebuildLock(user_id=user_id))
+                UserAssetGrantedTreeNodeRelation.objects.filter(user_id__in=user_ids).delete()
+                UserAssetGrantedTreeNodeRelation.objects.bulk_create(to_create, batch_size=1000)
+        UserGrantedTreeRefreshController.incr_tree_versions(user_ids)
+        return len(to_create)
+
+    @ensure_in_real_or_default_org
+    def rebuild(self):
+        t_start = time.time()
+        rows = 0
+        for i in range(0, len(self.user_ids), self.user_batch_size):
+            user_ids = self.user_ids[i:i + self.user_batch_size]
+            rows += self._rebuild_users(user_ids)
+        logger.info(
+            f'Batch rebuild user tree ok: cost={time.time() - t_start} '
+            f'users={len(self.user_ids)} rows={rows} org={current_org}'
+        )
+        return rows
@@ -4,14 +4,36 @@ from collections import defaultdict
 from django.db.models import Q
 
 from common.utils import get_logger
+from common.utils.common import lazyproperty
+from orgs.utils import tmp_to_org
+from assets.models import NodeAncestry
 from perms.models import AssetPermission, Action
 from perms.hands import Asset, User, UserGroup, SystemUser, Node
-from perms.utils.asset.user_permission import get_user_all_asset_perm_ids
+from perms.utils.asset.user_permission import (
+    get_user_all_asset_perm_ids, get_users_all_asset_perm_ids,
+    AssetPermissionDecisionCache, UserAssetSystemUsersMap
+)
 
 logger = get_logger(__file__)
 
 
+def get_asset_nodes_ancestor_ids(asset: Asset) -> set:
+    """
+    资产所在节点及其祖先节点的 id，通过节点闭包表查询
+    """
+    asset_node_ids = [node.id for node in asset.get_nodes()]
+    node_ids = Node.get_nodes_ancestor_ids(asset_node_ids, with_self=True)
+    return set(node_ids)
+
+
 def validate_permission(user, asset, system_user, action_name):
+    """
+    判定用户是否可以用系统用户对资产执行动作，禁用的用户没有任何权限
+
+    :return: (是否有权限, 权限的过期时间戳)
+    """
+    if not user.is_active:
+        return False, time.time()
 
     if not system_user.protocol in asset.protocols_as_dict.keys():
         return False, time.time()
@@ -23,14 +45,7 @@ def validate_permission(user, asset, system_user, action_name):
         asset_id=asset.id
     ).values_list('assetpermission_id', flat=True)
 
-    nodes = asset.get_nodes()
-    node_keys = set()
-    for node in nodes:
-        ancestor_keys = node.get_ancestor_keys(with_self=True)
-        node_keys.update(ancestor_keys)
-    node_ids = Node.objects.filter(key__in=node_keys).values_list('id', flat=True)
-
-    node_ids = set(node_ids)
+    node_ids = get_asset_nodes_ancestor_ids(asset)
 
     asset_perm_ids_from_node = AssetPermission.nodes.through.objects.filter(
         assetpermission_id__in=asset_perm_ids,
@@ -56,15 +71,214 @@ def validate_permission(user, asset, system_user, action_name):
     return False, time.time()
 
 
+def validate_permission_with_cache(user, asset, system_user, action_name):
+    """
+    同 `validate_permission`，判定结果缓存在 `AssetPermissionDecisionCache` 中；
+    禁用的用户不查询也不写入缓存，重新启用后不会读到缓存的拒绝结果
+    """
+    if not user.is_active:
+        return False, time.time()
+
+    if not system_user.protocol in asset.protocols_as_dict.keys():
+        return False, time.time()
+
+    decision_cache = AssetPermissionDecisionCache(user)
+    decision, version = decision_cache.get(asset.id, system_user.id, action_name, asset.org_id)
+    if decision:
+        return decision
+
+    has_permission, expire_at = validate_permission(user, asset, system_user, action_name)
+    decision_cache.set(asset.id, system_user.id, action_name, has_permission, expire_at, version)
+    return has_permission, expire_at
+
+
+class AssetPermissionBatchValidator:
+    """
+    批量判定 (user, asset, system_user, action) 是否有权限，结果与 `validate_permission` 一致，
+    不存在或者禁用的用户没有任何权限
+
+    所有判定共用查询：每个用户只查一次授权规则，每个资产只解析一次祖先节点，
+    授权规则与资产、节点、系统用户的关系各查询一次
+    """
+
+    def __init__(self, items):
+        """
+        :param items: [{'user_id', 'asset_id', 'system_user_id', 'action_name'}, ]
+        """
+        self.items = [
+            (
+                str(item.get('user_id', '')), str(item.get('asset_id', '')),
+                str(item.get('system_user_id', '')), item.get('action_name', '')
+            )
+            for item in items
+        ]
+
+    def _get_ids(self, index):
+        return {item[index] for item in self.items if item[index]}
+
+    @lazyproperty
+    def users_perm_ids(self) -> dict:
+        user_ids = User.objects.filter(
+            id__in=self._get_ids(0), is_active=True
+        ).values_list('id', flat=True)
+        return get_users_all_asset_perm_ids(user_ids)
+
+    @lazyproperty
+    def all_perm_ids(self) -> set:
+        perm_ids = set()
+        for _perm_ids in self.users_perm_ids.values():
+            perm_ids.update(_perm_ids)
+        return perm_ids
+
+    @lazyproperty
+    def assets(self) -> dict:
+        assets = Asset.objects.valid().filter(id__in=self._get_ids(1))
+        return {str(asset.id): asset for asset in assets}
+
+    @lazyproperty
+    def system_users(self) -> dict:
+        system_users = SystemUser.objects.filter(
+            id__in=self._get_ids(2)
+        ).only('id', 'protocol')
+        return {str(system_user.id): system_user for system_user in system_users}
+
+    @lazyproperty
+    def asset_ancestor_ids(self) -> dict:
+        """
+        :return: {asset_id(str): {资产所在节点及其祖先节点的 id}}
+        """
+        asset_node_ids = defaultdict(set)
+        pairs = Asset.nodes.through.objects.filter(
+            asset_id__in=self.assets.keys()
+        ).values_list('asset_id', 'node_id')
+        for asset_id, node_id in pairs:
+            asset_node_ids[str(asset_id)].add(node_id)
+
+        # 同 `Asset.get_nodes`，没有节点的资产属于组织的根节点
+        for asset_id, asset in self.assets.items():
+            if asset_id in asset_node_ids:
+                continue
+            with tmp_to_org(asset.org_id):
+                asset_node_ids[asset_id].add(Node.org_root().id)
+
+        node_ids = set()
+        for _node_ids in asset_node_ids.values():
+            node_ids.update(_node_ids)
+        node_ancestor_ids = defaultdict(set)
+        pairs = NodeAncestry.objects.filter(
+            descendant_id__in=node_ids
+        ).values_list('descendant_id', 'ancestor_id')
+        for node_id, ancestor_id in pairs:
+            node_ancestor_ids[node_id].add(ancestor_id)
+
+        mapper = {}
+        for asset_id, _node_ids in asset_node_ids.items():
+            ancestor_ids = set()
+            for node_id in _node_ids:
+                ancestor_ids.update(node_ancestor_ids[node_id])
+            mapper[asset_id] = ancestor_ids
+        return mapper
+
+    @lazyproperty
+    def asset_perm_ids(self) -> dict:
+        mapper = defaultdict(set)
+        pairs = AssetPermission.assets.through.objects.filter(
+            assetpermission_id__in=self.all_perm_ids,
+            asset_id__in=self.assets.keys()
+        ).values_list('asset_id', 'assetpermission_id')
+        for asset_id, perm_id in pairs:
+            mapper[str(asset_id)].add(perm_id)
+        return mapper
+
+    @lazyproperty
+    def node_perm_ids(self) -> dict:
+        node_ids = set()
+        for ancestor_ids in self.asset_ancestor_ids.values():
+            node_ids.update(ancestor_ids)
+
+        mapper = defaultdict(set)
+        pairs = AssetPermission.nodes.through.objects.filter(
+            assetpermission_id__in=self.all_perm_ids,
+            node_id__in=node_ids
+        ).values_list('node_id', 'assetpermission_id')
+        for node_id, perm_id in pairs:
+            mapper[node_id].add(perm_id)
+        return mapper
+
+    @lazyproperty
+    def system_user_perm_ids(self) -> dict:
+        mapper = defaultdict(set)
+        pairs = AssetPermission.system_users.through.objects.filter(
+            assetpermission_id__in=self.all_perm_ids,
+            systemuser_id__in=self.system_users.keys()
+        ).values_list('systemuser_id', 'assetpermission_id')
+        for system_user_id, perm_id in pairs:
+            mapper[str(system_user_id)].add(perm_id)
+        return mapper
+
+    @lazyproperty
+    def perm_actions_expired(self) -> dict:
+        """
+        :return: {perm_id: (actions, date_expired_timestamp)}
+        """
+        values = AssetPermission.objects.filter(
+            id__in=self.all_perm_ids
+        ).values_list('id', 'actions', 'date_expired')
+        return {
+            perm_id: (actions, date_expired.timestamp())
+            for perm_id, actions, date_expired in values
+        }
+
+    def get_asset_all_perm_ids(self, asset_id) -> set:
+        perm_ids = set(self.asset_perm_ids.get(asset_id, ()))
+        for node_id in self.asset_ancestor_ids.get(asset_id, ()):
+            perm_ids.update(self.node_perm_ids.get(node_id, ()))
+        return perm_ids
+
+    def validate_one(self, user_id, asset_id, system_user_id, action_name):
+        """
+        :return: {'has_permission', 'expire_at', 'actions'}
+        """
+        denied = {'has_permission': False, 'expire_at': int(time.time()), 'actions': []}
+        asset = self.assets.get(asset_id)
+        system_user = self.system_users.get(system_user_id)
+        if not asset or not system_user:
+            return denied
+        if not system_user.protocol in asset.protocols_as_dict.keys():
+            return denied
+
+        perm_ids = self.users_perm_ids.get(user_id, set()) \
+            & self.get_asset_all_perm_ids(asset_id) \
+            & self.system_user_perm_ids.get(system_user_id, set())
+
+        actions = 0
+        expire_at = None
+        for perm_id in perm_ids:
+            perm_actions, date_expired = self.perm_actions_expired[perm_id]
+            actions |= perm_actions
+            if action_name not in Action.value_to_choices(perm_actions):
+                continue
+            if expire_at is None or date_expired > expire_at:
+                expire_at = date_expired
+
+        if expire_at is None:
+            denied['actions'] = Action.value_to_choices(actions)
+            return denied
+        return {
+            'has_permission': True,
+            'expire_at': int(expire_at),
+            'actions': Action.value_to_choices(actions)
+        }
+
+    def validate(self) -> list:
+        return [self.validate_one(*item) for item in self.items]
+
+
 def get_asset_system_user_ids_with_actions(asset_perm_ids, asset: Asset):
-    nodes = asset.get_nodes()
-    node_keys = set()
-    for node in nodes:
-        ancestor_keys = node.get_ancestor_keys(with_self=True)
-        node_keys.update(ancestor_keys)
+    node_ids = get_asset_nodes_ancestor_ids(asset)
 
     queryset = AssetPermission.objects.filter(id__in=asset_perm_ids)\
-        .filter(Q(assets=asset) | Q(nodes__key__in=node_keys))
+        .filter(Q(assets=asset) | Q(nodes__id__in=node_ids))
 
     asset_protocols = asset.protocols_as_dict.keys()
     values = queryset.filter(
@@ -80,6 +294,11 @@ def get_asset_system_user_ids_with_actions(asset_perm_ids, asset: Asset):
 
 
 def get_asset_system_user_ids_with_actions_by_user(user: User, asset: Asset):
+    # 优先使用与授权树一起构建的 资产 -> 系统用户 映射
+    system_users_actions = UserAssetSystemUsersMap(user, asset.org_id).get_system_user_ids_with_actions(asset)
+    if system_users_actions is not None:
+        return system_users_actions
+
     asset_perm_ids = get_user_all_asset_perm_ids(user)
     return get_asset_system_user_ids_with_actions(asset_perm_ids, asset)
 
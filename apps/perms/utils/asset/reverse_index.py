@@ -0,0 +1,256 @@
+from collections import defaultdict
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+
+from common.decorator import on_transaction_commit
+from common.utils import get_logger
+from common.utils.common import timeit
+from orgs.utils import current_org, tmp_to_org
+from orgs.models import Organization
+from assets.models import Asset, SystemUser
+from perms.models import AssetPermission, AssetPermReverseIndex, Action
+from perms.locks import AssetPermReverseIndexRebuildLock
+from users.models import User, UserGroup
+
+__all__ = ['AssetPermReverseIndexUtil']
+
+logger = get_logger(__name__)
+
+
+class AssetPermReverseIndexUtil:
+    """
+    维护和查询资产到授权规则的反向索引 `AssetPermReverseIndex`
+
+    - 授权规则的资产、节点变化，资产与节点的关系变化时，只重建受影响的授权规则
+    - 节点删除或移动时，重建整个组织
+    - 授权规则的有效期、用户、用户组、系统用户和动作在查询时关联，变化时不需要重建
+    """
+    built_orgs_key = 'perms.asset_perm_reverse_index.built_orgs'
+    # 已经分发了重建任务的组织，避免每次请求都分发
+    rebuilding_key_template = 'perms.asset_perm_reverse_index.rebuilding.{org_id}'
+    rebuilding_ttl = 600
+    bulk_create_size = 5000
+
+    def __init__(self, org_id=None):
+        self.org_id = str(org_id or current_org.id)
+
+    @classmethod
+    def get_redis_client(cls):
+        return cache.client.get_client(write=True)
+
+    # 维护
+    # ----------------------------------------------------------------
+
+    @staticmethod
+    def compute_perms_asset_ids(perm_ids) -> dict:
+        """
+        :return: {perm_id: {asset_id, }}
+        """
+        perms_asset_ids = defaultdict(set)
+        pairs = AssetPermission.assets.through.objects.filter(
+            assetpermission_id__in=perm_ids
+        ).values_list('assetpermission_id', 'asset_id')
+        for perm_id, asset_id in pairs:
+            perms_asset_ids[perm_id].add(asset_id)
+
+        node_perm_ids = defaultdict(set)
+        pairs = AssetPermission.nodes.through.objects.filter(
+            assetpermission_id__in=perm_ids
+        ).values_list('node_id', 'assetpermission_id')
+        for node_id, perm_id in pairs:
+            node_perm_ids[node_id].add(perm_id)
+
+        # 通过节点闭包表找到授权节点及其后代节点下的资产
+        ancestor_field = 'node__ancestor_rels__ancestor_id'
+        pairs = Asset.nodes.through.objects.filter(
+            **{f'{ancestor_field}__in': node_perm_ids.keys()}
+        ).values_list(ancestor_field, 'asset_id').distinct()
+        for node_id, asset_id in pairs:
+            for perm_id in node_perm_ids[node_id]:
+                perms_asset_ids[perm_id].add(asset_id)
+        return perms_asset_ids
+
+    def _bulk_create(self, perms_asset_ids):
+        to_create = []
+        count = 0
+        for perm_id, asset_ids in perms_asset_ids.items():
+            for asset_id in asset_ids:
+                to_create.append(AssetPermReverseIndex(
+                    asset_id=asset_id, assetpermission_id=perm_id, org_id=self.org_id
+                ))
+                if len(to_create) >= self.bulk_create_size:
+                    AssetPermReverseIndex.objects.bulk_create(to_create)
+                    count += len(to_create)
+                    to_create = []
+        AssetPermReverseIndex.objects.bulk_create(to_create)
+        return count + len(to_create)
+
+    @timeit
+    def rebuild_perms(self, perm_ids):
+        perm_ids = set(perm_ids)
+        with tmp_to_org(self.org_id):
+            # 已删除的授权规则，其索引会被级联删除
+            perm_ids = set(AssetPermission.objects.filter(id__in=perm_ids).values_list('id', flat=True))
+            perms_asset_ids = self.compute_perms_asset_ids(perm_ids)
+            with transaction.atomic():
+                with AssetPermReverseIndexRebuildLock(self.org_id):
+                    AssetPermReverseIndex.objects.filter(assetpermission_id__in=perm_ids).delete()
+                    rows = self._bulk_create(perms_asset_ids)
+        logger.info(f'Rebuild asset perm reverse index: org={self.org_id} perms={len(perm_ids)} rows={rows}')
+        return rows
+
+    @timeit
+    def rebuild(self):
+        t_start = time.time()
+        with tmp_to_org(self.org_id):
+            # 先标记为已构建，重建期间的变化会再次去掉标记
+            self.get_redis_client().sadd(self.built_orgs_key, self.org_id)
+            perm_ids = set(AssetPermission.objects.all().values_list('id', flat=True))
+            perms_asset_ids = self.compute_perms_asset_ids(perm_ids)
+            with transaction.atomic():
+                with AssetPermReverseIndexRebuildLock(self.org_id):
+                    AssetPermReverseIndex.objects.all().delete()
+                    rows = self._bulk_create(perms_asset_ids)
+        self.get_redis_client().delete(self.rebuilding_key_template.format(org_id=self.org_id))
+        logger.info(
+            f'Rebuild asset perm reverse index of org: cost={time.time() - t_start} '
+            f'org={self.org_id} perms={len(perm_ids)} rows={rows}'
+        )
+        return rows
+
+    def is_built(self):
+        return self.get_redis_client().sismember(self.built_orgs_key, self.org_id)
+
+    def rebuild_async_if_need(self):
+        """
+        没有构建时分发重建任务，不在请求中同步重建
+
+        :return: 是否已经构建
+        """
+        from perms.tasks import rebuild_asset_perm_reverse_index
+        client = self.get_redis_client()
+        key = self.rebuilding_key_template.format(org_id=self.org_id)
+        # 重建时先标记为已构建，事务提交后才删除 rebuilding 标记
+        if self.is_built() and not client.exists(key):
+            return True
+        if client.set(key, 1, nx=True, ex=self.rebuilding_ttl):
+            rebuild_asset_perm_reverse_index.delay(self.org_id)
+        return False
+
+    @classmethod
+    def rebuild_orgs_async_if_need(cls, org_ids):
+        """
+        :return: 还没有构建的组织 id
+        """
+        return [org_id for org_id in org_ids if not cls(org_id).rebuild_async_if_need()]
+
+    @classmethod
+    def get_current_org_ids(cls):
+        if current_org.is_root():
+            org_ids = {str(org_id) for org_id in Organization.objects.all().values_list('id', flat=True)}
+            org_ids.add(Organization.DEFAULT_ID)
+            return sorted(org_ids)
+        return [str(current_org.id)]
+
+    @classmethod
+    @on_transaction_commit
+    def rebuild_perms_async(cls, org_id, perm_ids):
+        from perms.tasks import rebuild_asset_perm_reverse_index
+        if not perm_ids:
+            return
+        rebuild_asset_perm_reverse_index.delay(str(org_id), [str(i) for i in perm_ids])
+
+    @classmethod
+    @on_transaction_commit
+    def rebuild_org_async(cls, org_id):
+        from perms.tasks import rebuild_asset_perm_reverse_index
+        cls.get_redis_client().srem(cls.built_orgs_key, str(org_id))
+        rebuild_asset_perm_reverse_index.delay(str(org_id))
+
+    # 查询
+    # ----------------------------------------------------------------
+
+    @staticmethod
+    def _get_relation_mapper(through, field, perm_ids):
+        mapper = defaultdict(set)
+        pairs = through.objects.filter(
+            assetpermission_id__in=perm_ids
+        ).values_list('assetpermission_id', field)
+        for perm_id, value in pairs:
+            mapper[perm_id].add(value)
+        return mapper
+
+    @classmethod
+    def get_assets_granted_subjects(cls, asset_ids) -> dict:
+        """
+        资产可以被哪些用户、用户组通过哪些系统用户和动作登录，只包含有效的授权规则
+
+        :return: {asset_id(str): {'permissions', 'users', 'user_groups', 'system_users'}}
+        """
+        asset_perm_ids = defaultdict(set)
+        pairs = AssetPermReverseIndex.objects.filter(
+            asset_id__in=asset_ids
+        ).values_list('asset_id', 'assetpermission_id')
+        for asset_id, perm_id in pairs:
+            asset_perm_ids[str(asset_id)].add(perm_id)
+
+        all_perm_ids = set()
+        for perm_ids in asset_perm_ids.values():
+            all_perm_ids.update(perm_ids)
+        perms = AssetPermission.objects.valid().filter(
+            id__in=all_perm_ids
+        ).values('id', 'name', 'actions', 'date_expired')
+        perms = {perm['id']: perm for perm in perms}
+
+        perm_user_ids = cls._get_relation_mapper(AssetPermission.users.through, 'user_id', perms.keys())
+        perm_group_ids = cls._get_relation_mapper(AssetPermission.user_groups.through, 'usergroup_id', perms.keys())
+        perm_system_user_ids = cls._get_relation_mapper(
+            AssetPermission.system_users.through, 'systemuser_id', perms.keys()
+        )
+
+        def get_values(model, id_mapper, fields):
+            ids = set()
+            for _ids in id_mapper.values():
+                ids.update(_ids)
+            values = model.objects.filter(id__in=ids).values('id', *fields)
+            return {value['id']: value for value in values}
+
+        users = get_values(User, perm_user_ids, ('name', 'username'))
+        groups = get_values(UserGroup, perm_group_ids, ('name',))
+        system_users = get_values(SystemUser, perm_system_user_ids, ('name', 'username', 'protocol'))
+
+        result = {}
+        for asset_id in asset_ids:
+            asset_id = str(asset_id)
+            perm_ids = [i for i in asset_perm_ids.get(asset_id, ()) if i in perms]
+            user_ids, group_ids = set(), set()
+            system_user_actions = defaultdict(int)
+            for perm_id in perm_ids:
+                user_ids.update(perm_user_ids.get(perm_id, ()))
+                group_ids.update(perm_group_ids.get(perm_id, ()))
+                for system_user_id in perm_system_user_ids.get(perm_id, ()):
+                    system_user_actions[system_user_id] |= perms[perm_id]['actions']
+
+            result[asset_id] = {
+                'permissions': [
+                    {
+                        'id': perms[i]['id'],
+                        'name': perms[i]['name'],
+                        'actions': Action.value_to_choices(perms[i]['actions']),
+                        'date_expired': perms[i]['date_expired'],
+                        'users': [str(u) for u in perm_user_ids.get(i, ())],
+                        'user_groups': [str(g) for g in perm_group_ids.get(i, ())],
+                        'system_users': [str(s) for s in perm_system_user_ids.get(i, ())],
+                    }
+                    for i in perm_ids
+                ],
+                'users': [users[i] for i in user_ids if i in users],
+                'user_groups': [groups[i] for i in group_ids if i in groups],
+                'system_users': [
+                    {**system_users[i], 'actions': Action.value_to_choices(actions)}
+                    for i, actions in system_user_actions.items() if i in system_users
+                ],
+            }
+        return result
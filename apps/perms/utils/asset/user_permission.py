@@ -1,19 +1,26 @@
 from collections import defaultdict
 from typing import List, Tuple
+import hashlib
+import json
+import threading
 import time
+import uuid
 
 from django.core.cache import cache
 from django.conf import settings
+from django.db import transaction
 from django.db.models import Q, QuerySet
+from django.utils import timezone
 
 from common.db.models import output_as_string, UnionQuerySet
 from common.utils.common import lazyproperty, timeit
 from assets.utils import NodeAssetsUtil
 from common.utils import get_logger
 from common.decorator import on_transaction_commit
+from common.local import thread_local
 from orgs.utils import tmp_to_org, current_org, ensure_in_real_or_default_org, tmp_to_root_org
 from assets.models import (
-    Asset, FavoriteAsset, AssetQuerySet, NodeQuerySet
+    Asset, FavoriteAsset, AssetQuerySet, NodeQuerySet, SystemUser
 )
 from orgs.models import Organization
 from perms.models import (
@@ -29,6 +36,16 @@ logger = get_logger(__name__)
 
 
 def get_user_all_asset_perm_ids(user) -> set:
+    """
+    用户在当前组织有效的授权规则，结果缓存在 `UserAssetPermIdsCache` 中
+    """
+    return UserAssetPermIdsCache(user).get_or_refresh()
+
+
+def get_user_related_asset_perm_ids(user) -> set:
+    """
+    直接授权给用户以及用户组的授权规则，不考虑是否有效
+    """
     asset_perm_ids = set()
     user_perm_id = AssetPermission.users.through.objects \
         .filter(user_id=user.id) \
@@ -46,79 +63,281 @@ def get_user_all_asset_perm_ids(user) -> set:
         .values_list('assetpermission_id', flat=True) \
         .distinct()
     asset_perm_ids.update(groups_perm_id)
-
-    asset_perm_ids = AssetPermission.objects.filter(
-        id__in=asset_perm_ids).valid().values_list('id', flat=True)
-    asset_perm_ids = set(asset_perm_ids)
     return asset_perm_ids
 
 
+def get_users_all_asset_perm_ids(user_ids, valid_perm_ids=None) -> dict:
+    """
+    同 `get_user_all_asset_perm_ids`，一次查询多个用户
+
+    :param valid_perm_ids: 调用方已经查询过的有效授权规则，没有时在这里查询
+    :return: {user_id(str): {asset_perm_id, }}
+    """
+    users_perm_ids = defaultdict(set)
+    user_perm_pairs = AssetPermission.users.through.objects \
+        .filter(user_id__in=user_ids) \
+        .values_list('user_id', 'assetpermission_id')
+    for user_id, perm_id in user_perm_pairs:
+        users_perm_ids[str(user_id)].add(perm_id)
+
+    group_user_ids = defaultdict(set)
+    user_group_pairs = User.groups.through.objects \
+        .filter(user_id__in=user_ids) \
+        .values_list('user_id', 'usergroup_id')
+    for user_id, group_id in user_group_pairs:
+        group_user_ids[group_id].add(str(user_id))
+
+    group_perm_pairs = AssetPermission.user_groups.through.objects \
+        .filter(usergroup_id__in=group_user_ids.keys()) \
+        .values_list('usergroup_id', 'assetpermission_id')
+    for group_id, perm_id in group_perm_pairs:
+        for user_id in group_user_ids[group_id]:
+            users_perm_ids[user_id].add(perm_id)
+
+    if valid_perm_ids is None:
+        all_perm_ids = set()
+        for perm_ids in users_perm_ids.values():
+            all_perm_ids.update(perm_ids)
+        valid_perm_ids = set(AssetPermission.objects.filter(
+            id__in=all_perm_ids).valid().values_list('id', flat=True))
+    for user_id in users_perm_ids:
+        users_perm_ids[user_id] &= valid_perm_ids
+    return users_perm_ids
+
+
+class GrantedTreeRebuildStats:
+    """
+    授权树重建时写入数据库的统计，`touched` 是实际写的行数，`kept` 是未变化的行数
+    """
+    compare_fields = ('node_key', 'node_parent_key', 'node_from', 'node_assets_amount')
+
+    def __init__(self, created=0, updated=0, deleted=0, kept=0):
+        self.created = created
+        self.updated = updated
+        self.deleted = deleted
+        self.kept = kept
+
+    @property
+    def touched(self):
+        return self.created + self.updated + self.deleted
+
+    def __str__(self):
+        return f'touched={self.touched} (created={self.created} updated={self.updated} ' \
+               f'deleted={self.deleted}) kept={self.kept}'
+
+
 class UserGrantedTreeRefreshController:
-    key_template = 'perms.user.node_tree.built_orgs.user_id:{user_id}'
+    """
+    用户授权树已构建的标记保存在 hash 中，field 是组织 id，value 是标记时的组织 epoch，
+    key 里带有全局 epoch；重新标记时覆盖旧的 epoch，不会积累失效的标记
+
+    全局 epoch 递增后所有用户的标记都失效，组织 epoch 递增后该组织的标记都失效，
+    不需要扫描、删除所有用户的 key，失效的 key 过期后自动删除
+    """
+    key_template = 'perms.user.node_tree.built_orgs_hash.epoch:{epoch}.user_id:{user_id}'
+    global_epoch_key = 'perms.user.node_tree.built_orgs.epoch'
+    org_epoch_key_template = 'perms.user.node_tree.built_orgs.epoch.org_id:{org_id}'
+    # 已构建标记的过期时间，每次标记时重置
+    built_mark_ttl = 3600 * 24 * 7
+    # 用户授权树的版本，授权树失效、重建、收藏变化时递增，用于生成 ETag
+    tree_version_key_template = 'perms.user.node_tree.version.user_id:{user_id}'
+    # 组织内资产、节点属性的版本，变化时递增，用于生成 ETag
+    org_content_version_key_template = 'perms.org.assets_content.version.org_id:{org_id}'
+    # 等待批量重建的用户，这些用户在该组织不各自重建，先使用已有的授权树
+    batch_pending_key_template = 'perms.user.node_tree.batch_pending.org_id:{org_id}'
+    # 批量任务没有执行完时，超时后用户各自重建
+    batch_pending_ttl = 600
 
     def __init__(self, user):
         self.user = user
-        self.key = self.key_template.format(user_id=user.id)
         self.client = self.get_redis_client()
 
     @classmethod
     def clean_all_user_tree_built_mark(cls):
         """ 清除所有用户已构建树的标记 """
         client = cls.get_redis_client()
-        key_match = cls.key_template.format(user_id='*')
-        keys = client.keys(key_match)
-        with client.pipeline() as p:
-            for key in keys:
-                p.delete(key)
-            p.execute()
+        epoch = client.incr(cls.global_epoch_key)
+        logger.info(f'Clean all user tree built mark: epoch={epoch}')
+
+    @classmethod
+    @on_transaction_commit
+    def clean_org_tree_built_mark(cls, org_id):
+        """ 清除所有用户在该组织已构建树的标记 """
+        client = cls.get_redis_client()
+        epoch = client.incr(cls.org_epoch_key_template.format(org_id=org_id))
+        logger.info(f'Clean org user tree built mark: org={org_id} epoch={epoch}')
 
     @classmethod
     def get_redis_client(cls):
         return cache.client.get_client(write=True)
 
-    def get_need_refresh_org_ids(self):
-        org_ids = self.client.smembers(self.key)
-        return {org_id.decode() for org_id in org_ids}
+    @classmethod
+    def get_epochs(cls, client, org_ids):
+        """
+        :return: (全局 epoch, {org_id: 组织 epoch})
+        """
+        org_ids = [str(org_id) for org_id in org_ids]
+        keys = [cls.global_epoch_key]
+        keys.extend(cls.org_epoch_key_template.format(org_id=org_id) for org_id in org_ids)
+        values = [int(v or 0) for v in client.mget(keys)]
+        return values[0], dict(zip(org_ids, values[1:]))
+
+    @classmethod
+    def get_built_mark_key(cls, user_id, epoch):
+        return cls.key_template.format(epoch=epoch, user_id=user_id)
+
+    @staticmethod
+    def parse_built_org_ids(marks: dict, org_epochs: dict) -> set:
+        """
+        只有与组织当前 epoch 一致的标记才有效
+
+        :param marks: hgetall 的结果 {org_id: epoch}
+        """
+        built_org_ids = set()
+        for org_id, epoch in marks.items():
+            org_id = org_id.decode()
+            if org_epochs.get(org_id) == int(epoch or 0):
+                built_org_ids.add(org_id)
+        return built_org_ids
+
+    def get_built_mark_key_and_org_epochs(self):
+        epoch, org_epochs = self.get_epochs(self.client, self.org_ids)
+        return self.get_built_mark_key(self.user.id, epoch), org_epochs
+
+    def get_built_org_ids(self):
+        key, org_epochs = self.get_built_mark_key_and_org_epochs()
+        return self.parse_built_org_ids(self.client.hgetall(key), org_epochs)
 
     def set_all_orgs_as_built(self):
-        self.client.sadd(self.key, *self.org_ids)
+        key, org_epochs = self.get_built_mark_key_and_org_epochs()
+        with self.client.pipeline() as p:
+            p.hset(key, mapping=org_epochs)
+            p.expire(key, self.built_mark_ttl)
+            p.execute()
 
     def have_need_refresh_orgs(self):
-        built_org_ids = self.client.smembers(self.key)
-        built_org_ids = {org_id.decode() for org_id in built_org_ids}
-        have = self.org_ids - built_org_ids
+        have = self.org_ids - self.get_built_org_ids()
         return have
 
+    def get_batch_pending_org_ids(self, org_ids):
+        org_ids = list(org_ids)
+        with self.client.pipeline(transaction=False) as p:
+            for org_id in org_ids:
+                p.sismember(self.batch_pending_key_template.format(org_id=org_id), str(self.user.id))
+            ret = p.execute()
+        return {org_id for org_id, pending in zip(org_ids, ret) if pending}
+
     def get_need_refresh_orgs_and_fill_up(self):
+        """
+        等待批量重建的组织不标记、不重建，由批量任务完成后标记
+        """
         org_ids = self.org_ids
+        pending_org_ids = self.get_batch_pending_org_ids(org_ids - self.get_built_org_ids())
+        key, org_epochs = self.get_built_mark_key_and_org_epochs()
+        fill_up_org_epochs = {k: v for k, v in org_epochs.items() if k not in pending_org_ids}
 
         with self.client.pipeline() as p:
-            p.smembers(self.key)
-            p.sadd(self.key, *org_ids)
+            p.hgetall(key)
+            if fill_up_org_epochs:
+                p.hset(key, mapping=fill_up_org_epochs)
+                p.expire(key, self.built_mark_ttl)
             ret = p.execute()
-            built_org_ids = {org_id.decode() for org_id in ret[0]}
-            ids = org_ids - built_org_ids
+            built_org_ids = self.parse_built_org_ids(ret[0], org_epochs)
+            ids = org_ids - built_org_ids - pending_org_ids
             orgs = {*Organization.objects.filter(id__in=ids)}
             logger.info(
-                f'Need rebuild orgs are {orgs}, built orgs are {ret[0]}, '
-                f'all orgs are {org_ids}'
+                f'Need rebuild orgs are {orgs}, built orgs are {built_org_ids}, '
+                f'batch pending orgs are {pending_org_ids}, all orgs are {org_ids}'
             )
             return orgs
 
+    @classmethod
+    def remove_built_orgs_in_pipeline(cls, pipeline, user_id, epoch, org_epochs):
+        key = cls.get_built_mark_key(user_id, epoch)
+        pipeline.hdel(key, *org_epochs.keys())
+
     @classmethod
     @on_transaction_commit
     def remove_built_orgs_from_users(cls, org_ids, user_ids):
         client = cls.get_redis_client()
         org_ids = [str(org_id) for org_id in org_ids]
+        epoch, org_epochs = cls.get_epochs(client, org_ids)
 
         with client.pipeline() as p:
             for user_id in user_ids:
-                key = cls.key_template.format(user_id=user_id)
-                p.srem(key, *org_ids)
+                cls.remove_built_orgs_in_pipeline(p, user_id, epoch, org_epochs)
+                cls.incr_tree_version_in_pipeline(p, user_id)
+                UserAssetSystemUsersMap.incr_version_in_pipeline(p, user_id)
+                # 授权树变化的用户，其连接授权的判定缓存也要失效
+                AssetPermissionDecisionCache.expire_in_pipeline(p, user_id)
             p.execute()
         logger.info(f'Remove orgs from users built tree: users:{user_ids} '
                     f'orgs:{org_ids}')
 
+    @classmethod
+    def get_tree_versions(cls, client, user_ids):
+        keys = [cls.tree_version_key_template.format(user_id=user_id) for user_id in user_ids]
+        values = client.mget(keys) if keys else []
+        return {user_id: int(v or 0) for user_id, v in zip(user_ids, values)}
+
+    @classmethod
+    @on_transaction_commit
+    def set_org_as_built_for_users(cls, org_id, user_ids, epochs=None, tree_versions=None):
+        """
+        重建提交后再标记为已构建
+
+        :param epochs: 重建前的 (全局 epoch, {org_id: epoch})，重建期间 epoch 变化时标记自然失效
+        :param tree_versions: {user_id: 期望的树版本}，不一致说明重建期间用户又有变更，不标记
+        """
+        client = cls.get_redis_client()
+        if epochs is None:
+            epochs = cls.get_epochs(client, [org_id])
+        epoch, org_epochs = epochs
+
+        if tree_versions is not None:
+            current_versions = cls.get_tree_versions(client, user_ids)
+            user_ids = [
+                user_id for user_id in user_ids
+                if current_versions.get(user_id) == tree_versions.get(user_id)
+            ]
+
+        with client.pipeline() as p:
+            for user_id in user_ids:
+                key = cls.get_built_mark_key(user_id, epoch)
+                p.hset(key, mapping=org_epochs)
+                p.expire(key, cls.built_mark_ttl)
+            p.execute()
+
+    @classmethod
+    @on_transaction_commit
+    def rebuild_users_tree_in_batch_if_need(cls, org_id, user_ids):
+        """
+        受影响的用户很多时，提交一个批量重建的任务，避免这些用户各自重建
+        """
+        from perms.tasks import rebuild_users_granted_tree_in_batch
+
+        user_ids = [str(user_id) for user_id in user_ids]
+        threshold = settings.PERM_TREE_BATCH_REBUILD_THRESHOLD
+        if not threshold or len(user_ids) < threshold:
+            return
+        client = cls.get_redis_client()
+        # 在 `remove_built_orgs_from_users` 递增版本之后读取，任务执行前版本变化说明用户已经自己重建
+        tree_versions = cls.get_tree_versions(client, user_ids)
+        key = cls.batch_pending_key_template.format(org_id=org_id)
+        with client.pipeline() as p:
+            p.sadd(key, *user_ids)
+            p.expire(key, cls.batch_pending_ttl)
+            p.execute()
+        logger.info(f'Submit batch rebuild user tree task: org={org_id} users={len(user_ids)}')
+        rebuild_users_granted_tree_in_batch.delay(str(org_id), user_ids, tree_versions)
+
+    @classmethod
+    def remove_batch_pending_users(cls, org_id, user_ids):
+        if not user_ids:
+            return
+        key = cls.batch_pending_key_template.format(org_id=org_id)
+        cls.get_redis_client().srem(key, *user_ids)
+
     @classmethod
     def add_need_refresh_orgs_for_users(cls, org_ids, user_ids):
         cls.remove_built_orgs_from_users(org_ids, user_ids)
@@ -130,16 +349,15 @@ class UserGrantedTreeRefreshController:
         1，计算与这些资产有关的授权
         2，计算与这些节点以及祖先节点有关的授权
         """
+        asset_perm_ids = cls.get_asset_perm_ids_by_nodes_assets(node_ids, asset_ids)
+        cls.add_need_refresh_by_asset_perm_ids(asset_perm_ids)
 
+    @staticmethod
+    def get_asset_perm_ids_by_nodes_assets(node_ids, asset_ids) -> set:
         node_ids = set(node_ids)
-        ancestor_node_keys = set()
         asset_perm_ids = set()
 
-        nodes = PermNode.objects.filter(id__in=node_ids).only('id', 'key')
-        for node in nodes:
-            ancestor_node_keys.update(node.get_ancestor_keys())
-
-        ancestor_id = PermNode.objects.filter(key__in=ancestor_node_keys).values_list('id', flat=True)
+        ancestor_id = PermNode.get_nodes_ancestor_ids(node_ids, with_self=False)
         node_ids.update(ancestor_id)
 
         assets_related_perm_ids = AssetPermission.nodes.through.objects.filter(
@@ -151,8 +369,7 @@ class UserGrantedTreeRefreshController:
             asset_id__in=asset_ids
         ).values_list('assetpermission_id', flat=True)
         asset_perm_ids.update(nodes_related_perm_ids)
-
-        cls.add_need_refresh_by_asset_perm_ids(asset_perm_ids)
+        return asset_perm_ids
 
     @classmethod
     def add_need_refresh_by_asset_perm_ids_cross_orgs(cls, asset_perm_ids):
@@ -164,10 +381,8 @@ class UserGrantedTreeRefreshController:
             with tmp_to_org(org_id):
                 cls.add_need_refresh_by_asset_perm_ids(perm_ids)
 
-    @classmethod
-    @ensure_in_real_or_default_org
-    def add_need_refresh_by_asset_perm_ids(cls, asset_perm_ids):
-
+    @staticmethod
+    def get_user_ids_by_asset_perm_ids(asset_perm_ids) -> set:
         group_ids = AssetPermission.user_groups.through.objects.filter(
             assetpermission_id__in=asset_perm_ids
         ).values_list('usergroup_id', flat=True)
@@ -182,10 +397,17 @@ class UserGrantedTreeRefreshController:
             usergroup_id__in=group_ids
         ).values_list('user_id', flat=True)
         user_ids.update(group_user_ids)
+        return user_ids
+
+    @classmethod
+    @ensure_in_real_or_default_org
+    def add_need_refresh_by_asset_perm_ids(cls, asset_perm_ids):
+        user_ids = cls.get_user_ids_by_asset_perm_ids(asset_perm_ids)
 
         cls.remove_built_orgs_from_users(
             [current_org.id], user_ids
         )
+        cls.rebuild_users_tree_in_batch_if_need(current_org.id, user_ids)
 
     @lazyproperty
     def org_ids(self):
@@ -212,14 +434,700 @@ class UserGrantedTreeRefreshController:
                 else:
                     orgs = self.get_need_refresh_orgs_and_fill_up()
 
+                if not orgs:
+                    # 需要重建的组织都在等待批量重建，不递增版本，否则批量任务会跳过这个用户
+                    return
+
                 for org in orgs:
                     with tmp_to_org(org):
                         t_start = time.time()
                         logger.info(f'Rebuild user tree: user={self.user} org={current_org}')
                         utils = UserGrantedTreeBuildUtils(user)
-                        utils.rebuild_user_granted_tree()
+                        stats = utils.rebuild_user_granted_tree()
                         logger.info(
-                            f'Rebuild user tree ok: cost={time.time() - t_start} user={self.user} org={current_org}')
+                            f'Rebuild user tree ok: cost={time.time() - t_start} user={self.user} org={current_org} '
+                            f'rows: {stats}')
+                self.incr_tree_versions([user.id])
+
+    @classmethod
+    def incr_tree_version_in_pipeline(cls, pipeline, user_id):
+        pipeline.incr(cls.tree_version_key_template.format(user_id=user_id))
+
+    @classmethod
+    def incr_tree_versions(cls, user_ids):
+        client = cls.get_redis_client()
+        with client.pipeline() as p:
+            for user_id in user_ids:
+                cls.incr_tree_version_in_pipeline(p, user_id)
+            p.execute()
+
+    @classmethod
+    @on_transaction_commit
+    def incr_org_content_version(cls, org_id):
+        client = cls.get_redis_client()
+        client.incr(cls.org_content_version_key_template.format(org_id=org_id))
+
+    def get_tree_etag(self, *extras):
+        """
+        由授权树的版本、各组织节点资产映射和资产属性的版本生成 ETag，
+        有组织的授权树需要重建时返回 None
+
+        不查询授权树和资产，只读 redis
+        """
+        org_ids = sorted(self.org_ids)
+        key, org_epochs = self.get_built_mark_key_and_org_epochs()
+        with self.client.pipeline() as p:
+            p.hgetall(key)
+            p.get(self.tree_version_key_template.format(user_id=self.user.id))
+            for org_id in org_ids:
+                p.get(self.org_content_version_key_template.format(org_id=org_id))
+            ret = p.execute()
+
+        built_org_ids = self.parse_built_org_ids(ret[0], org_epochs)
+        if set(org_ids) - built_org_ids:
+            return None
+
+        tree_version = int(ret[1] or 0)
+        content_versions = [int(v or 0) for v in ret[2:]]
+        mapping_versions = [
+            PermNode.get_node_all_asset_ids_mapping_version(org_id) for org_id in org_ids
+        ]
+        value = json.dumps([
+            str(self.user.id), org_ids, tree_version, content_versions, mapping_versions,
+            settings.PERM_SINGLE_ASSET_TO_UNGROUP_NODE, *extras
+        ])
+        return '"{}"'.format(hashlib.md5(value.encode()).hexdigest())
+
+
+class AssetPermissionBoundarySchedule:
+    """
+    授权规则开始生效和过期时刻的时间表，保存在 redis 的有序集合中，分数是时间戳
+
+    周期任务取出已经到达的时刻，只刷新这些授权规则相关用户的授权树和判定缓存；
+    从数据库加载成功后在有序集合中加入分数为 +inf 的标记，标记不在时重新加载
+    """
+    key = 'perms.asset_permission.boundaries'
+    seeded_member = '__seeded__'
+    seed_batch_size = 1000
+
+    @classmethod
+    def get_redis_client(cls):
+        return cache.client.get_client(write=True)
+
+    @staticmethod
+    def get_members(perm_id):
+        return f'{perm_id}:start', f'{perm_id}:expired'
+
+    @classmethod
+    def _get_schedule(cls, perm_id, date_start, date_expired, now):
+        to_add, to_remove = {}, []
+        for member, dt in zip(cls.get_members(perm_id), (date_start, date_expired)):
+            timestamp = dt.timestamp() if dt else 0
+            if timestamp > now:
+                to_add[member] = timestamp
+            else:
+                to_remove.append(member)
+        return to_add, to_remove
+
+    @classmethod
+    @on_transaction_commit
+    def schedule(cls, perm_id, date_start, date_expired):
+        to_add, to_remove = cls._get_schedule(perm_id, date_start, date_expired, time.time())
+        client = cls.get_redis_client()
+        with client.pipeline() as p:
+            if to_add:
+                p.zadd(cls.key, to_add)
+            if to_remove:
+                p.zrem(cls.key, *to_remove)
+            p.execute()
+
+    @classmethod
+    @on_transaction_commit
+    def unschedule(cls, perm_id):
+        cls.get_redis_client().zrem(cls.key, *cls.get_members(perm_id))
+
+    @classmethod
+    def is_seeded(cls, client=None):
+        client = client or cls.get_redis_client()
+        return client.zscore(cls.key, cls.seeded_member) is not None
+
+    @classmethod
+    def seed_if_need(cls):
+        """
+        时间表没有加载过时（首次运行、上次加载失败或 redis 数据丢失），从数据库加载所有未到达的时刻
+        """
+        client = cls.get_redis_client()
+        if cls.is_seeded(client):
+            return
+
+        now = time.time()
+        now_dt = timezone.now()
+        with tmp_to_root_org():
+            perms = AssetPermission.objects.filter(
+                Q(date_start__gt=now_dt) | Q(date_expired__gt=now_dt)
+            ).values_list('id', 'date_start', 'date_expired')
+            perms = list(perms)
+
+        for i in range(0, len(perms), cls.seed_batch_size):
+            to_add = {}
+            for perm_id, date_start, date_expired in perms[i:i + cls.seed_batch_size]:
+                to_add.update(cls._get_schedule(perm_id, date_start, date_expired, now)[0])
+            if to_add:
+                client.zadd(cls.key, to_add)
+        # 标记的分数是 +inf，不会被当作到达的时刻取出
+        client.zadd(cls.key, {cls.seeded_member: float('inf')})
+        logger.info(f'Seed asset permission boundaries: perms={len(perms)}')
+
+    @classmethod
+    def pop_due_perm_ids(cls, now=None) -> set:
+        now = now or time.time()
+        client = cls.get_redis_client()
+        with client.pipeline(transaction=True) as p:
+            p.zrangebyscore(cls.key, '-inf', now)
+            p.zremrangebyscore(cls.key, '-inf', now)
+            members, __ = p.execute()
+        return {member.decode().split(':')[0] for member in members}
+
+    @classmethod
+    def refresh_due_perms(cls):
+        cls.seed_if_need()
+        perm_ids = cls.pop_due_perm_ids()
+        if not perm_ids:
+            return perm_ids
+        logger.info(f'Asset permissions reach start or expired time: {perm_ids}')
+        UserGrantedTreeRefreshController.add_need_refresh_by_asset_perm_ids_cross_orgs(perm_ids)
+        return perm_ids
+
+
+class AssetPermissionDecisionCache:
+    """
+    连接授权判定的缓存，按 (user, asset, system_user, action) 缓存是否允许以及过期时间
+
+    每个用户的判定存在一个 hash 里，失效时直接删除该用户的 hash；
+    判定同时记录计算时的全局 epoch 和资产所在组织的 epoch，
+    节点移动、删除或者设置变化时递增 epoch，旧的判定不再使用
+
+    命中统计不单独请求 redis：未命中在 `set` 写入判定时一起计数，
+    命中先在进程内累计，随下一次 `get` 的 pipeline 发送，所以统计会略微滞后
+    """
+    key_template = 'perms.user.asset.decision.user_id:{user_id}'
+    stats_key = 'perms.user.asset.decision.stats'
+    _pending_hits = 0
+    _pending_hits_lock = threading.Lock()
+
+    def __init__(self, user):
+        self.user = user
+        self.key = self.key_template.format(user_id=user.id)
+        self.client = self.get_redis_client()
+
+    @classmethod
+    def get_redis_client(cls):
+        return cache.client.get_client(write=True)
+
+    @staticmethod
+    def get_field(asset_id, system_user_id, action_name):
+        return f'{asset_id}:{system_user_id}:{action_name}'
+
+    @staticmethod
+    def get_epoch_keys(org_id):
+        return [
+            UserGrantedTreeRefreshController.global_epoch_key,
+            UserGrantedTreeRefreshController.org_epoch_key_template.format(org_id=org_id),
+        ]
+
+    def get(self, asset_id, system_user_id, action_name, org_id):
+        """
+        :return: ((has_permission, expire_at) 或 None, 当前版本)，
+                 判定需要用读取时的版本写入，避免计算期间的变更被覆盖
+        """
+        field = self.get_field(asset_id, system_user_id, action_name)
+        hits = self.pop_pending_hits()
+        with self.client.pipeline(transaction=False) as p:
+            p.hget(self.key, field)
+            p.mget(self.get_epoch_keys(org_id))
+            if hits:
+                p.hincrby(self.stats_key, 'hit', hits)
+            value, epochs = p.execute()[:2]
+        version = '.'.join(str(int(v or 0)) for v in epochs)
+
+        decision = None
+        if value:
+            allowed, __, rest = value.decode().partition(':')
+            expire_at, __, value_version = rest.partition(':')
+            expire_at = float(expire_at)
+            if value_version == version and expire_at > time.time():
+                decision = (allowed == '1', expire_at)
+
+        if decision:
+            self.add_pending_hits(1)
+        return decision, version
+
+    @classmethod
+    def add_pending_hits(cls, count):
+        with cls._pending_hits_lock:
+            cls._pending_hits += count
+
+    @classmethod
+    def pop_pending_hits(cls):
+        with cls._pending_hits_lock:
+            hits, cls._pending_hits = cls._pending_hits, 0
+        return hits
+
+    def set(self, asset_id, system_user_id, action_name, allowed, expire_at, version):
+        """
+        拒绝的判定不会有授权过期时间，最多缓存 `PERM_DECISION_CACHE_TTL` 秒，
+        以便授权开始生效时能及时允许
+        """
+        ttl = settings.PERM_DECISION_CACHE_TTL
+        max_expire_at = time.time() + ttl
+        if not allowed or expire_at > max_expire_at:
+            expire_at = max_expire_at
+
+        field = self.get_field(asset_id, system_user_id, action_name)
+        with self.client.pipeline() as p:
+            p.hset(self.key, field, f'{int(allowed)}:{expire_at}:{version}')
+            p.expire(self.key, ttl)
+            # 只有未命中时才会写入判定
+            p.hincrby(self.stats_key, 'miss', 1)
+            p.execute()
+
+    @classmethod
+    def expire_in_pipeline(cls, pipeline, user_id):
+        key = cls.key_template.format(user_id=user_id)
+        pipeline.delete(key)
+
+    @classmethod
+    @on_transaction_commit
+    def expire_by_user_ids(cls, user_ids):
+        client = cls.get_redis_client()
+        with client.pipeline() as p:
+            for user_id in user_ids:
+                cls.expire_in_pipeline(p, user_id)
+            p.execute()
+
+    @classmethod
+    @ensure_in_real_or_default_org
+    def expire_by_asset_perm_ids(cls, asset_perm_ids):
+        user_ids = UserGrantedTreeRefreshController.get_user_ids_by_asset_perm_ids(asset_perm_ids)
+        cls.expire_by_user_ids(user_ids)
+
+    @classmethod
+    def get_stats(cls):
+        client = cls.get_redis_client()
+        stats = client.hgetall(cls.stats_key)
+        stats = {k.decode(): int(v) for k, v in stats.items()}
+        return {'hit': stats.get('hit', 0), 'miss': stats.get('miss', 0)}
+
+
+class UserAssetPermIdsCache:
+    """
+    用户有效授权规则的缓存，按用户和组织缓存
+
+    缓存的是激活的授权规则及其开始、过期时间，读取时按当前时间过滤，
+    授权规则开始生效或过期不需要失效缓存；
+    授权规则、与用户和用户组的关系或者用户组成员变化时递增组织的版本号，
+    版本号不一致的缓存被丢弃。全局组织使用单独的版本号，任何组织变化时都会递增
+    """
+    key_template = 'perms.user.asset_perm_ids.user_id:{user_id}.org_id:{org_id}'
+    version_key_template = 'perms.asset_permission.version.org_id:{org_id}'
+    ttl = 3600 * 24
+
+    def __init__(self, user):
+        self.user = user
+        self.org_id = str(current_org.id) if current_org else ''
+        self.key = self.key_template.format(user_id=user.id, org_id=self.org_id)
+        self.version_key = self.version_key_template.format(org_id=self.org_id)
+        self.client = self.get_redis_client()
+
+    @classmethod
+    def get_redis_client(cls):
+        return cache.client.get_client(write=True)
+
+    @classmethod
+    def incr_version_in_pipeline(cls, pipeline, org_ids):
+        if not org_ids:
+            return
+        org_ids = {str(org_id) for org_id in org_ids}
+        org_ids.add(Organization.ROOT_ID)
+        for org_id in org_ids:
+            pipeline.incr(cls.version_key_template.format(org_id=org_id))
+
+    def get_version_and_perms(self):
+        with self.client.pipeline() as p:
+            p.get(self.version_key)
+            p.get(self.key)
+            version, value = p.execute()
+        version = int(version or 0)
+        if not value:
+            return version, None
+        value = json.loads(value)
+        if value['version'] != version:
+            return version, None
+        return version, value['perms']
+
+    @staticmethod
+    def filter_valid_perm_ids(perms) -> set:
+        now = time.time()
+        return {
+            uuid.UUID(perm_id) for perm_id, date_start, date_expired in perms
+            if date_start < now < date_expired
+        }
+
+    def compute_perms(self) -> list:
+        """
+        :return: [(perm_id, date_start, date_expired), ]
+        """
+        perm_ids = get_user_related_asset_perm_ids(self.user)
+        values = AssetPermission.objects.filter(
+            id__in=perm_ids
+        ).active().values_list('id', 'date_start', 'date_expired')
+        return [
+            (str(perm_id), date_start.timestamp(), date_expired.timestamp())
+            for perm_id, date_start, date_expired in values
+        ]
+
+    def get_or_refresh(self) -> set:
+        if not self.org_id:
+            return self.filter_valid_perm_ids(self.compute_perms())
+
+        # 先读版本号再查询，查询期间有变化时写入的缓存会因为版本号旧而被丢弃
+        version, perms = self.get_version_and_perms()
+        if perms is None:
+            perms = self.compute_perms()
+            value = json.dumps({'version': version, 'perms': perms})
+            self.client.set(self.key, value, ex=self.ttl)
+        return self.filter_valid_perm_ids(perms)
+
+
+class UserAssetSystemUsersMap:
+    """
+    用户在一个组织内授权的 资产 -> {系统用户: 动作} 映射，保存在 redis hash 中，
+    连接时查询资产可用的系统用户不需要再关联节点、资产和授权规则
+
+    hash 的 field 是资产 id，value 是 `{系统用户: 动作}` 去重后的序号；
+    映射有自己的版本，只在用户的授权变化时递增(收藏、重建授权树不变)，与 epoch 一起判断是否失效。
+    失效或没有映射时回退到查询，并在 celery 中重建一次；
+    授权的资产超过 `PERM_ASSET_SYSTEM_USERS_MAP_MAX_ASSETS` 时不保存映射，回退到查询
+    """
+    key_template = 'perms.user.asset_system_users.user_id:{user_id}.org_id:{org_id}'
+    version_key_template = 'perms.user.asset_system_users.version.user_id:{user_id}'
+    building_key_template = 'perms.user.asset_system_users.building.user_id:{user_id}.org_id:{org_id}'
+    building_ttl = 60
+    version_field = '_version'
+    profiles_field = '_profiles'
+    overflow_field = '_overflow'
+    ttl = 3600 * 24
+    write_batch_size = 5000
+
+    def __init__(self, user, org_id):
+        self.user = user
+        self.org_id = str(org_id)
+        self.key = self.key_template.format(user_id=user.id, org_id=self.org_id)
+        self.client = self.get_redis_client()
+
+    @classmethod
+    def get_redis_client(cls):
+        return cache.client.get_client(write=True)
+
+    @classmethod
+    def incr_version_in_pipeline(cls, pipeline, user_id):
+        pipeline.incr(cls.version_key_template.format(user_id=user_id))
+
+    def get_version_in_pipeline(self, pipeline):
+        pipeline.get(self.version_key_template.format(user_id=self.user.id))
+        pipeline.get(UserGrantedTreeRefreshController.global_epoch_key)
+        pipeline.get(UserGrantedTreeRefreshController.org_epoch_key_template.format(org_id=self.org_id))
+
+    @staticmethod
+    def to_version(map_version, global_epoch, org_epoch):
+        return f'{int(map_version or 0)}:{int(global_epoch or 0)}:{int(org_epoch or 0)}'
+
+    def get_version(self):
+        with self.client.pipeline() as p:
+            self.get_version_in_pipeline(p)
+            return self.to_version(*p.execute())
+
+    def compute_mapper(self) -> dict:
+        """
+        :return: {asset_id(str): {system_user_id(str): actions}}
+        """
+        with tmp_to_org(self.org_id):
+            perm_ids = UserAssetPermIdsCache(self.user).get_or_refresh()
+            perm_actions = dict(
+                AssetPermission.objects.filter(id__in=perm_ids).values_list('id', 'actions')
+            )
+            perm_su_actions = defaultdict(dict)
+            su_pairs = AssetPermission.system_users.through.objects.filter(
+                assetpermission_id__in=perm_ids
+            ).values_list('assetpermission_id', 'systemuser_id')
+            for perm_id, system_user_id in su_pairs:
+                perm_su_actions[perm_id][str(system_user_id)] = perm_actions.get(perm_id) or 0
+
+            perm_node_keys = defaultdict(set)
+            node_pairs = AssetPermission.nodes.through.objects.filter(
+                assetpermission_id__in=perm_su_actions.keys()
+            ).values_list('assetpermission_id', 'node__key')
+            for perm_id, node_key in node_pairs:
+                perm_node_keys[perm_id].add(node_key)
+
+            perm_asset_ids = defaultdict(set)
+            asset_pairs = AssetPermission.assets.through.objects.filter(
+                assetpermission_id__in=perm_su_actions.keys()
+            ).annotate(
+                asset_id_str=output_as_string('asset_id')
+            ).values_list('assetpermission_id', 'asset_id_str')
+            for perm_id, asset_id in asset_pairs:
+                perm_asset_ids[perm_id].add(asset_id)
+
+        index = PermNode.get_node_all_asset_ids_mapping(self.org_id)
+        mapper = defaultdict(dict)
+        for perm_id, su_actions in perm_su_actions.items():
+            asset_ids = perm_asset_ids.get(perm_id, set())
+            node_keys = perm_node_keys.get(perm_id)
+            if node_keys:
+                asset_ids = asset_ids | index.to_asset_ids(index.union(node_keys))
+            for asset_id in asset_ids:
+                entry = mapper[asset_id]
+                for system_user_id, actions in su_actions.items():
+                    entry[system_user_id] = entry.get(system_user_id, 0) | actions
+        return mapper
+
+    @timeit
+    def build(self, version=None) -> dict:
+        # 先读版本再计算，计算期间有变化时写入的映射版本是旧的，读取时会被丢弃
+        if version is None:
+            version = self.get_version()
+        mapper = self.compute_mapper()
+
+        with self.client.pipeline() as p:
+            p.delete(self.key)
+            if len(mapper) > settings.PERM_ASSET_SYSTEM_USERS_MAP_MAX_ASSETS:
+                p.hset(self.key, mapping={self.version_field: version, self.overflow_field: 1})
+            else:
+                self._write_in_pipeline(p, mapper, version)
+            p.expire(self.key, self.ttl)
+            p.delete(self.building_key_template.format(user_id=self.user.id, org_id=self.org_id))
+            p.execute()
+        logger.debug(f'Build user asset system users map: user={self.user} org={self.org_id} '
+                     f'assets={len(mapper)}')
+        return mapper
+
+    def _write_in_pipeline(self, pipeline, mapper, version):
+        profiles = []
+        profile_index_mapper = {}
+        fields = {}
+        for asset_id, su_actions in mapper.items():
+            profile = json.dumps(su_actions, sort_keys=True)
+            i = profile_index_mapper.get(profile)
+            if i is None:
+                i = len(profiles)
+                profile_index_mapper[profile] = i
+                profiles.append(su_actions)
+            fields[asset_id] = i
+
+        pipeline.hset(self.key, mapping={
+            self.version_field: version,
+            self.profiles_field: json.dumps(profiles)
+        })
+        asset_ids = list(fields.keys())
+        for i in range(0, len(asset_ids), self.write_batch_size):
+            pipeline.hset(self.key, mapping={
+                asset_id: fields[asset_id] for asset_id in asset_ids[i:i + self.write_batch_size]
+            })
+
+    def build_async(self):
+        """
+        提交重建映射的任务，同一个用户和组织在重建完成前只提交一次
+        """
+        from perms.tasks import build_user_asset_system_users_map
+
+        key = self.building_key_template.format(user_id=self.user.id, org_id=self.org_id)
+        if self.client.set(key, 1, nx=True, ex=self.building_ttl):
+            build_user_asset_system_users_map.delay(str(self.user.id), self.org_id)
+
+    def get(self, asset_id):
+        """
+        :return: {system_user_id(str): actions}，没有可用的映射或者授权的资产太多时返回 None
+        """
+        asset_id = str(asset_id)
+        with self.client.pipeline() as p:
+            self.get_version_in_pipeline(p)
+            p.hmget(self.key, self.version_field, self.overflow_field, asset_id, self.profiles_field)
+            map_version, global_epoch, org_epoch, values = p.execute()
+
+        version = self.to_version(map_version, global_epoch, org_epoch)
+        stored_version, overflow, profile_index, profiles = values
+        if stored_version is None or stored_version.decode() != version:
+            # 不在请求中构建整个映射，这次回退到查询
+            self.build_async()
+            return None
+
+        if overflow:
+            return None
+        if profile_index is None:
+            return {}
+        return json.loads(profiles)[int(profile_index)]
+
+    def get_system_user_ids_with_actions(self, asset):
+        """
+        与 `get_asset_system_user_ids_with_actions` 的结果一致，只返回协议与资产匹配的系统用户
+        """
+        su_actions = self.get(asset.id)
+        if su_actions is None:
+            return None
+
+        system_users_actions = defaultdict(int)
+        if not su_actions:
+            return system_users_actions
+
+        with tmp_to_org(self.org_id):
+            system_user_ids = SystemUser.objects.filter(
+                id__in=su_actions.keys(),
+                protocol__in=asset.protocols_as_dict.keys()
+            ).values_list('id', flat=True)
+            for system_user_id in system_user_ids:
+                system_users_actions[system_user_id] = su_actions[str(system_user_id)]
+        return system_users_actions
+
+
+class UserGrantedTreeRefreshAccumulator:
+    """
+    在一个事务中收集授权相关信号的变化，提交时统一计算受影响的用户，
+    再用一个 redis pipeline 去掉已构建的标记和连接授权的判定缓存
+
+    批量操作（如给授权添加 500 个用户）会触发大量信号，合并后只需处理一次
+    """
+    local_attr = 'perms_user_granted_tree_refresh_changes'
+    perm_changed_fields = ('perm_ids', 'decision_perm_ids', 'group_ids', 'user_ids')
+
+    def __init__(self):
+        # org_id -> {'perm_ids', 'decision_perm_ids', 'node_ids', 'asset_ids', 'group_ids', 'user_ids'}
+        self.org_changes = defaultdict(lambda: defaultdict(set))
+
+    @classmethod
+    def get_current(cls):
+        accumulator = getattr(thread_local, cls.local_attr, None)
+        if accumulator is None:
+            accumulator = cls()
+            setattr(thread_local, cls.local_attr, accumulator)
+        return accumulator
+
+    @classmethod
+    def _add(cls, org_id, field, values):
+        accumulator = cls.get_current()
+        accumulator.org_changes[str(org_id)][field].update(values or ())
+        # 每次都注册，第一个回调执行后其他的都是空操作；
+        # 事务回滚时残留的变化会在下次提交时一起处理，多刷新不影响正确性
+        transaction.on_commit(cls.flush)
+
+    @classmethod
+    def add_asset_perm_ids(cls, org_id, asset_perm_ids):
+        cls._add(org_id, 'perm_ids', asset_perm_ids)
+
+    @classmethod
+    def add_decision_asset_perm_ids(cls, org_id, asset_perm_ids):
+        """ 只影响连接授权的判定，不影响授权树 """
+        cls._add(org_id, 'decision_perm_ids', asset_perm_ids)
+
+    @classmethod
+    def add_nodes_assets(cls, org_id, node_ids, asset_ids):
+        cls._add(org_id, 'node_ids', node_ids)
+        cls._add(org_id, 'asset_ids', asset_ids)
+
+    @classmethod
+    def add_user_group_ids(cls, org_id, group_ids):
+        cls._add(org_id, 'group_ids', group_ids)
+
+    @classmethod
+    def add_user_ids(cls, org_id, user_ids):
+        cls._add(org_id, 'user_ids', user_ids)
+
+    @classmethod
+    def flush(cls):
+        accumulator = getattr(thread_local, cls.local_attr, None)
+        if accumulator is None or not accumulator.org_changes:
+            return
+        setattr(thread_local, cls.local_attr, None)
+        accumulator.apply()
+
+    @staticmethod
+    def compute_org_perm_ids(changes) -> set:
+        perm_ids = set(changes['perm_ids'])
+        if changes['node_ids'] or changes['asset_ids']:
+            perm_ids.update(UserGrantedTreeRefreshController.get_asset_perm_ids_by_nodes_assets(
+                changes['node_ids'], changes['asset_ids']
+            ))
+        return perm_ids
+
+    def compute_org_user_ids(self, changes, perm_ids):
+        """
+        :return: (需要重建授权树的用户, 只需要失效判定缓存的用户)
+        """
+        user_ids = {str(i) for i in changes['user_ids']}
+        if perm_ids:
+            user_ids.update(str(i) for i in UserGrantedTreeRefreshController.get_user_ids_by_asset_perm_ids(perm_ids))
+        if changes['group_ids']:
+            group_user_ids = User.groups.through.objects.filter(
+                usergroup_id__in=changes['group_ids']
+            ).values_list('user_id', flat=True)
+            user_ids.update(str(i) for i in group_user_ids)
+
+        decision_perm_ids = changes['decision_perm_ids'] - perm_ids
+        decision_user_ids = set()
+        if decision_perm_ids:
+            decision_user_ids = UserGrantedTreeRefreshController.get_user_ids_by_asset_perm_ids(decision_perm_ids)
+            decision_user_ids = {str(i) for i in decision_user_ids} - user_ids
+        return user_ids, decision_user_ids
+
+    @timeit
+    def apply(self):
+        user_org_ids = defaultdict(set)
+        decision_user_ids = set()
+        org_user_ids = {}
+        org_perm_ids = {}
+        perm_changed_org_ids = set()
+
+        for org_id, changes in self.org_changes.items():
+            # 只有节点和资产的关系变化时，用户的授权规则不变
+            if any(changes[field] for field in self.perm_changed_fields):
+                perm_changed_org_ids.add(org_id)
+            with tmp_to_org(org_id):
+                perm_ids = self.compute_org_perm_ids(changes)
+                _user_ids, _decision_user_ids = self.compute_org_user_ids(changes, perm_ids)
+            org_perm_ids[org_id] = perm_ids
+            for user_id in _user_ids:
+                user_org_ids[user_id].add(org_id)
+            decision_user_ids.update(_decision_user_ids)
+            org_user_ids[org_id] = _user_ids
+
+        client = UserGrantedTreeRefreshController.get_redis_client()
+        epoch, org_epochs = UserGrantedTreeRefreshController.get_epochs(client, org_user_ids.keys())
+        with client.pipeline() as p:
+            for user_id, org_ids in user_org_ids.items():
+                UserGrantedTreeRefreshController.remove_built_orgs_in_pipeline(
+                    p, user_id, epoch, {org_id: org_epochs[str(org_id)] for org_id in org_ids}
+                )
+                UserGrantedTreeRefreshController.incr_tree_version_in_pipeline(p, user_id)
+                UserAssetSystemUsersMap.incr_version_in_pipeline(p, user_id)
+                AssetPermissionDecisionCache.expire_in_pipeline(p, user_id)
+            for user_id in decision_user_ids:
+                # 动作变化会影响按系统用户筛选的授权树和 资产 -> 系统用户 的映射
+                UserGrantedTreeRefreshController.incr_tree_version_in_pipeline(p, user_id)
+                UserAssetSystemUsersMap.incr_version_in_pipeline(p, user_id)
+                AssetPermissionDecisionCache.expire_in_pipeline(p, user_id)
+            UserAssetPermIdsCache.incr_version_in_pipeline(p, perm_changed_org_ids)
+            p.execute()
+        logger.info(
+            f'Remove orgs from users built tree: users={len(user_org_ids)} '
+            f'orgs={list(org_user_ids.keys())} decision_users={len(decision_user_ids)}'
+        )
+
+        for org_id, user_ids in org_user_ids.items():
+            UserGrantedTreeRefreshController.rebuild_users_tree_in_batch_if_need(org_id, user_ids)
+
+        from .reverse_index import AssetPermReverseIndexUtil
+        for org_id, perm_ids in org_perm_ids.items():
+            AssetPermReverseIndexUtil.rebuild_perms_async(org_id, perm_ids)
 
 
 class UserGrantedUtilsBase:
@@ -262,24 +1170,99 @@ class UserGrantedTreeBuildUtils(UserGrantedUtilsBase):
         return asset_ids
 
     @ensure_in_real_or_default_org
-    def rebuild_user_granted_tree(self):
+    def rebuild_user_granted_tree(self, delta=None):
         """
         注意：调用该方法一定要被 `UserGrantedTreeRebuildLock` 锁住
+
+        :param delta: 是否增量重建，默认取 `settings.PERM_TREE_REBUILD_DELTA`
+        :return: `GrantedTreeRebuildStats`
         """
+        if delta is None:
+            delta = settings.PERM_TREE_REBUILD_DELTA
+        if delta:
+            return self.rebuild_user_granted_tree_delta()
+
         user = self.user
+        stats = GrantedTreeRebuildStats()
 
         # 先删除旧的授权树🌲
-        UserAssetGrantedTreeNodeRelation.objects.filter(user=user).delete()
+        stats.deleted, __ = UserAssetGrantedTreeNodeRelation.objects.filter(user=user).delete()
 
+        nodes = self.compute_user_granted_tree_nodes()
+        if not nodes:
+            return stats
+        self.create_mapping_nodes(nodes)
+        stats.created = len(nodes)
+        return stats
+
+    def compute_user_granted_tree_nodes(self) -> list:
         if not self.asset_perm_ids:
             # 没有授权直接返回
-            return
+            return []
 
         nodes = self.compute_perm_nodes_tree()
         self.compute_node_assets_amount(nodes)
-        if not nodes:
-            return
-        self.create_mapping_nodes(nodes)
+        return nodes
+
+    @ensure_in_real_or_default_org
+    def rebuild_user_granted_tree_delta(self):
+        """
+        增量重建授权树：计算出新的节点集合，与已存储的 `UserAssetGrantedTreeNodeRelation`
+        做对比，只新增、更新、删除发生变化的行
+
+        注意：调用该方法一定要被 `UserGrantedTreeRebuildLock` 锁住
+        """
+        user = self.user
+        stats = GrantedTreeRebuildStats()
+
+        nodes = self.compute_user_granted_tree_nodes()
+
+        nodeid_rel_mapper = {}
+        to_delete_ids = []
+        existed_rels = UserAssetGrantedTreeNodeRelation.objects.filter(user=user).only(
+            'id', 'node_id', *GrantedTreeRebuildStats.compare_fields
+        )
+        for rel in existed_rels:
+            if rel.node_id in nodeid_rel_mapper:
+                # 重复的数据，直接删掉
+                to_delete_ids.append(rel.id)
+                continue
+            nodeid_rel_mapper[rel.node_id] = rel
+
+        to_create = []
+        to_update = []
+        for node in nodes:
+            rel = nodeid_rel_mapper.pop(node.id, None)
+            if rel is None:
+                to_create.append(self._build_mapping_node(node))
+                continue
+
+            changed = False
+            for field, value in self._get_mapping_node_values(node).items():
+                if getattr(rel, field) != value:
+                    setattr(rel, field, value)
+                    changed = True
+            if changed:
+                to_update.append(rel)
+            else:
+                stats.kept += 1
+
+        # 剩下的是新树里已经不存在的节点
+        to_delete_ids.extend(rel.id for rel in nodeid_rel_mapper.values())
+
+        if to_delete_ids:
+            UserAssetGrantedTreeNodeRelation.objects.filter(id__in=to_delete_ids).delete()
+        if to_update:
+            UserAssetGrantedTreeNodeRelation.objects.bulk_update(
+                to_update, fields=GrantedTreeRebuildStats.compare_fields
+            )
+        if to_create:
+            UserAssetGrantedTreeNodeRelation.objects.bulk_create(to_create)
+
+        stats.created = len(to_create)
+        stats.updated = len(to_update)
+        stats.deleted = len(to_delete_ids)
+        return stats
 
     @timeit
     def compute_perm_nodes_tree(self, node_only_fields=NODE_ONLY_FIELDS) -> list:
@@ -347,22 +1330,26 @@ class UserGrantedTreeBuildUtils(UserGrantedUtilsBase):
         result = [*leaf_nodes, *ancestors]
         return result
 
+    @staticmethod
+    def _get_mapping_node_values(node) -> dict:
+        return {
+            'node_key': node.key,
+            'node_parent_key': node.parent_key,
+            'node_from': node.node_from,
+            'node_assets_amount': node.assets_amount,
+        }
+
+    def _build_mapping_node(self, node):
+        return UserAssetGrantedTreeNodeRelation(
+            user=self.user,
+            node=node,
+            org_id=node.org_id,
+            **self._get_mapping_node_values(node)
+        )
+
     @timeit
     def create_mapping_nodes(self, nodes):
-        user = self.user
-        to_create = []
-
-        for node in nodes:
-            to_create.append(UserAssetGrantedTreeNodeRelation(
-                user=user,
-                node=node,
-                node_key=node.key,
-                node_parent_key=node.parent_key,
-                node_from=node.node_from,
-                node_assets_amount=node.assets_amount,
-                org_id=node.org_id
-            ))
-
+        to_create = [self._build_mapping_node(node) for node in nodes]
         UserAssetGrantedTreeNodeRelation.objects.bulk_create(to_create)
 
     @timeit
@@ -395,7 +1382,7 @@ class UserGrantedTreeBuildUtils(UserGrantedUtilsBase):
             node = nodes[0]
             if node.node_from == NodeFrom.granted and node.key.isdigit():
                 with tmp_to_org(node.org):
-                    node.granted_assets_amount = len(node.get_all_asset_ids())
+                    node.granted_assets_amount = PermNode.get_all_assets_amount_by_node_key(node.org_id, node.key)
                     return
 
         direct_granted_nodes_key = []
@@ -436,12 +1423,10 @@ class UserGrantedTreeBuildUtils(UserGrantedUtilsBase):
         self.compute_node_assets_amount(nodes)
 
         # 查询直接授权节点的子节点
-        q = Q()
-        for node in self.get_direct_granted_nodes().only('key'):
-            q |= Q(key__startswith=f'{node.key}:')
-
-        if q:
-            descendant_nodes = PermNode.objects.filter(q).distinct()
+        granted_node_ids = list(self.get_direct_granted_nodes().values_list('id', flat=True))
+        if granted_node_ids:
+            descendant_ids = PermNode.get_nodes_descendant_ids(granted_node_ids, with_self=False)
+            descendant_nodes = PermNode.objects.filter(id__in=descendant_ids).distinct()
         else:
             descendant_nodes = PermNode.objects.none()
 
@@ -556,7 +1541,8 @@ class UserGrantedAssetsQueryUtils(UserGrantedUtilsBase):
 
 class UserGrantedNodesQueryUtils(UserGrantedUtilsBase):
     def sort(self, nodes):
-        nodes = sorted(nodes, key=lambda x: x.value)
+        # 与分页时数据库的排序 (value, key) 一致
+        nodes = sorted(nodes, key=lambda x: (x.value, x.key))
         return nodes
 
     def get_node_children(self, key):
@@ -567,16 +1553,53 @@ class UserGrantedNodesQueryUtils(UserGrantedUtilsBase):
         if key in [PermNode.FAVORITE_NODE_KEY, PermNode.UNGROUPED_NODE_KEY]:
             return nodes
 
+        nodes, is_indirect = self.get_node_children_queryset(key)
+        if is_indirect:
+            self.use_granted_assets_amount(nodes)
+        nodes = self.sort(nodes)
+        return nodes
+
+    def get_node_children_queryset(self, key) -> Tuple[QuerySet, bool]:
+        """
+        :return: (子节点 queryset, 是否是未直接授权节点的子节点)
+        """
         node = PermNode.objects.get(key=key)
         granted_status = node.get_granted_status(self.user)
         if granted_status == NodeFrom.granted:
-            nodes = PermNode.objects.filter(parent_key=key)
+            return PermNode.objects.filter(parent_key=key), False
         elif granted_status in (NodeFrom.asset, NodeFrom.child):
-            nodes = self.get_indirect_granted_node_children(key)
-        nodes = self.sort(nodes)
+            return self.get_indirect_granted_node_children_queryset(key), True
+        return PermNode.objects.none(), False
+
+    def get_node_children_page(self, key, paginator) -> list:
+        """
+        按游标分页获取子节点，特殊节点只在顶层的第一页返回
+
+        :param paginator: `assets.pagination.NodeChildrenCursorPagination`
+        """
+        if key in [PermNode.FAVORITE_NODE_KEY, PermNode.UNGROUPED_NODE_KEY]:
+            return []
+
+        if not key:
+            nodes = self.get_special_nodes() if paginator.is_first_page else []
+            queryset, is_indirect = self.get_indirect_granted_node_children_queryset(''), True
+        else:
+            nodes = []
+            queryset, is_indirect = self.get_node_children_queryset(key)
+
+        children = paginator.paginate_queryset(queryset)
+        if is_indirect:
+            self.use_granted_assets_amount(children)
+        nodes.extend(children)
         return nodes
 
-    def get_indirect_granted_node_children(self, key):
+    @staticmethod
+    def use_granted_assets_amount(nodes):
+        # 设置节点授权资产数量
+        for node in nodes:
+            node.use_granted_assets_amount()
+
+    def get_indirect_granted_node_children_queryset(self, key):
         """
         获取用户授权树中未授权节点的子节点
         只匹配在 `UserAssetGrantedTreeNodeRelation` 中存在的节点
@@ -588,10 +1611,11 @@ class UserGrantedNodesQueryUtils(UserGrantedUtilsBase):
         ).annotate(
             **PermNode.annotate_granted_node_rel_fields
         ).distinct()
+        return nodes
 
-        # 设置节点授权资产数量
-        for node in nodes:
-            node.use_granted_assets_amount()
+    def get_indirect_granted_node_children(self, key):
+        nodes = self.get_indirect_granted_node_children_queryset(key)
+        self.use_granted_assets_amount(nodes)
         return nodes
 
     def get_top_level_nodes(self):
@@ -633,21 +1657,19 @@ class UserGrantedNodesQueryUtils(UserGrantedUtilsBase):
         ).distinct()
 
         key_to_node_mapper = {}
-        nodes_descendant_q = Q()
+        granted_node_ids = []
 
         for node in nodes:
             node.use_granted_assets_amount()
             key_to_node_mapper[node.key] = node
 
             if node.node_from == NodeFrom.granted:
-                # 直接授权的节点
-                # 增加查询后代节点的过滤条件
-                nodes_descendant_q |= Q(key__startswith=f'{node.key}:')
+                # 直接授权的节点，要查询其后代节点
+                granted_node_ids.append(node.id)
 
-        if nodes_descendant_q:
-            descendant_nodes = PermNode.objects.filter(
-                nodes_descendant_q
-            )
+        if granted_node_ids:
+            descendant_ids = PermNode.get_nodes_descendant_ids(granted_node_ids, with_self=False)
+            descendant_nodes = PermNode.objects.filter(id__in=descendant_ids)
             for node in descendant_nodes:
                 key_to_node_mapper[node.key] = node
 
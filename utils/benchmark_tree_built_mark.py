@@ -0,0 +1,136 @@
+#!/usr/bin/python
+#
+# 对比用户授权树已构建标记的两种失效方式：
+#   旧: KEYS 扫描后逐个删除
+#   新: 递增全局 epoch
+#
+# 只能在单独的、空的 redis db 中运行，不会读写 jumpserver 正在使用的 key，结束后清空这个 db
+#
+# python benchmark_tree_built_mark.py --redis-db 15 [--users 100000] [--orgs 3]
+
+import argparse
+import os
+import sys
+import time
+import uuid
+import django
+
+
+if os.path.exists('../apps'):
+    sys.path.insert(0, '../apps')
+elif os.path.exists('./apps'):
+    sys.path.insert(0, './apps')
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "jumpserver.settings")
+django.setup()
+
+import redis
+from django.conf import settings
+from jumpserver.const import CONFIG
+from perms.utils.asset.user_permission import UserGrantedTreeRefreshController
+
+
+class Controller(UserGrantedTreeRefreshController):
+    """ 所有读写都使用压测的 redis db """
+    client = None
+
+    @classmethod
+    def get_redis_client(cls):
+        return cls.client
+
+
+LEGACY_KEY_TEMPLATE = 'benchmark.perms.user.node_tree.built_orgs.user_id:{user_id}'
+BATCH_SIZE = 5000
+
+
+def timed(name, func, *args):
+    t_start = time.time()
+    ret = func(*args)
+    print('{:<40} {:.3f}s'.format(name, time.time() - t_start))
+    return ret
+
+
+def fill_legacy_marks(client, user_ids, org_ids):
+    for i in range(0, len(user_ids), BATCH_SIZE):
+        with client.pipeline() as p:
+            for user_id in user_ids[i:i + BATCH_SIZE]:
+                p.sadd(LEGACY_KEY_TEMPLATE.format(user_id=user_id), *org_ids)
+            p.execute()
+
+
+def clean_legacy_marks(client):
+    keys = client.keys(LEGACY_KEY_TEMPLATE.format(user_id='*'))
+    with client.pipeline() as p:
+        for key in keys:
+            p.delete(key)
+        p.execute()
+    return len(keys)
+
+
+def fill_epoch_marks(client, user_ids, org_ids):
+    for org_id in org_ids:
+        for i in range(0, len(user_ids), BATCH_SIZE):
+            Controller.set_org_as_built_for_users(org_id, user_ids[i:i + BATCH_SIZE])
+
+
+def count_built_users(client, user_ids, org_ids):
+    epoch, org_epochs = Controller.get_epochs(client, org_ids)
+    built = 0
+    for i in range(0, len(user_ids), BATCH_SIZE):
+        with client.pipeline() as p:
+            for user_id in user_ids[i:i + BATCH_SIZE]:
+                p.hgetall(Controller.get_built_mark_key(user_id, epoch))
+            for members in p.execute():
+                if Controller.parse_built_org_ids(members, org_epochs):
+                    built += 1
+    return built
+
+
+def get_isolated_client(db):
+    used_dbs = {
+        CONFIG.REDIS_DB_CELERY, CONFIG.REDIS_DB_CACHE,
+        CONFIG.REDIS_DB_SESSION, CONFIG.REDIS_DB_WS,
+    }
+    if db in used_dbs:
+        sys.exit('Redis db {} is used by jumpserver, choose another one'.format(db))
+    client = redis.Redis(
+        host=settings.REDIS_HOST, port=settings.REDIS_PORT,
+        password=settings.REDIS_PASSWORD or None, db=db
+    )
+    if client.dbsize():
+        sys.exit('Redis db {} is not empty, refuse to run'.format(db))
+    return client
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark user tree built mark invalidation')
+    parser.add_argument('--redis-db', type=int, required=True,
+                        help='An empty redis db not used by jumpserver, it is flushed after running')
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--orgs', type=int, default=3)
+    args = parser.parse_args()
+
+    client = get_isolated_client(args.redis_db)
+    Controller.client = client
+    user_ids = [str(uuid.uuid4()) for _ in range(args.users)]
+    org_ids = [str(uuid.uuid4()) for _ in range(args.orgs)]
+    print('Users: {}, orgs: {}, redis db: {}'.format(args.users, args.orgs, args.redis_db))
+
+    try:
+        timed('Legacy: fill marks', fill_legacy_marks, client, user_ids, org_ids)
+        deleted = timed('Legacy: KEYS + DEL', clean_legacy_marks, client)
+        print('Legacy: deleted keys {}'.format(deleted))
+
+        timed('Epoch: fill marks', fill_epoch_marks, client, user_ids, org_ids)
+        built = timed('Epoch: check marks', count_built_users, client, user_ids, org_ids)
+        print('Epoch: built users before clean {}'.format(built))
+        timed('Epoch: INCR global epoch', Controller.clean_all_user_tree_built_mark)
+        built = timed('Epoch: check marks', count_built_users, client, user_ids, org_ids)
+        print('Epoch: built users after clean {}'.format(built))
+    finally:
+        # 运行前已经确认 db 是空的，这里的 key 都是压测写入的
+        client.flushdb()
+
+
+if __name__ == '__main__':
+    main()